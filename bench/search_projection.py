@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the bytes and time saved by asking the search API for fewer fields.
+
+For a page of typical annotations (see ``streamer_fanout.py``), as returned
+to the sidebar, this reports for the whole annotation and for some
+projections (the ``fields`` and ``exclude`` search params):
+
+- the size of the hits in the Elasticsearch response, which Elasticsearch
+  filters before sending them when the search asks for fewer fields,
+- the size of the search API's response, and
+- the time taken by the web application to decode the Elasticsearch response,
+  render the rows and encode the API response.
+
+The time Elasticsearch takes to filter the hits, and to send them, is not
+measured.
+
+Usage::
+
+    python bench/search_projection.py [--limit N] [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import timeit
+
+from webob.multidict import MultiDict
+
+from h.api.models import Annotation
+from h.api.search import query
+from h.api.search import transform
+
+from streamer_fanout import ANNOTATION
+
+PROJECTIONS = [
+    ('whole annotation', []),
+    ('exclude=document', [('exclude', 'document')]),
+    ('exclude=document,permissions,target.selector',
+     [('exclude', 'document,permissions,target.selector')]),
+    ('fields=user,created,updated,text,tags',
+     [('fields', 'user,created,updated,text,tags')]),
+]
+
+
+def es_response(limit, fields, exclude):
+    """Return the JSON of an Elasticsearch response with `limit` hits."""
+    hits = []
+    for n in range(limit):
+        source = copy.deepcopy(ANNOTATION)
+        source.pop('id')
+        transform.prepare(source)
+        if fields or exclude:
+            # As Elasticsearch filters the source.
+            source = transform._project(source, frozenset(fields),
+                                        frozenset(exclude), '')
+        hits.append({'_index': 'annotator', '_type': 'annotation',
+                     '_id': '{}-{}'.format(ANNOTATION['id'], n),
+                     '_score': None, '_source': source,
+                     'sort': [1445949062341 - n]})
+    return json.dumps({'took': 3, 'timed_out': False,
+                       'hits': {'total': 1000, 'max_score': None,
+                                'hits': hits}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--limit', type=int, default=200,
+                        help='annotations in a page, as loaded by the sidebar '
+                             '(default: 200)')
+    parser.add_argument('--number', type=int, default=20,
+                        help='pages per timing run (default: 20)')
+    args = parser.parse_args()
+
+    print('{:<46} {:>9} {:>9} {:>9}'.format('page of {}'.format(args.limit),
+                                             'ES bytes', 'API bytes',
+                                             'ms/page'))
+    for name, params in PROJECTIONS:
+        fields, exclude = query.projection(MultiDict(params))
+        raw = es_response(args.limit, fields, exclude)
+
+        def respond():
+            results = json.loads(raw)
+            rows = [Annotation(d['_source'], id=d['_id'])
+                    for d in results['hits']['hits']]
+            return json.dumps({
+                'total': results['hits']['total'],
+                'rows': [transform.render(a, fields=fields, exclude=exclude)
+                         for a in rows],
+            })
+
+        elapsed = min(timeit.repeat(respond, number=args.number, repeat=3))
+        print('{:<46} {:>9} {:>9} {:>9.2f}'.format(
+            name, len(raw), len(respond()), elapsed * 1e3 / args.number))
+
+
+if __name__ == '__main__':
+    main()
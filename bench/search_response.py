@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the time the search API takes to respond with a page of annotations.
+
+The search view is called with ``limit`` set to the page size, and its result
+rendered as Pyramid's ``json`` renderer does, as it would be for a request,
+or its response body iterated over. Besides the time taken to respond, this
+reports the time taken to produce the first chunk of the body, and the size
+of the largest chunk, which is held in memory whole.
+
+Elasticsearch is replaced by a stub which decodes a prebuilt response for a
+page of typical annotations (see ``streamer_fanout.py``), as the
+Elasticsearch client does with the response it reads. The stub honours the
+query's source filtering.
+
+Usage::
+
+    python bench/search_response.py [--limit N] [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import timeit
+
+from mock import patch
+from pyramid import renderers
+from pyramid import testing
+from pyramid.response import Response
+from webob.multidict import MultiDict
+
+from h.api import views
+from h.api.search import transform
+
+from streamer_fanout import ANNOTATION
+
+
+def es_response(limit, source_filter):
+    """Return the JSON of an Elasticsearch response with `limit` hits."""
+    hits = []
+    for n in range(limit):
+        source = copy.deepcopy(ANNOTATION)
+        source.pop('id')
+        transform.prepare(source)
+        if source_filter:
+            source = transform._project(
+                source, frozenset(source_filter.get('include', ())),
+                frozenset(source_filter.get('exclude', ())), '')
+        hits.append({'_index': 'annotator', '_type': 'annotation',
+                     '_id': '{}-{}'.format(ANNOTATION['id'], n),
+                     '_score': None, '_source': source,
+                     'sort': [1445949062341 - n]})
+    return json.dumps({'took': 3, 'timed_out': False,
+                       'hits': {'total': 1000, 'max_score': None,
+                                'hits': hits}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--limit', type=int, default=200,
+                        help='annotations in a page (default: 200)')
+    parser.add_argument('--number', type=int, default=20,
+                        help='requests per timing run (default: 20)')
+    args = parser.parse_args()
+
+    config = testing.setUp(settings={})
+    responses = {}
+
+    def search_raw(body, **kwargs):
+        key = json.dumps(body.get('_source'), sort_keys=True)
+        if key not in responses:
+            responses[key] = es_response(args.limit, body.get('_source'))
+        return json.loads(responses[key])
+
+    def chunks():
+        """Return an iterator over the chunks of a search response's body."""
+        request = testing.DummyRequest(
+            params=MultiDict({'limit': str(args.limit)}))
+        request.feature = lambda name: False
+        result = views.search(request)
+        if isinstance(result, Response):
+            return iter(result.app_iter)
+        return iter([renderers.render('json', result, request=request)])
+
+    def respond():
+        return [chunk for chunk in chunks()]
+
+    def first_byte():
+        return next(chunks())
+
+    with patch('h.api.models.Annotation.search_raw', side_effect=search_raw):
+        body = respond()
+        elapsed = min(timeit.repeat(respond, number=args.number, repeat=5))
+        to_first = min(timeit.repeat(first_byte, number=args.number,
+                                     repeat=5))
+
+    print('limit={}: {:.2f} ms/request, {:.2f} ms to the first byte, '
+          '{} bytes in {} chunks, largest {} bytes'.format(
+              args.limit, elapsed * 1e3 / args.number,
+              to_first * 1e3 / args.number, sum(len(c) for c in body),
+              len(body), max(len(c) for c in body)))
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the bandwidth and CPU cost of fanning an annotation event out to many
+websockets, with and without permessage-deflate.
+
+For a typical annotation frame, this reports the bytes on the wire and the
+time taken to build the frames for every socket when the frame is sent
+uncompressed, compressed separately for each socket, and compressed once and
+shared between sockets (as :py:mod:`h.streamer.deflate` does).
+
+Usage::
+
+    python bench/streamer_fanout.py [--sockets N] [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import timeit
+
+from ws4py.framing import Frame, OPCODE_TEXT
+from ws4py.messaging import TextMessage
+
+from h.streamer import deflate
+from h.streamer.frames import _annotation_frame
+
+ANNOTATION = {
+    'id': 'AVBt1c8kbdH2vyizUY9T',
+    'created': '2015-10-27T12:31:02.341277+00:00',
+    'updated': '2015-10-27T12:31:02.341300+00:00',
+    'user': 'acct:giraffe@hypothes.is',
+    'uri': 'https://example.com/2015/10/27/arctic-sea-ice-report.html',
+    'text': (u'Global warming is changing the économie of the Arctic, and '
+             u'this report explains how the shrinking summer sea ice is '
+             u'opening new shipping routes. ') * 3,
+    'tags': [u'climate', u'arctic', u'science'],
+    'permissions': {
+        'read': ['group:__world__'],
+        'admin': ['acct:giraffe@hypothes.is'],
+        'update': ['acct:giraffe@hypothes.is'],
+        'delete': ['acct:giraffe@hypothes.is'],
+    },
+    'group': '__world__',
+    'target': [{
+        'source': 'https://example.com/2015/10/27/arctic-sea-ice-report.html',
+        'selector': [
+            {'type': 'RangeSelector',
+             'startContainer': '/div[1]/main[1]/article[1]/p[4]',
+             'startOffset': 0,
+             'endContainer': '/div[1]/main[1]/article[1]/p[4]',
+             'endOffset': 112},
+            {'type': 'TextPositionSelector', 'start': 2310, 'end': 2422},
+            {'type': 'TextQuoteSelector',
+             'exact': ('the Arctic has warmed at more than twice the rate '
+                       'of the global average over the past two decades'),
+             'prefix': 'Scientists now estimate that ',
+             'suffix': ', with the largest changes in'},
+        ],
+    }],
+    'document': {
+        'title': ['Arctic sea ice report: a record low summer'],
+        'link': [
+            {'href': 'https://example.com/2015/10/27/'
+                     'arctic-sea-ice-report.html'},
+            {'href': 'https://example.com/2015/10/27/'
+                     'arctic-sea-ice-report.html',
+             'rel': 'canonical'},
+            {'href': 'https://example.com/amp/2015/10/27/'
+                     'arctic-sea-ice-report.html',
+             'rel': 'amphtml'},
+        ],
+        'facebook': {
+            'title': ['Arctic sea ice report: a record low summer'],
+            'description': ['The shrinking summer sea ice is opening new '
+                            'shipping routes.'],
+            'url': ['https://example.com/2015/10/27/'
+                    'arctic-sea-ice-report.html'],
+            'image': ['https://example.com/images/arctic-sea-ice.jpg'],
+        },
+        'twitter': {
+            'card': ['summary_large_image'],
+            'site': ['@example'],
+        },
+    },
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sockets', type=int, default=100,
+                        help='sockets receiving each event (default: 100)')
+    parser.add_argument('--number', type=int, default=200,
+                        help='events per timing run (default: 200)')
+    args = parser.parse_args()
+
+    frame = _annotation_frame([json.dumps(ANNOTATION)], 'create')
+    sockets = range(args.sockets)
+
+    def uncompressed():
+        for _ in sockets:
+            TextMessage(frame).single()
+
+    def compressed_per_socket():
+        for _ in sockets:
+            Frame(opcode=OPCODE_TEXT, body=deflate.compress(frame), fin=1,
+                  rsv1=1).build()
+
+    def compressed_shared():
+        # A fresh copy of the payload, as for each new event.
+        payload = frame[:-1] + frame[-1]
+        for _ in sockets:
+            deflate.compressed_frame(payload)
+
+    raw_size = len(TextMessage(frame).single())
+    compressed_size = len(deflate.compressed_frame(frame))
+    print('frame size: {} bytes, {} bytes compressed ({:.0%})'.format(
+        raw_size, compressed_size, float(compressed_size) / raw_size))
+    print('fanout to {} sockets:'.format(args.sockets))
+
+    per_event = 1e6 / args.number
+    for name, func in [('uncompressed', uncompressed),
+                       ('compressed per socket', compressed_per_socket),
+                       ('compressed once, shared', compressed_shared)]:
+        elapsed = min(timeit.repeat(func, number=args.number, repeat=3))
+        print('  {:<26} {:>10.1f} us/event'.format(name, elapsed * per_event))
+
+
+if __name__ == '__main__':
+    main()
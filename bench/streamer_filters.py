@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the per-event cost of the streamer's filter matchers.
+
+Runs a set of realistic websocket filters (as sent by the sidebar, the stream
+page and the single annotation view) against a set of annotations, using both
+the interpreting :py:class:`h.streamer.filters.FilterHandler` and the
+precompiled :py:class:`h.streamer.filters.CompiledFilter`.
+
+Usage::
+
+    python bench/streamer_filters.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from h.streamer.filters import CompiledFilter
+from h.streamer.filters import FilterHandler
+
+ACTIONS = {'create': True, 'update': True, 'delete': True}
+
+FILTERS = {
+    'sidebar': {
+        'match_policy': 'include_any',
+        'actions': ACTIONS,
+        'clauses': [{
+            'field': '/uri',
+            'operator': 'one_of',
+            'value': ['http://example.com/article',
+                      'https://example.com/article',
+                      'http://example.com/article?print=1',
+                      'urn:x-pdf:c83fa94bd1d522276a32f81682a43d29'],
+        }],
+    },
+    'stream search': {
+        'match_policy': 'include_all',
+        'actions': ACTIONS,
+        'clauses': [
+            {'field': '/tags', 'operator': 'match_of',
+             'value': [u'climate', u'Économie']},
+            {'field': '/user', 'operator': 'matches', 'value': 'giraffe'},
+            {'field': ['/quote', '/tags', '/text', '/uri', '/user'],
+             'operator': 'matches', 'value': u'warming'},
+        ],
+    },
+    'annotation viewer': {
+        'match_policy': 'include_any',
+        'actions': ACTIONS,
+        'clauses': [
+            {'field': '/references', 'operator': 'first_of',
+             'value': 'AVBt1c8kbdH2vyizUY9T'},
+            {'field': '/id', 'operator': 'equals',
+             'value': 'AVBt1c8kbdH2vyizUY9T'},
+        ],
+    },
+}
+
+ANNOTATIONS = [
+    {
+        'id': 'AVBt1c8kbdH2vyizUY9T',
+        'uri': 'http://example.com/article',
+        'user': 'acct:giraffe@hypothes.is',
+        'text': (u'Global warming is changing the économie of the '
+                 u'Arctic. ') * 4,
+        'tags': [u'climate', u'arctic', u'science'],
+        'quote': u'the Arctic has warmed twice as fast as the global average',
+        'target': [{'source': 'http://example.com/article',
+                    'selector': [{'type': 'TextQuoteSelector',
+                                  'exact': 'the Arctic has warmed'}]}],
+    },
+    {
+        'id': 'AVBt2Xh3bdH2vyizUY9U',
+        'uri': 'http://example.org/other',
+        'user': 'acct:pigeon@hypothes.is',
+        'text': u'An unrelated reply.',
+        'tags': [],
+        'references': ['AVBt1c8kbdH2vyizUY9T'],
+    },
+]
+
+
+def run(matcher_cls, filter_json, number):
+    matcher = matcher_cls(filter_json)
+
+    def check():
+        for annotation in ANNOTATIONS:
+            matcher.match(annotation, 'create')
+
+    return min(timeit.repeat(check, number=number, repeat=3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=10000,
+                        help='iterations per timing run (default: 10000)')
+    args = parser.parse_args()
+
+    per_call = 1e6 / (args.number * len(ANNOTATIONS))
+    print('{:<20} {:>16} {:>16} {:>8}'.format(
+        'filter', 'FilterHandler', 'CompiledFilter', 'speedup'))
+    for name, filter_json in sorted(FILTERS.items()):
+        handler = run(FilterHandler, filter_json, args.number)
+        compiled = run(CompiledFilter, filter_json, args.number)
+        print('{:<20} {:>13.2f} us {:>13.2f} us {:>7.1f}x'.format(
+            name, handler * per_call, compiled * per_call,
+            handler / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the cost of encoding and decoding streamer messages as JSON and as
+msgpack.
+
+For a typical annotation (see ``streamer_fanout.py``) this reports the size
+of each message and the time taken to:
+
+- encode a notification of a single annotation event, as the streamer does
+  for each event it broadcasts: for JSON, by splicing the annotation's JSON
+  into a prebuilt envelope, and for msgpack, by encoding the (already
+  decoded) annotation and copying it into a packet,
+- encode a page of past annotations, as sent in reply to a ``past`` message,
+- decode either of these, as a client does, and
+- decode a ``filter`` message with its list of document URIs, as the
+  streamer does for each client.
+
+Requires msgpack (``pip install h[msgpack]``).
+
+Usage::
+
+    python bench/streamer_msgpack.py [--number N] [--page N]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import timeit
+
+from h.streamer import subprotocol
+from h.streamer.frames import _annotation_frame, _annotation_packet
+
+from streamer_fanout import ANNOTATION
+
+FILTER_MESSAGE = {
+    'messageType': 'filter',
+    'filter': {
+        'match_policy': 'include_any',
+        'actions': {'create': True, 'update': True, 'delete': True},
+        'clauses': [{
+            'field': '/uri',
+            'operator': 'one_of',
+            'value': [
+                'https://example.com/2015/10/27/arctic-sea-ice-report.html',
+                'https://example.com/amp/2015/10/27/'
+                'arctic-sea-ice-report.html',
+                'https://example.com/2015/10/27/arctic-sea-ice-report.html'
+                '?utm_source=twitter',
+                'urn:x-pdf:4a0b3ee6ab0b4d5e9ac3a26a83a66b4e',
+            ],
+            'case_sensitive': False,
+        }],
+    },
+}
+
+
+def _time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) * 1e6 / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='operations per timing run (default: 2000)')
+    parser.add_argument('--page', type=int, default=20,
+                        help='annotations in a page of past annotations '
+                             '(default: 20)')
+    args = parser.parse_args()
+
+    if not subprotocol.available():
+        parser.error('msgpack is not installed')
+
+    # Annotations as they arrive from NSQ: decoded, with their JSON alongside.
+    annotation = json.loads(json.dumps(ANNOTATION))
+    raw = json.dumps(annotation)
+    page = [dict(annotation, id='{}-{}'.format(annotation['id'], n))
+            for n in range(args.page)]
+    page_packet = _annotation_packet(page, 'past')
+
+    def json_event():
+        return _annotation_frame([raw], 'create', '1:2')
+
+    def msgpack_event():
+        return subprotocol.annotation_frame([subprotocol.packb(annotation)],
+                                            'create', '1:2')
+
+    def json_page():
+        return json.dumps(page_packet)
+
+    def msgpack_page():
+        return subprotocol.packb(page_packet)
+
+    filter_json = json.dumps(FILTER_MESSAGE)
+    filter_msgpack = subprotocol.packb(FILTER_MESSAGE)
+
+    rows = [
+        ('encode event', json_event, msgpack_event),
+        ('encode page of {}'.format(args.page), json_page, msgpack_page),
+        ('decode event',
+         lambda data=json_event(): json.loads(data),
+         lambda data=msgpack_event(): subprotocol.unpackb(data)),
+        ('decode page of {}'.format(args.page),
+         lambda data=json_page(): json.loads(data),
+         lambda data=msgpack_page(): subprotocol.unpackb(data)),
+        ('decode filter',
+         lambda: json.loads(filter_json),
+         lambda: subprotocol.unpackb(filter_msgpack)),
+    ]
+
+    print('{:<20} {:>10} {:>10} {:>8}'.format('bytes', 'json', 'msgpack',
+                                              'ratio'))
+    for name, data_json, data_msgpack in [
+            ('event', json_event(), msgpack_event()),
+            ('page of {}'.format(args.page), json_page(), msgpack_page()),
+            ('filter', filter_json, filter_msgpack)]:
+        print('{:<20} {:>10} {:>10} {:>8.2f}'.format(
+            name, len(data_json), len(data_msgpack),
+            float(len(data_msgpack)) / len(data_json)))
+
+    print()
+    print('{:<20} {:>10} {:>10} {:>8}'.format('us/op', 'json', 'msgpack',
+                                              'ratio'))
+    for name, json_func, msgpack_func in rows:
+        json_us = _time(json_func, args.number)
+        msgpack_us = _time(msgpack_func, args.number)
+        print('{:<20} {:>10.1f} {:>10.1f} {:>8.2f}'.format(
+            name, json_us, msgpack_us, msgpack_us / json_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the memory held by idle websockets.
+
+Opens a number of streamer websockets over fake connections, each from a
+request resembling a browser's websocket handshake, and reports the growth of
+the process's resident memory per socket. With ``--keep-request`` each socket
+holds on to its request and environ, as the streamer used to; otherwise only
+the :py:class:`h.streamer.sockets.SocketState` snapshot is kept.
+
+Only the request, its environ and its parsed headers and cookies are modelled
+here. In production a request also carries a session and a database session,
+so the saving is larger than reported.
+
+Usage::
+
+    python bench/streamer_sockets.py [--sockets N] [--keep-request]
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import resource
+
+from mock import patch
+from pyramid import testing
+from pyramid.request import Request
+
+from h.streamer.sockets import WebSocket
+
+HEADERS = {
+    'Host': 'hypothes.is',
+    'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64; rv:41.0) Gecko/20100101 '
+                   'Firefox/41.0'),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*',
+    'Accept-Language': 'en-GB,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Origin': 'https://hypothes.is',
+    'Sec-WebSocket-Version': '13',
+    'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+    'Sec-WebSocket-Extensions': 'permessage-deflate',
+    'Connection': 'keep-alive, Upgrade',
+    'Upgrade': 'websocket',
+    'Cookie': 'session=' + 'x' * 300 + '; _ga=GA1.2.1234567890.1445000000',
+}
+
+
+class FakeConnection(object):
+    def sendall(self, data):
+        pass
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def open_socket(registry, n, keep_request):
+    request = Request.blank('/ws', headers=HEADERS)
+    request.registry = registry
+    request.environ['REMOTE_ADDR'] = '10.0.{}.{}'.format(n // 256, n % 256)
+    request.cookies  # parsed on every request, by the session machinery
+    request.feature = lambda name: False
+    request.tm = testing.DummyResource(commit=lambda: None)
+
+    with patch('h.streamer.sockets.get_current_request', return_value=request):
+        socket = WebSocket(FakeConnection(), environ=request.environ,
+                           heartbeat_freq=None)
+    socket.opened()
+    if keep_request:
+        socket.request = request
+        socket.environ = request.environ
+    return socket
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sockets', type=int, default=10000,
+                        help='sockets to open (default: 10000)')
+    parser.add_argument('--keep-request', action='store_true',
+                        help='keep each request alive, as before')
+    args = parser.parse_args()
+
+    config = testing.setUp(settings={})
+    config.testing_securitypolicy(userid='acct:giraffe@hypothes.is',
+                                  groupids=['group:__world__'])
+
+    sockets = []
+    gc.collect()
+    before = rss()
+    for n in range(args.sockets):
+        sockets.append(open_socket(config.registry, n, args.keep_request))
+    gc.collect()
+    after = rss()
+
+    for socket in sockets:
+        socket.closed(1000)
+
+    print('{} idle sockets ({}): {:.1f} MB, {:.0f} bytes per socket'.format(
+        args.sockets,
+        'keeping requests' if args.keep_request else 'socket state only',
+        (after - before) / 1e6,
+        float(after - before) / args.sockets))
+
+
+if __name__ == '__main__':
+    main()
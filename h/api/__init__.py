@@ -11,4 +11,5 @@ def includeme(config):
     config.include('h.features')
     config.include('h.api.db')
     config.include('h.api.queue')
+    config.include('h.api.search.cache')
     config.include('h.api.views')
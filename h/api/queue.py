@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 """Publish annotations events into the distributed message queue."""
 import json
+import zlib
 
+from h.api import uri
 from h.api.events import AnnotationEvent
 
 
@@ -21,7 +23,45 @@ def annotation(event):
         'annotation': annotation,
         'src_client_id': request.headers.get('X-Client-Id'),
     }
-    queue.publish('annotations', json.dumps(data))
+    body = json.dumps(data)
+    queue.publish('annotations', body)
+
+    # No streamer sends read events to its clients, so they are not worth
+    # expanding the annotation's URI for.
+    if action == 'read':
+        return
+
+    # When the streamer is sharded, each shard only reads the events for the
+    # documents its clients may be watching.
+    shards = int(request.registry.settings.get('h.streamer.shards', 1))
+    if shards > 1:
+        for shard in sorted(shards_for_annotation(annotation, shards)):
+            queue.publish(shard_topic(shard), body)
+
+
+def shard_topic(shard):
+    """Return the name of the topic carrying the events for a shard."""
+    return 'annotations-shard-{}'.format(shard)
+
+
+def shard_for_uri(uristr, shards):
+    """Return the shard responsible for clients watching the passed URI."""
+    normalized = uri.normalize(uristr)
+    return (zlib.crc32(normalized) & 0xffffffff) % shards
+
+
+def shards_for_annotation(annotation, shards):
+    """
+    Return the set of shards whose clients may be watching the document the
+    passed annotation belongs to.
+
+    Clients subscribe to every URI of the document they are viewing, so the
+    event is needed by the shard of each of those URIs.
+    """
+    uristr = annotation.get('uri')
+    if not uristr:
+        return set()
+    return set(shard_for_uri(u, shards) for u in uri.expand(uristr))
 
 
 def includeme(config):
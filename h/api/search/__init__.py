@@ -2,12 +2,14 @@
 
 from h.api.search.core import index
 from h.api.search.core import search
+from h.api.search.query import projection
 from h.api.search.transform import prepare
 from h.api.search.transform import render
 
 __all__ = (
     'index',
     'prepare',
+    'projection',
     'render',
     'search',
 )
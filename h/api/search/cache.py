@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+A cache of search results for the annotations on a URI.
+
+The sidebar searches for the annotations on the page it is shown on, so a
+popular page is searched for with the same parameters, by callers with the
+same principals, over and over. Those searches are answered from the cache.
+
+Only searches with a ``uri`` parameter are cached. Each entry is tagged with
+the normalized URIs searched for, including the equivalent URIs the search
+expanded them to, and removed when an annotation on any of them is created,
+updated or deleted in this process. Changes made by other processes are not
+seen until entries expire after ``ttl`` seconds, so the cache is disabled
+unless ``h.search.cache.ttl`` is set.
+"""
+
+import collections
+import logging
+import time
+
+import statsd
+
+from h.api import uri
+from h.api.events import AnnotationEvent
+
+log = logging.getLogger(__name__)
+
+
+class SearchCache(object):
+    """
+    A bounded, expiring cache of search results, invalidated by tag.
+
+    Invalidating a tag while a search is running means the search's results
+    may already be out of date, so they are not stored: :py:meth:`set` is
+    passed the :py:attr:`generation` read before the search started.
+    """
+
+    def __init__(self, ttl=10.0, maxsize=1000, clock=time.time, stats=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.stats = stats
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._keys_by_tag = collections.defaultdict(set)
+        self._invalidated = collections.OrderedDict()
+        self._forgotten = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value for the key, or None."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._count('miss')
+            return None
+        self.hits += 1
+        self._count('hit')
+        return entry[1]
+
+    def set(self, key, value, tags, generation):
+        """
+        Store a value, tagged with the passed tags, unless any of them has
+        been invalidated since `generation`.
+        """
+        if generation < self._forgotten:
+            return
+        for tag in tags:
+            if self._invalidated.get(tag, 0) > generation:
+                return
+        self._remove(key)
+        self._entries[key] = (self.clock() + self.ttl, value, tags)
+        for tag in tags:
+            self._keys_by_tag[tag].add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        """Remove the entries with any of the passed tags."""
+        self.generation += 1
+        for tag in tags:
+            self._invalidated.pop(tag, None)
+            self._invalidated[tag] = self.generation
+            for key in list(self._keys_by_tag.get(tag, ())):
+                self._remove(key)
+        # Remember only recent invalidations. Searches which started before
+        # the last one forgotten are not stored.
+        while len(self._invalidated) > self.maxsize:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.increment(name)
+
+
+def cache_key(request_params, principals, search_normalized_uris=False):
+    """
+    Return the key under which the results of a search are cached, or None if
+    the search is not to be cached.
+
+    The key is made of the search parameters in a canonical order, the
+    search mode and the caller's effective principals, which decide which
+    annotations the caller may see.
+    """
+    if 'uri' not in request_params:
+        return None
+    params = tuple(sorted(request_params.items()))
+    return (params, bool(search_normalized_uris), frozenset(principals or ()))
+
+
+def search_tags(request_params, uris=()):
+    """
+    Return the tags for the results of a search for a URI: the normalized
+    URIs searched for, and those the search expanded them to (see
+    :py:func:`h.api.search.query.build`).
+    """
+    uristrs = set(uris)
+    uristrs.update(request_params.getall('uri'))
+    return frozenset(uri.normalize(u) for u in uristrs)
+
+
+def annotation_tags(annotation):
+    """
+    Return the tags of the cached searches which may include the passed
+    annotation: the normalized URIs of the annotation, its targets and the
+    links of its document.
+
+    Searches are tagged with the URIs equivalent to those searched for, so
+    these need not be expanded.
+    """
+    uris = set()
+    uristr = annotation.get('uri')
+    if isinstance(uristr, basestring) and uristr:
+        uris.add(uristr)
+    targets = annotation.get('target')
+    if isinstance(targets, list):
+        for target in targets:
+            if isinstance(target, dict) and \
+                    isinstance(target.get('source'), basestring):
+                uris.add(target['source'])
+    document = annotation.get('document')
+    links = document.get('link') if isinstance(document, dict) else None
+    if isinstance(links, list):
+        for link in links:
+            if isinstance(link, dict) and \
+                    isinstance(link.get('href'), basestring):
+                uris.add(link['href'])
+    return set(uri.normalize(u) for u in uris)
+
+
+def invalidate(event):
+    """Remove the cached searches affected by an annotation event."""
+    cache = getattr(event.request.registry, 'search_cache', None)
+    if cache is None or event.action == 'read':
+        return
+    cache.invalidate(annotation_tags(event.annotation))
+
+
+def includeme(config):
+    settings = config.registry.settings
+    ttl = float(settings.get('h.search.cache.ttl', 0))
+    if ttl <= 0:
+        config.registry.search_cache = None
+        return
+    conn = statsd.Connection(host=settings.get('statsd.host'),
+                             port=settings.get('statsd.port'))
+    config.registry.search_cache = SearchCache(
+        ttl=ttl,
+        maxsize=int(settings.get('h.search.cache.size', 1000)),
+        stats=statsd.Counter('h.api.search.cache', connection=conn))
+    config.add_subscriber(invalidate, AnnotationEvent)
@@ -5,12 +5,14 @@ import logging
 import webob.multidict
 
 from h.api import models
+from h.api.search import cache as search_cache
 from h.api.search import query
 
 log = logging.getLogger(__name__)
 
 
-def search(request_params, user=None, search_normalized_uris=False):
+def search(request_params, user=None, search_normalized_uris=False,
+           cache=None, principals=None):
     """
     Search with the given params and return the matching annotations.
 
@@ -25,24 +27,67 @@ def search(request_params, user=None, search_normalized_uris=False):
         search against pre-normalized URI fields.
     :type search_normalized_uris: bool
 
+    :param cache: the cache to look the results up in, and store them in, if
+        the search is cacheable (optional, default: None)
+    :type cache: h.api.search.cache.SearchCache or None
+
+    :param principals: the effective principals of the caller, which are
+        part of the cache key
+    :type principals: list of unicode or None
+
     :returns: a dict with keys "rows" (the list of matching annotations, as
-        dicts) and "total" (the number of matching annotations, an int)
+        dicts, without the fields which are only indexed), "total" (the
+        number of matching annotations, an int) and "next" (the cursor for the
+        next page of results, or None). With a "cursor" param, "total" only
+        counts the annotations from the cursor on. Results from the cache are
+        shared, and must not be modified.
     :rtype: dict
+
+    :raises ValueError: if the params are invalid (see
+        :py:func:`h.api.search.query.build`)
     """
+    key = None
+    if cache is not None:
+        key = search_cache.cache_key(request_params, principals,
+                                     search_normalized_uris)
+    if key is not None:
+        results = cache.get(key)
+        if results is not None:
+            return results
+        generation = cache.generation
+
     userid = user.id if user else None
     log.debug("Searching with user=%s, for uri=%s",
               str(userid), request_params.get('uri'))
 
+    uris = set()
     body = query.build(request_params,
                        userid=userid,
-                       search_normalized_uris=search_normalized_uris)
+                       search_normalized_uris=search_normalized_uris,
+                       uris=uris)
     results = models.Annotation.search_raw(body, user=user, raw_result=True)
 
     total = results['hits']['total']
     docs = results['hits']['hits']
-    rows = [models.Annotation(d['_source'], id=d['_id']) for d in docs]
+    rows = [_row(d) for d in docs]
+    results = {
+        "rows": rows,
+        "total": total,
+        "next": query.next_cursor(body, docs, request_params.get("cursor")),
+    }
+
+    if key is not None:
+        cache.set(key, results, search_cache.search_tags(request_params, uris),
+                  generation)
+
+    return results
+
 
-    return {"rows": rows, "total": total}
+def _row(hit):
+    """Return the annotation for a hit, reusing its decoded source."""
+    source = hit['_source']
+    source['id'] = hit['_id']
+    return source
 
 
 def index(user=None, search_normalized_uris=False):
@@ -1,8 +1,25 @@
+import base64
+import json
+
 from h.api import uri
 from h.api import nipsa
 
+# Fields which are added to annotations for indexing (see
+# h.api.search.transform.prepare), and are never returned.
+INDEX_ONLY_FIELDS = ["target.source_normalized"]
+
+# Every shard collects and sorts offset + limit hits to serve a page, so
+# deeper pages must be fetched with the cursor returned with each page.
+OFFSET_MAX = 5000
+
+# The sort fields for which cursors are issued. A cursor lists the hits
+# already returned with the last page's sort value, which for these
+# timestamps is rarely more than one.
+CURSOR_SORTS = ("updated", "created")
 
-def build(request_params, userid=None, search_normalized_uris=False):
+
+def build(request_params, userid=None, search_normalized_uris=False,
+          uris=None):
     """
     Return an Elasticsearch query dict for the given h search API params.
 
@@ -20,9 +37,17 @@ def build(request_params, userid=None, search_normalized_uris=False):
         search against pre-normalized URI fields.
     :type search_normalized_uris: bool
 
+    :param uris: a set to add the URIs the "uri" param was expanded to
+        (optional, default: None)
+    :type uris: set or None
+
     :returns: an Elasticsearch query dict corresponding to the given h search
         API params
     :rtype: dict
+
+    :raises ValueError: if the "offset" param exceeds :py:data:`OFFSET_MAX`,
+        or the "cursor", "fields" or "exclude" params are invalid, or a
+        cursor is passed with a sort field not in :py:data:`CURSOR_SORTS`
     """
     # NestedMultiDict objects are read-only, so we need to copy to make it
     # modifiable.
@@ -34,6 +59,9 @@ def build(request_params, userid=None, search_normalized_uris=False):
             raise ValueError
     except (ValueError, KeyError):
         from_ = 0
+    if from_ > OFFSET_MAX:
+        raise ValueError('offset may not exceed {}: page through results with '
+                         'the "next" cursor instead'.format(OFFSET_MAX))
 
     try:
         size = int(request_params.pop("limit"))
@@ -42,23 +70,40 @@ def build(request_params, userid=None, search_normalized_uris=False):
     except (ValueError, KeyError):
         size = 20
 
+    sort_field = request_params.pop("sort", "updated")
+    order = request_params.pop("order", "desc")
     sort = [{
-        request_params.pop("sort", "updated"): {
+        sort_field: {
             "ignore_unmapped": True,
-            "order": request_params.pop("order", "desc")
+            "order": order
         }
     }]
 
+    # The fields to return are not matched against.
+    fields, exclude = projection(request_params)
+    for name in ("fields", "exclude"):
+        if name in request_params:
+            del request_params[name]
+
     filters = []
     matches = []
 
+    # A cursor picks up where the previous page left off, in place of an
+    # offset.
+    cursor = request_params.pop("cursor", None)
+    if cursor is not None:
+        from_ = 0
+        filters.append(_cursor_filter(cursor, sort_field, order))
+
     uri_param = request_params.pop("uri", None)
-    if uri_param is None:
-        pass
-    elif search_normalized_uris:
-        filters.append(_term_clause_for_uri(uri_param))
-    else:
-        matches.append(_match_clause_for_uri(uri_param))
+    if uri_param is not None:
+        uristrs = uri.expand(uri_param)
+        if uris is not None:
+            uris.update(uristrs)
+        if search_normalized_uris:
+            filters.append(_term_clause_for_uri(uristrs))
+        else:
+            matches.append(_match_clause_for_uri(uristrs))
 
     if "any" in request_params:
         matches.append({
@@ -89,17 +134,146 @@ def build(request_params, userid=None, search_normalized_uris=False):
             }
         }
 
-    return {
+    body = {
         "from": from_,
         "size": size,
         "sort": sort,
         "query": query,
     }
 
+    # Elasticsearch leaves out the fields which are only indexed, so the
+    # annotations it returns need no rendering.
+    body["_source"] = {"exclude": exclude + INDEX_ONLY_FIELDS}
+    if fields:
+        body["_source"]["include"] = fields
+
+    return body
+
+
+def projection(request_params):
+    """
+    Return the fields to return, and to leave out of, the annotations for the
+    given h search API params.
+
+    Fields are named by their dotted paths (for example "document.title"), in
+    the "fields" and "exclude" params, which may be repeated or hold a
+    comma-separated list.
+
+    :returns: a tuple of the lists of fields to include and to exclude,
+        either of which may be empty
+    :rtype: tuple
+
+    :raises ValueError: if a field name contains a wildcard, which
+        :py:func:`h.api.search.transform.render` does not support
+    """
+    return (_field_list(request_params, "fields"),
+            _field_list(request_params, "exclude"))
+
+
+def _field_list(request_params, name):
+    fields = []
+    for value in request_params.getall(name):
+        fields.extend(f.strip() for f in value.split(",") if f.strip())
+    for field in fields:
+        if "*" in field:
+            raise ValueError("invalid field name: {!r}".format(field))
+    return fields
+
+
+def next_cursor(body, hits, cursor=None):
+    """
+    Return the cursor for the page of results following the passed hits, or
+    None if they were the last page, or were not sorted by one of
+    :py:data:`CURSOR_SORTS`.
+
+    :param body: the Elasticsearch query dict which returned the hits, such
+        as one returned by :py:func:`build`
+    :param hits: the hits returned
+    :param cursor: the cursor the hits were fetched with, if any
+
+    The cursor records the sort value of the last hit, and the ids of the
+    hits with that value which have been returned, so that hits with equal
+    sort values are neither skipped nor repeated.
+    """
+    count = len(hits)
+    if count == 0 or count < body["size"]:
+        return None
+    [(field, options)] = body["sort"][0].items()
+    if field not in CURSOR_SORTS:
+        return None
+    value = _sort_value(hits[-1])
+    if value is None:
+        return None
+    seen = [h["_id"] for h in hits if _sort_value(h) == value]
+    if cursor is not None:
+        previous_value, previous_seen = _decode_cursor(cursor, field,
+                                                       options["order"])
+        if previous_value == value:
+            seen = previous_seen + seen
+    data = json.dumps({"sort": field, "order": options["order"],
+                       "value": value, "seen": seen})
+    return base64.urlsafe_b64encode(data)
+
+
+def _sort_value(hit):
+    values = hit.get("sort")
+    if not values:
+        return None
+    return values[0]
+
+
+def _decode_cursor(cursor, field, order):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        value = data["value"]
+        seen = data["seen"]
+        valid = (isinstance(seen, list) and
+                 isinstance(value, (basestring, int, long, float)))
+    except (TypeError, ValueError, KeyError):
+        valid = False
+    if not valid:
+        raise ValueError("invalid cursor: {!r}".format(cursor))
+    if data.get("sort") != field or data.get("order") != order:
+        raise ValueError("cursor does not match the sort order")
+    return value, seen
+
+
+def after_cursor(body, cursor):
+    """
+    Return a copy of the passed Elasticsearch query dict, restricted to the
+    hits following the passed cursor (see :py:func:`next_cursor`).
+
+    This lets other queries than those returned by :py:func:`build`, sorted
+    by one of :py:data:`CURSOR_SORTS`, be paged through with the same
+    cursors.
+
+    :raises ValueError: if the cursor is invalid, or was not returned for a
+        query with the same sort order
+    """
+    [(field, options)] = body["sort"][0].items()
+    page_filter = _cursor_filter(cursor, field, options["order"])
+    return dict(body, **{
+        "from": 0,
+        "query": {"filtered": {"filter": page_filter,
+                               "query": body["query"]}},
+    })
+
+
+def _cursor_filter(cursor, field, order):
+    """Return an Elasticsearch filter for the hits following a cursor."""
+    if field not in CURSOR_SORTS:
+        raise ValueError("cursors can only be used when sorting by "
+                         "{}".format(" or ".join(CURSOR_SORTS)))
+    value, seen = _decode_cursor(cursor, field, order)
+    bound = "gte" if order == "asc" else "lte"
+    page_filter = {"bool": {"must": [{"range": {field: {bound: value}}}]}}
+    if seen:
+        page_filter["bool"]["must_not"] = [{"ids": {"values": seen}}]
+    return page_filter
+
 
-def _match_clause_for_uri(uristr):
-    """Return an Elasticsearch match clause dict for the given URI."""
-    uristrs = uri.expand(uristr)
+def _match_clause_for_uri(uristrs):
+    """Return an Elasticsearch match clause dict for the given URIs."""
     matchers = [{"match": {"uri": u}} for u in uristrs]
 
     if len(matchers) == 1:
@@ -112,9 +286,8 @@ def _match_clause_for_uri(uristr):
     }
 
 
-def _term_clause_for_uri(uristr):
-    """Return an Elasticsearch term clause for the given URI."""
-    uristrs = uri.expand(uristr)
+def _term_clause_for_uri(uristrs):
+    """Return an Elasticsearch term clause for the given URIs."""
     filters = [{"term": {"target.source_normalized": uri.normalize(u)}}
                for u in uristrs]
 
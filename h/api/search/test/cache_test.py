@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from pyramid import testing
+from webob import multidict
+
+from h.api.events import AnnotationEvent
+from h.api.search import cache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _params(**kwargs):
+    return multidict.NestedMultiDict(multidict.MultiDict(kwargs))
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def search_cache(clock):
+    return cache.SearchCache(ttl=10, maxsize=3, clock=clock)
+
+
+def test_get_returns_stored_value(search_cache):
+    search_cache.set('a', {'total': 1}, {'x'}, search_cache.generation)
+    assert search_cache.get('a') == {'total': 1}
+    assert (search_cache.hits, search_cache.misses) == (1, 0)
+
+
+def test_get_counts_misses(search_cache):
+    assert search_cache.get('a') is None
+    assert (search_cache.hits, search_cache.misses) == (0, 1)
+
+
+def test_get_reports_hits_and_misses(search_cache):
+    search_cache.stats = mock.Mock()
+    search_cache.get('a')
+    search_cache.set('a', {}, {'x'}, search_cache.generation)
+    search_cache.get('a')
+    assert search_cache.stats.increment.call_args_list == [
+        mock.call('miss'), mock.call('hit')]
+
+
+def test_entries_expire(search_cache, clock):
+    search_cache.set('a', {}, {'x'}, search_cache.generation)
+    clock.now += 10
+    assert search_cache.get('a') is None
+    assert len(search_cache) == 0
+
+
+def test_evicts_oldest_entries(search_cache):
+    for key in 'abcd':
+        search_cache.set(key, {}, {key}, search_cache.generation)
+    assert len(search_cache) == 3
+    assert search_cache.get('a') is None
+    assert search_cache.get('d') == {}
+
+
+def test_invalidate_removes_tagged_entries(search_cache):
+    search_cache.set('a', {}, {'x', 'y'}, search_cache.generation)
+    search_cache.set('b', {}, {'z'}, search_cache.generation)
+    search_cache.invalidate({'y'})
+    assert search_cache.get('a') is None
+    assert search_cache.get('b') == {}
+
+
+def test_set_ignores_results_invalidated_during_search(search_cache):
+    generation = search_cache.generation
+    search_cache.invalidate({'x'})
+    search_cache.set('a', {}, {'x'}, generation)
+    search_cache.set('b', {}, {'y'}, generation)
+    assert search_cache.get('a') is None
+    assert search_cache.get('b') == {}
+
+
+def test_set_ignores_results_when_invalidation_forgotten(search_cache):
+    generation = search_cache.generation
+    search_cache.invalidate({'w', 'x', 'y', 'z'})
+    search_cache.set('a', {}, {'w'}, generation)
+    assert search_cache.get('a') is None
+
+
+def test_cache_key_is_canonical():
+    principals = ['system.Everyone', 'acct:a@b']
+    key = cache.cache_key(_params(uri='http://a', limit='20'), principals)
+    other = cache.cache_key(_params(limit='20', uri='http://a'),
+                            list(reversed(principals)))
+    assert key == other
+
+
+def test_cache_key_differs_by_principals_and_mode():
+    params = _params(uri='http://a')
+    key = cache.cache_key(params, ['system.Everyone'])
+    assert key != cache.cache_key(params, ['system.Everyone', 'acct:a@b'])
+    assert key != cache.cache_key(params, ['system.Everyone'], True)
+
+
+def test_cache_key_is_none_without_uri():
+    assert cache.cache_key(_params(user='acct:a@b'), []) is None
+
+
+def test_search_tags_include_expanded_uris():
+    tags = cache.search_tags(_params(uri='http://example.com/a'),
+                             ['http://example.com/a', 'http://example.com/b'])
+    assert tags == {'http://example.com/a', 'http://example.com/b'}
+
+
+@mock.patch('h.api.uri.expand')
+def test_annotation_tags_are_the_annotations_uris(expand):
+    tags = cache.annotation_tags({
+        'uri': 'http://example.com/a',
+        'target': [{'source': 'http://example.com/c'}, 'foo'],
+        'document': {'link': [{'href': 'http://example.com/d'}, 'bar']},
+    })
+    assert tags == {'http://example.com/a', 'http://example.com/c',
+                    'http://example.com/d'}
+    assert not expand.called
+
+
+def test_invalidate_on_annotation_event(search_cache):
+    request = testing.DummyRequest()
+    request.registry.search_cache = search_cache
+    tags = cache.search_tags(_params(uri='http://example.com/b'),
+                             ['http://example.com/a', 'http://example.com/b'])
+    search_cache.set('a', {}, tags, search_cache.generation)
+
+    cache.invalidate(AnnotationEvent(request,
+                                     {'uri': 'http://example.com/a'},
+                                     'create'))
+
+    assert search_cache.get('a') is None
+
+
+def test_read_events_do_not_invalidate(search_cache):
+    request = testing.DummyRequest()
+    request.registry.search_cache = search_cache
+    search_cache.set('a', {}, {'http://example.com/a'}, 0)
+
+    cache.invalidate(AnnotationEvent(request,
+                                     {'uri': 'http://example.com/a'},
+                                     'read'))
+
+    assert search_cache.get('a') == {}
+
+
+def test_includeme_configures_cache(config):
+    config.registry.settings.update({'h.search.cache.ttl': '30',
+                                     'h.search.cache.size': '50'})
+    config.include('h.api.search.cache')
+    assert config.registry.search_cache.ttl == 30
+    assert config.registry.search_cache.maxsize == 50
+
+
+def test_includeme_can_disable_cache(config):
+    config.registry.settings.update({'h.search.cache.ttl': '0'})
+    config.include('h.api.search.cache')
+    assert config.registry.search_cache is None
+
+
+def test_includeme_disables_cache_by_default(config):
+    config.include('h.api.search.cache')
+    assert config.registry.search_cache is None
@@ -3,6 +3,7 @@
 import mock
 from webob import multidict
 
+from h.api.search import cache
 from h.api.search import core
 
 
@@ -41,6 +42,18 @@ def test_search_does_pass_userid_to_build(build, _):
     assert build.call_args[1]["userid"] == "test_id"
 
 
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_search_returns_sources_with_ids(search_raw):
+    source = {"text": "giraffe"}
+    search_raw.return_value = {
+        "hits": {"total": 1, "hits": [{"_id": "abc", "_source": source}]}}
+
+    results = core.search(multidict.NestedMultiDict())
+
+    assert results["rows"] == [{"id": "abc", "text": "giraffe"}]
+    assert results["rows"][0] is source
+
+
 @mock.patch("h.api.search.core.search")
 def test_index_limit_is_20(search_func):
     """index() calls search with "limit": 20."""
@@ -48,3 +61,60 @@ def test_index_limit_is_20(search_func):
 
     first_call = search_func.call_args_list[0]
     assert first_call[0][0]["limit"] == 20
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+@mock.patch("h.api.search.query.build")
+def test_search_stores_results_in_cache(_, search_raw):
+    search_raw.return_value = {'hits': {'total': 0, 'hits': []}}
+    search_cache = cache.SearchCache()
+    params = multidict.MultiDict({'uri': 'http://example.com'})
+
+    first = core.search(params, cache=search_cache, principals=['a'])
+    second = core.search(params, cache=search_cache, principals=['a'])
+
+    assert search_raw.call_count == 1
+    assert second is first
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+@mock.patch("h.api.search.query.build")
+def test_search_does_not_share_results_between_principals(_, search_raw):
+    search_raw.return_value = {'hits': {'total': 0, 'hits': []}}
+    search_cache = cache.SearchCache()
+    params = multidict.MultiDict({'uri': 'http://example.com'})
+
+    core.search(params, cache=search_cache, principals=['a'])
+    core.search(params, cache=search_cache, principals=['a', 'b'])
+
+    assert search_raw.call_count == 2
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+@mock.patch("h.api.search.query.build")
+def test_search_does_not_cache_searches_without_uri(_, search_raw):
+    search_raw.return_value = {'hits': {'total': 0, 'hits': []}}
+    search_cache = cache.SearchCache()
+
+    core.search(multidict.NestedMultiDict(), cache=search_cache)
+    core.search(multidict.NestedMultiDict(), cache=search_cache)
+
+    assert search_raw.call_count == 2
+    assert len(search_cache) == 0
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+@mock.patch("h.api.search.query.build")
+def test_search_tags_cached_results_with_expanded_uris(build, search_raw):
+    def fake_build(request_params, uris, **kwargs):
+        uris.update(['http://example.com/a', 'http://example.com/b'])
+        return {}
+    build.side_effect = fake_build
+    search_raw.return_value = {'hits': {'total': 0, 'hits': []}}
+    search_cache = cache.SearchCache()
+    params = multidict.MultiDict({'uri': 'http://example.com/a'})
+
+    core.search(params, cache=search_cache, principals=['a'])
+    search_cache.invalidate({'http://example.com/b'})
+
+    assert len(search_cache) == 0
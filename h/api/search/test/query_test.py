@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import mock
+import pytest
 from webob import multidict
 
 from h.api.search import query
@@ -314,6 +315,21 @@ def test_build_for_uri_normalized(uri):
     assert expected_filter in q["query"]["filtered"]["filter"]["and"]
 
 
+@mock.patch("h.api.search.query.uri")
+def test_build_adds_expanded_uris_to_passed_set(uri):
+    """It should add the URIs the "uri" param expands to to the passed set."""
+    uri.expand.side_effect = lambda x: [x, "http://example2.com/"]
+    uri.normalize.side_effect = lambda x: x
+    uris = set()
+
+    query.build(
+        request_params=multidict.NestedMultiDict(
+            {"uri": "http://example.com/"}),
+        uris=uris)
+
+    assert uris == {"http://example.com/", "http://example2.com/"}
+
+
 def test_build_with_single_text_param():
     """'text' params are returned in the query dict in "match" clauses."""
     q = query.build(
@@ -420,3 +436,163 @@ def test_build_with_arbitrary_params():
             ]
         }
     }
+
+
+def test_build_rejects_deep_offsets():
+    params = multidict.NestedMultiDict({"offset": query.OFFSET_MAX + 1})
+
+    with pytest.raises(ValueError):
+        query.build(request_params=params)
+
+
+def _hits(*sort_values):
+    return [{"_id": str(i), "sort": [v]} for i, v in enumerate(sort_values)]
+
+
+def test_next_cursor_is_none_for_last_page():
+    q = query.build(multidict.NestedMultiDict({"limit": 3}))
+
+    assert query.next_cursor(q, _hits(3, 2)) is None
+
+
+def test_build_with_cursor():
+    q = query.build(multidict.NestedMultiDict({"limit": 3, "offset": 5}))
+    cursor = query.next_cursor(q, _hits(3, 2, 2))
+
+    params = multidict.NestedMultiDict({"limit": 3, "cursor": cursor})
+    q = query.build(request_params=params)
+
+    assert q["from"] == 0
+    assert q["query"]["filtered"]["filter"]["and"][0] == {"bool": {
+        "must": [{"range": {"updated": {"lte": 2}}}],
+        "must_not": [{"ids": {"values": ["1", "2"]}}],
+    }}
+
+
+def test_build_with_cursor_in_ascending_order():
+    params = multidict.NestedMultiDict({"sort": "created", "order": "asc"})
+    cursor = query.next_cursor(query.build(params), _hits(*range(20)))
+
+    params = multidict.NestedMultiDict({"sort": "created", "order": "asc",
+                                        "cursor": cursor})
+    q = query.build(request_params=params)
+
+    page_filter = q["query"]["filtered"]["filter"]["and"][0]
+    assert page_filter["bool"]["must"] == [
+        {"range": {"created": {"gte": 19}}}]
+
+
+def test_next_cursor_accumulates_ids_with_equal_sort_values():
+    q = query.build(multidict.NestedMultiDict({"limit": 2}))
+    cursor = query.next_cursor(q, _hits(5, 5))
+    hits = [{"_id": "a", "sort": [5]}, {"_id": "b", "sort": [5]}]
+    cursor = query.next_cursor(q, hits, cursor)
+
+    params = multidict.NestedMultiDict({"limit": 2, "cursor": cursor})
+    q = query.build(request_params=params)
+
+    page_filter = q["query"]["filtered"]["filter"]["and"][0]
+    assert page_filter["bool"]["must_not"] == [
+        {"ids": {"values": ["0", "1", "a", "b"]}}]
+
+
+@pytest.mark.parametrize("cursor", ["", "foo", "e30=", "W10="])
+def test_build_with_invalid_cursor(cursor):
+    params = multidict.NestedMultiDict({"cursor": cursor})
+
+    with pytest.raises(ValueError):
+        query.build(request_params=params)
+
+
+def test_build_with_cursor_for_another_sort_order():
+    cursor = query.next_cursor(query.build(multidict.NestedMultiDict()),
+                               _hits(*range(20)))
+    params = multidict.NestedMultiDict({"cursor": cursor, "order": "asc"})
+
+    with pytest.raises(ValueError):
+        query.build(request_params=params)
+
+
+def test_next_cursor_is_none_for_other_sorts():
+    q = query.build(multidict.NestedMultiDict({"limit": 2, "sort": "user"}))
+
+    assert query.next_cursor(q, _hits("a", "a")) is None
+
+
+def test_build_with_cursor_for_other_sorts():
+    cursor = query.next_cursor(query.build(multidict.NestedMultiDict()),
+                               _hits(*range(20)))
+    params = multidict.NestedMultiDict({"cursor": cursor, "sort": "user"})
+
+    with pytest.raises(ValueError):
+        query.build(request_params=params)
+
+
+def test_after_cursor():
+    body = {"from": 5, "size": 2, "query": {"match_all": {}},
+            "sort": [{"updated": {"order": "desc"}}]}
+    cursor = query.next_cursor(body, _hits(3, 2))
+
+    q = query.after_cursor(body, cursor)
+
+    assert q["from"] == 0
+    assert q["size"] == 2
+    assert q["query"] == {"filtered": {
+        "filter": {"bool": {
+            "must": [{"range": {"updated": {"lte": 2}}}],
+            "must_not": [{"ids": {"values": ["1"]}}],
+        }},
+        "query": {"match_all": {}},
+    }}
+    assert body["query"] == {"match_all": {}}
+
+
+def test_after_cursor_for_other_sorts():
+    body = {"size": 2, "query": {"match_all": {}},
+            "sort": [{"updated": {"order": "desc"}}]}
+    cursor = query.next_cursor(body, _hits(3, 2))
+    body["sort"] = [{"user": {"order": "desc"}}]
+
+    with pytest.raises(ValueError):
+        query.after_cursor(body, cursor)
+
+
+def test_build_excludes_index_only_fields():
+    q = query.build(multidict.NestedMultiDict())
+
+    assert q["_source"] == {"exclude": ["target.source_normalized"]}
+
+
+def test_build_with_fields():
+    params = multidict.MultiDict([("fields", "text,tags"),
+                                  ("fields", "document.title")])
+
+    q = query.build(request_params=params)
+
+    assert q["_source"] == {"include": ["text", "tags", "document.title"],
+                            "exclude": ["target.source_normalized"]}
+    assert q["query"]["filtered"]["query"] == {"match_all": {}}
+
+
+def test_build_with_exclude():
+    params = multidict.NestedMultiDict({"exclude": "document, permissions"})
+
+    q = query.build(request_params=params)
+
+    assert q["_source"] == {"exclude": ["document", "permissions",
+                                        "target.source_normalized"]}
+
+
+@pytest.mark.parametrize("param", ["fields", "exclude"])
+def test_build_with_wildcard_fields(param):
+    params = multidict.NestedMultiDict({param: "document.*"})
+
+    with pytest.raises(ValueError):
+        query.build(request_params=params)
+
+
+def test_projection():
+    params = multidict.MultiDict([("fields", "text,,tags"),
+                                  ("exclude", "tags")])
+
+    assert query.projection(params) == (["text", "tags"], ["tags"])
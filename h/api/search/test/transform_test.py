@@ -60,6 +60,47 @@ def test_render_removes_source_normalized_field(ann_in, ann_out):
     assert transform.render(ann_in) == ann_out
 
 
+@pytest.mark.parametrize("fields,exclude,ann_out", [
+    (["text"], None, {"id": "1", "text": "Hello"}),
+    (["document"], None, {"id": "1", "document": {"title": ["Giraffes"],
+                                                  "link": [{"href": "a"}]}}),
+    (["document.title", "target.source"], None,
+     {"id": "1", "document": {"title": ["Giraffes"]},
+      "target": [{"source": "giraffe"}]}),
+    (None, ["document", "permissions"],
+     {"id": "1", "text": "Hello", "target": [
+         {"source": "giraffe", "selector": [{"type": "TextQuoteSelector"}]}]}),
+    (None, ["target.selector", "document.link", "permissions"],
+     {"id": "1", "text": "Hello", "target": [{"source": "giraffe"}],
+      "document": {"title": ["Giraffes"]}}),
+    (["target"], ["target.selector"],
+     {"id": "1", "target": [{"source": "giraffe"}]}),
+    (["text.length"], None, {"id": "1"}),
+    (["text"], ["id"], {"id": "1", "text": "Hello"}),
+])
+def test_render_projects_fields(fields, exclude, ann_out):
+    ann_in = {
+        "id": "1",
+        "text": "Hello",
+        "permissions": {"read": ["group:__world__"]},
+        "target": [{"source": "giraffe",
+                    "source_normalized": "*giraffe*",
+                    "selector": [{"type": "TextQuoteSelector"}]}],
+        "document": {"title": ["Giraffes"], "link": [{"href": "a"}]},
+    }
+
+    assert transform.render(ann_in, fields=fields, exclude=exclude) == ann_out
+
+
+def test_render_does_not_modify_the_annotation():
+    ann_in = {"id": "1", "target": [{"source": "giraffe",
+                                     "source_normalized": "*giraffe*"}]}
+
+    transform.render(ann_in, exclude=["text"])
+
+    assert ann_in["target"][0]["source_normalized"] == "*giraffe*"
+
+
 @pytest.fixture
 def uri_normalize(request):
     patcher = mock.patch('h.api.uri.normalize', autospec=True)
@@ -19,14 +19,24 @@ def prepare(annotation):
     _normalize_annotation_target_uris(annotation)
 
 
-def render(annotation):
+def render(annotation, fields=None, exclude=None):
     """
     Render an annotation retrieved from search for public display.
 
     Receives data direct from the search index and reformats it for rendering
     or display in the public API.
+
+    If `fields` is passed, only the fields it names, by their dotted paths,
+    are rendered. The fields named in `exclude` are left out. The
+    annotation's id is always rendered.
     """
-    data = copy.deepcopy(annotation)
+    data = annotation
+    if fields or exclude:
+        data = _project(annotation, frozenset(fields or ()),
+                        frozenset(exclude or ()), '')
+        if 'id' in annotation:
+            data['id'] = annotation['id']
+    data = copy.deepcopy(data)
 
     _filter_target_normalized_uris(data)
 
@@ -60,3 +70,44 @@ def _filter_target_normalized_uris(data):
         if 'source_normalized' not in target:
             continue
         del target['source_normalized']
+
+
+def _project(value, include, exclude, prefix):
+    """
+    Return the passed value with only the included fields, and without the
+    excluded ones, below the passed path prefix.
+
+    The parts of the value which are returned unchanged are shared with it,
+    not copied.
+    """
+    if isinstance(value, list):
+        return [_project(item, include, exclude, prefix) for item in value
+                if not include or isinstance(item, (dict, list))]
+    if not isinstance(value, dict):
+        return value
+
+    result = {}
+    for key, item in value.items():
+        path = prefix + key
+        if path in exclude:
+            continue
+        if path in include:
+            # Everything below an included field is included.
+            item_include = frozenset()
+        elif include:
+            if not _has_descendant(include, path):
+                continue
+            if not isinstance(item, (dict, list)):
+                continue
+            item_include = include
+        else:
+            item_include = include
+        if item_include or _has_descendant(exclude, path):
+            item = _project(item, item_include, exclude, path + '.')
+        result[key] = item
+    return result
+
+
+def _has_descendant(paths, path):
+    prefix = path + '.'
+    return any(p.startswith(prefix) for p in paths)
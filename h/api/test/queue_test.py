@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import json
+
+import mock
+import pytest
+
+from h.api import queue
+
+
+def test_annotation_publishes_event(event):
+    queue.annotation(event)
+
+    writer = event.request.get_queue_writer.return_value
+    writer.publish.assert_called_once_with('annotations', mock.ANY)
+    data = json.loads(writer.publish.call_args[0][1])
+    assert data == {
+        'action': 'create',
+        'annotation': {'uri': 'http://example.com/'},
+        'src_client_id': 'client',
+    }
+
+
+def test_annotation_does_nothing_without_queue_feature(event):
+    event.request.feature.return_value = False
+
+    queue.annotation(event)
+
+    assert not event.request.get_queue_writer.called
+
+
+@mock.patch('h.api.queue.uri.expand')
+def test_annotation_publishes_to_shards_of_document_uris(expand, event):
+    event.request.registry.settings['h.streamer.shards'] = '16'
+    uris = ['http://example.com/', 'urn:x-pdf:abc']
+    expand.return_value = uris
+
+    queue.annotation(event)
+
+    writer = event.request.get_queue_writer.return_value
+    topics = [c[0][0] for c in writer.publish.call_args_list]
+    shards = sorted(set(queue.shard_for_uri(u, 16) for u in uris))
+    assert topics == ['annotations'] + [queue.shard_topic(s) for s in shards]
+    expand.assert_called_once_with('http://example.com/')
+
+
+@mock.patch('h.api.queue.uri.expand')
+def test_annotation_does_not_publish_reads_to_shards(expand, event):
+    event.request.registry.settings['h.streamer.shards'] = '16'
+    event.action = 'read'
+
+    queue.annotation(event)
+
+    writer = event.request.get_queue_writer.return_value
+    writer.publish.assert_called_once_with('annotations', mock.ANY)
+    assert not expand.called
+
+
+def test_shard_for_uri_is_stable():
+    assert queue.shard_for_uri('http://example.com/', 1000) == 980
+
+
+def test_shard_for_uri_normalizes():
+    assert queue.shard_for_uri('HTTP://Example.com/#foo', 100) == \
+        queue.shard_for_uri('http://example.com/', 100)
+
+
+def test_shards_for_annotation_without_uri():
+    assert queue.shards_for_annotation({}, 4) == set()
+
+
+@pytest.fixture
+def event():
+    event = mock.Mock()
+    event.action = 'create'
+    event.annotation = {'uri': 'http://example.com/'}
+    event.request.feature.return_value = True
+    event.request.headers = {'X-Client-Id': 'client'}
+    event.request.registry.settings = {}
+    return event
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import json
+
 import mock
 import pytest
 from pyramid import testing
@@ -16,6 +18,11 @@ def _mock_annotation(**kwargs):
     return annotation
 
 
+def _json_body(response):
+    """Return the decoded JSON body of a streamed response."""
+    return json.loads(''.join(response.app_iter))
+
+
 def test_index():
     """Get the API descriptor"""
     result = views.index(testing.DummyResource(), testing.DummyRequest())
@@ -75,6 +82,18 @@ def test_search_passes_user_to_search(get_user, search_lib):
     assert search_lib.search.call_args[1]['user'] == get_user.return_value
 
 
+@search_fixtures
+def test_search_passes_cache_and_principals_to_search(search_lib):
+    """It should pass the search cache and the caller's principals."""
+    request = mock.Mock()
+
+    views.search(request)
+
+    kwargs = search_lib.search.call_args[1]
+    assert kwargs['cache'] == request.registry.search_cache
+    assert kwargs['principals'] == request.effective_principals
+
+
 @search_fixtures
 def test_search_calls_feature():
     """It should call request.feature() once, passing 'search_normalized'."""
@@ -105,17 +124,17 @@ def test_search_returns_total(search_lib):
         'rows': ['annotation_1', 'annotation_2', 'annotation_3']
     }
 
-    response_data = views.search(mock.Mock())
+    response = views.search(mock.Mock())
 
-    assert response_data['total'] == 3
+    assert _json_body(response)['total'] == 3
 
 
 @search_fixtures
-def test_search_returns_rendered_annotations(search_lib):
-    """It should return the rendered annotations.
+def test_search_returns_annotations(search_lib):
+    """It should return the annotations from search_lib.search().
 
-    It should pass the annotations from search_lib.search() through
-    search_lib.render() and return the results.
+    They are returned without rendering, since search_lib.search() leaves
+    out the fields which rendering removes.
 
     """
     search_lib.search.return_value = {
@@ -123,15 +142,61 @@ def test_search_returns_rendered_annotations(search_lib):
         # In production these would be annotation dicts, not strings.
         'rows': ['annotation_1', 'annotation_2', 'annotation_3']
     }
-    # Our mock render function just appends '_rendered' onto our mock
-    # annotation strings.
-    search_lib.render.side_effect = lambda annotation: annotation + '_rendered'
 
-    response_data = views.search(mock.Mock())
+    response = views.search(mock.Mock())
+
+    assert _json_body(response)['rows'] == [
+        'annotation_1', 'annotation_2', 'annotation_3']
+    assert not search_lib.render.called
+
+
+@search_fixtures
+def test_search_returns_json(search_lib):
+    """It should return the request's response with a JSON body."""
+    request = mock.Mock()
+
+    response = views.search(request)
+
+    assert response == request.response
+    assert response.content_type == 'application/json'
+    assert response.charset == 'UTF-8'
+
+
+@search_fixtures
+@pytest.mark.parametrize('count', [0, 1, 50, 51, 120])
+def test_search_streams_rows_in_chunks(search_lib, count):
+    """It should encode the rows a chunk at a time, as valid JSON."""
+    rows = [{'id': str(n)} for n in range(count)]
+    search_lib.search.return_value = {'total': count, 'rows': rows,
+                                      'next': None}
+
+    chunks = list(views.search(mock.Mock()).app_iter)
+
+    assert len(chunks) == 2 + (count + 49) // 50
+    assert json.loads(''.join(chunks)) == {'total': count, 'rows': rows,
+                                           'next': None}
+
+
+@search_fixtures
+def test_search_returns_next_cursor(search_lib):
+    """It should return the cursor for the next page of results."""
+    search_lib.search.return_value = {'total': 3, 'rows': [], 'next': 'abc'}
+
+    response = views.search(mock.Mock())
+
+    assert _json_body(response)['next'] == 'abc'
+
+
+@search_fixtures
+def test_search_returns_error_for_invalid_params(search_lib):
+    """It should return a 400 error if search() rejects the params."""
+    search_lib.search.side_effect = ValueError('invalid cursor')
+    request = mock.Mock()
+
+    response_data = views.search(request)
 
-    assert response_data['rows'] == [
-        'annotation_1_rendered', 'annotation_2_rendered',
-        'annotation_3_rendered']
+    assert request.response.status_code == 400
+    assert response_data['reason'] == 'invalid cursor'
 
 
 def test_access_token_returns_create_token_response():
@@ -235,33 +300,25 @@ def test_annotations_index_returns_total(search_lib):
         'rows': ['annotation_1', 'annotation_2', 'annotation_3']
     }
 
-    response_data = views.annotations_index(mock.Mock())
+    response = views.annotations_index(mock.Mock())
 
-    assert response_data['total'] == 3
+    assert _json_body(response)['total'] == 3
 
 
 @annotations_index_fixtures
-def test_annotations_index_returns_rendered_annotations(search_lib):
-    """It should return the rendered annotations.
-
-    It should pass the annotations from search_lib.index() through
-    search_lib.render() and return the results.
-
-    """
+def test_annotations_index_returns_annotations(search_lib):
+    """It should return the annotations from search_lib.index()."""
     search_lib.index.return_value = {
         'total': 3,
         # In production these would be annotation dicts, not strings.
         'rows': ['annotation_1', 'annotation_2', 'annotation_3']
     }
-    # Our mock render function just appends '_rendered' onto our mock
-    # annotation strings.
-    search_lib.render.side_effect = lambda annotation: annotation + '_rendered'
 
-    response_data = views.annotations_index(mock.Mock())
+    response = views.annotations_index(mock.Mock())
 
-    assert response_data['rows'] == [
-        'annotation_1_rendered', 'annotation_2_rendered',
-        'annotation_3_rendered']
+    assert _json_body(response)['rows'] == [
+        'annotation_1', 'annotation_2', 'annotation_3']
+    assert not search_lib.render.called
 
 
 # The fixtures required to mock all of create()'s dependencies.
@@ -334,7 +391,33 @@ def test_read_calls_render(search_lib):
 
     views.read(context=annotation, request=mock.Mock())
 
-    search_lib.render.assert_called_once_with(annotation)
+    search_lib.render.assert_called_once_with(annotation, fields=[],
+                                              exclude=[])
+
+
+@read_fixtures
+def test_read_renders_projected_fields(search_lib):
+    annotation = mock.Mock()
+    request = mock.Mock()
+    search_lib.projection.return_value = (['text', 'tags'], [])
+
+    views.read(context=annotation, request=request)
+
+    search_lib.projection.assert_called_once_with(request.params)
+    search_lib.render.assert_called_once_with(annotation,
+                                              fields=['text', 'tags'],
+                                              exclude=[])
+
+
+@read_fixtures
+def test_read_returns_error_for_invalid_fields(search_lib):
+    search_lib.projection.side_effect = ValueError('invalid field name')
+    request = mock.Mock()
+
+    views.read(context=mock.Mock(), request=request)
+
+    assert request.response.status_code == 400
+    assert not search_lib.render.called
 
 
 @read_fixtures
@@ -489,7 +572,11 @@ def search_render(request):
 def search_lib(request):
     patcher = mock.patch('h.api.views.search_lib', autospec=True)
     request.addfinalizer(patcher.stop)
-    return patcher.start()
+    search_lib = patcher.start()
+    search_lib.projection.return_value = ([], [])
+    search_lib.search.return_value = {'total': 0, 'rows': [], 'next': None}
+    search_lib.index.return_value = {'total': 0, 'rows': []}
+    return search_lib
 
 
 @pytest.fixture
@@ -2,6 +2,7 @@
 
 """HTTP/REST API for interacting with the annotation store."""
 
+import json
 import logging
 
 from pyramid.view import view_config
@@ -17,6 +18,9 @@ from h.api import logic
 
 log = logging.getLogger(__name__)
 
+# The number of rows encoded for each chunk of a search response's body.
+ROWS_PER_CHUNK = 50
+
 
 def api_config(**kwargs):
     """Extend Pyramid's @view_config decorator with modified defaults."""
@@ -74,16 +78,29 @@ def search(request):
     """Search the database for annotations matching with the given query."""
     search_normalized_uris = request.feature('search_normalized')
 
-    # The search results are filtered for the authenticated user
+    # The search results are filtered for the authenticated user, and cached
+    # for callers with the same principals.
     user = get_user(request)
-    results = search_lib.search(request_params=request.params,
-                                user=user,
-                                search_normalized_uris=search_normalized_uris)
-
-    return {
+    try:
+        results = search_lib.search(
+            request_params=request.params,
+            user=user,
+            search_normalized_uris=search_normalized_uris,
+            cache=getattr(request.registry, 'search_cache', None),
+            principals=request.effective_principals)
+    except ValueError as err:
+        return _api_error(request, err.args[0], status_code=400)
+
+    # The rows are returned as Elasticsearch returned them, without the
+    # fields which are only indexed or which the caller left out, so they
+    # are encoded as they are rather than rendered and copied first.
+    #
+    # Pass "next" back as the "cursor" param to fetch the following page.
+    return _json_response(request, {
         'total': results['total'],
-        'rows': [search_lib.render(a) for a in results['rows']],
-    }
+        'rows': results['rows'],
+        'next': results.get('next'),
+    })
 
 
 @api_config(context=Root, name='access_token')
@@ -120,10 +137,10 @@ def annotations_index(request):
     results = search_lib.index(user=user,
                                search_normalized_uris=search_normalized_uris)
 
-    return {
+    return _json_response(request, {
         'total': results['total'],
-        'rows': [search_lib.render(a) for a in results['rows']],
-    }
+        'rows': results['rows'],
+    })
 
 
 @api_config(context=Annotations, request_method='POST', permission='create')
@@ -155,10 +172,15 @@ def read(context, request):
     """Return the annotation (simply how it was stored in the database)."""
     annotation = context
 
+    try:
+        fields, exclude = search_lib.projection(request.params)
+    except ValueError as err:
+        return _api_error(request, err.args[0], status_code=400)
+
     # Notify any subscribers
     _publish_annotation_event(request, annotation, 'read')
 
-    return search_lib.render(annotation)
+    return search_lib.render(annotation, fields=fields, exclude=exclude)
 
 
 @api_config(containment=Root, context=Annotation,
@@ -219,6 +241,34 @@ def _publish_annotation_event(request, annotation, action):
     request.registry.notify(event)
 
 
+def _json_response(request, data):
+    """
+    Return the request's response, with the passed data as its JSON body.
+
+    The body is encoded as it is sent, a few of the data's "rows" at a time,
+    rather than all at once: the whole body is never held in memory, and
+    the first rows are sent before the last are encoded. Without a
+    Content-Length the server sends the body with chunked transfer encoding.
+    """
+    response = request.response
+    response.content_type = 'application/json'
+    response.charset = 'UTF-8'
+    response.app_iter = _iter_json(data)
+    return response
+
+
+def _iter_json(data):
+    """Encode the passed data as JSON, yielding it in chunks."""
+    rows = data['rows']
+    head = json.dumps(dict((k, v) for k, v in data.items() if k != 'rows'))
+    yield head[:-1] + (', ' if len(head) > 2 else '') + '"rows": ['
+    for start in range(0, len(rows), ROWS_PER_CHUNK):
+        chunk = ', '.join(json.dumps(row)
+                          for row in rows[start:start + ROWS_PER_CHUNK])
+        yield (', ' if start else '') + chunk
+    yield ']}'
+
+
 def _api_error(request, reason, status_code):
     request.response.status_code = status_code
     response_info = {
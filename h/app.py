@@ -49,6 +49,36 @@ def create_app(global_config, **settings):
     return app
 
 
+def create_streamer(global_config, **settings):
+    """
+    Configure the websocket streamer on its own. Return the WSGI app.
+
+    This lets the streamer be scaled separately from the rest of the
+    application, optionally as a number of shards each serving the clients
+    watching a slice of the annotated documents.
+    """
+    settings = get_settings(global_config, **settings)
+
+    config = Configurator(settings=settings)
+
+    config.set_root_factory('h.resources.create_root')
+
+    config.add_subscriber('h.subscribers.set_user_from_oauth',
+                          'pyramid.events.NewRequest')
+
+    config.add_tween('h.tweens.auth_token')
+
+    config.include('h.features')
+    config.include('h.db')
+    config.include('h.models')
+    config.include('h.auth')
+    config.include('h.api.db')
+    config.include('h.queue')
+    config.include('h.streamer')
+
+    return config.make_wsgi_app()
+
+
 def includeme(config):
 
     config.include('h.features')
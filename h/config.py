@@ -174,6 +174,12 @@ def _setup_websocket(settings):
     if 'ALLOWED_ORIGINS' in os.environ:
         settings['origins'] = os.environ['ALLOWED_ORIGINS']
 
+    # Run a standalone streamer as one of a number of shards
+    if 'STREAMER_SHARDS' in os.environ:
+        settings['h.streamer.shards'] = os.environ['STREAMER_SHARDS']
+    if 'STREAMER_SHARD' in os.environ:
+        settings['h.streamer.shard'] = os.environ['STREAMER_SHARD']
+
 
 def _setup_blocklist(settings):
     if 'BLOCKLIST' in os.environ:
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+The streamer, which notifies websocket clients of the annotation events
+matching their filters.
+"""
+from h.streamer.cache import ExpansionCache
+from h.streamer.delivery import DeliveryWindow
+from h.streamer.delivery import SendQueue
+from h.streamer.events import ReplayBuffer
+from h.streamer.events import broadcast_from_queue
+from h.streamer.events import event_ring_writer
+from h.streamer.events import read_event_ring
+from h.streamer.events import should_send_event
+from h.streamer.filters import CompiledFilter
+from h.streamer.filters import FilterHandler
+from h.streamer.filters import FilterToElasticFilter
+from h.streamer.filters import compile_filter
+from h.streamer.index import SubscriptionIndex
+from h.streamer.sockets import SocketState
+from h.streamer.sockets import WebSocket
+from h.streamer.stats import StreamerStats
+from h.streamer.timers import TimerWheel
+from h.streamer.views import websocket
+from h.streamer.views import websocket_shard
+from h.streamer.views import websocket_stats
+
+__all__ = (
+    'CompiledFilter',
+    'DeliveryWindow',
+    'ExpansionCache',
+    'FilterHandler',
+    'FilterToElasticFilter',
+    'ReplayBuffer',
+    'SendQueue',
+    'SocketState',
+    'StreamerStats',
+    'SubscriptionIndex',
+    'TimerWheel',
+    'WebSocket',
+    'broadcast_from_queue',
+    'compile_filter',
+    'event_ring_writer',
+    'read_event_ring',
+    'should_send_event',
+    'websocket',
+    'websocket_shard',
+    'websocket_stats',
+)
+
+
+def includeme(config):
+    config.include('h.streamer.views')
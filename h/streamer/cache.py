@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""A process-wide cache of the URI expansions of websocket filters."""
+import collections
+import time
+
+import gevent
+import gevent.event
+import gevent.pool
+
+from h.api import uri
+
+
+class ExpansionCache(object):
+    """
+    A process-wide cache of URI expansions, as returned by
+    :py:func:`h.api.uri.expand`.
+
+    Expanding a URI means a search for the documents it belongs to. When
+    many clients reconnect at once, they send filters for the same handful of
+    pages, so each URI is only looked up once per ``ttl`` seconds however
+    many filters list it, and concurrent requests for a URI which is already
+    being looked up wait for that lookup rather than starting another. The
+    URIs of a filter which are not in the cache are looked up concurrently,
+    at most ``concurrency`` at a time across the process.
+    """
+
+    def __init__(self, ttl=60.0, maxsize=10000, concurrency=10,
+                 clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._pool = gevent.pool.Pool(concurrency)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def expand(self, uris):
+        """Return the set of URIs equivalent to any of the passed URIs."""
+        now = self.clock()
+        expanded = set()
+        waiting = []
+        for item in uris:
+            entry = self._entries.get(item)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                expanded.update(entry[1])
+                continue
+            result = self._pending.get(item)
+            if result is None:
+                self.misses += 1
+                result = self._pending[item] = gevent.event.AsyncResult()
+                self._pool.spawn(self._lookup, item, result)
+            waiting.append(result)
+        for result in waiting:
+            expanded.update(result.get())
+        return expanded
+
+    def _lookup(self, item, result):
+        try:
+            value = tuple(uri.expand(item))
+        except Exception as exc:
+            # Failures are not cached: the next filter to list the URI tries
+            # again.
+            del self._pending[item]
+            result.set_exception(exc)
+            return
+        self._entries.pop(item, None)
+        self._entries[item] = (self.clock() + self.ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        del self._pending[item]
+        result.set(value)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Support for the permessage-deflate WebSocket extension (RFC 7692).
+
+ws4py does not implement any extensions, so this module provides the pieces
+the streamer needs on top of it:
+
+- :py:func:`negotiate` picks the response to a client's extension offers,
+- :py:func:`compressed_frame` builds compressed text frames, and
+- :py:class:`Inflater` decompresses the frames sent by the client before they
+  reach ws4py's parser.
+
+The extension is always agreed with ``server_no_context_takeover`` and
+``client_no_context_takeover``, so that every message is compressed on its
+own. This costs a little in compression ratio, but means that a frame which
+is sent to many clients need only be compressed once, and that no
+compression state is kept per connection.
+"""
+import collections
+import struct
+import zlib
+
+from ws4py.framing import Frame
+from ws4py.framing import OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY
+
+EXTENSION = 'permessage-deflate'
+RESPONSE = ('permessage-deflate; server_no_context_takeover; '
+            'client_no_context_takeover')
+
+# Messages shorter than this are sent uncompressed: the saving would not be
+# worth the CPU.
+MIN_SIZE = 128
+
+# The largest message a client may send, once decompressed.
+MAX_MESSAGE_SIZE = 1 << 20
+
+# The number of recently compressed frames to keep, so that the same frame
+# sent to several clients is only compressed once.
+CACHE_SIZE = 64
+
+_TAIL = b'\x00\x00\xff\xff'
+_cache = collections.OrderedDict()
+
+
+def negotiate(offers):
+    """
+    Return the ``Sec-WebSocket-Extensions`` response accepting the first
+    acceptable permessage-deflate offer in the passed request header value, or
+    None if there is no such offer.
+    """
+    if not offers:
+        return None
+    for offer in offers.split(','):
+        params = [p.strip() for p in offer.split(';')]
+        if params[0] == EXTENSION and _acceptable(params[1:]):
+            return RESPONSE
+    return None
+
+
+def _acceptable(params):
+    seen = set()
+    for param in params:
+        name, _, value = param.partition('=')
+        name = name.strip()
+        value = value.strip().strip('"')
+        if name in seen:
+            return False
+        seen.add(name)
+        if name in ('server_no_context_takeover',
+                    'client_no_context_takeover'):
+            if value:
+                return False
+        elif name == 'client_max_window_bits':
+            # We always inflate with the largest window, so any limit the
+            # client places on its own window is fine.
+            if value and not (value.isdigit() and 8 <= int(value) <= 15):
+                return False
+        else:
+            # Limiting our window (server_max_window_bits) would rule out
+            # sharing compressed frames between clients.
+            return False
+    return True
+
+
+def compress(data):
+    """Compress a single message's payload."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return body[:-len(_TAIL)]
+
+
+def compressed_frame(payload):
+    """
+    Return the bytes of a compressed, unmasked text frame for the passed
+    payload, or None if the payload is too short to be worth compressing.
+
+    Frames are cached, so that a payload sent to many sockets is compressed
+    only once.
+    """
+    try:
+        frame = _cache.pop(payload)
+    except KeyError:
+        data = payload
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if len(data) < MIN_SIZE:
+            frame = None
+        else:
+            frame = Frame(opcode=OPCODE_TEXT, body=compress(data), fin=1,
+                          rsv1=1).build()
+        if len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[payload] = frame
+    return frame
+
+
+class Inflater(object):
+    """
+    Decompresses the messages in a stream of frames from a client.
+
+    Bytes read from the connection are passed to :py:meth:`feed`, which
+    returns a list of complete frames to be passed on to ws4py one at a time.
+    Frames which are part of a compressed message are replaced by equivalent
+    uncompressed frames, and all other frames are passed on unchanged.
+    """
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self.max_size = max_size
+        self._buffer = b''
+        self._decompressor = None
+        self._size = 0
+
+    @property
+    def needed(self):
+        """The number of bytes needed to complete the next frame."""
+        header = _parse_header(self._buffer)
+        if header is None:
+            return max(2, 14 - len(self._buffer))
+        return header[-1] - len(self._buffer)
+
+    def feed(self, data):
+        """
+        Add bytes read from the connection, returning any frames they
+        complete.
+
+        Raises ValueError if a message exceeds the maximum size or cannot be
+        decompressed.
+        """
+        self._buffer += data
+        frames = []
+        while True:
+            header = _parse_header(self._buffer)
+            if header is None:
+                break
+            if header[-1] - header[-2] > self.max_size:
+                raise ValueError('frame too large')
+            if len(self._buffer) < header[-1]:
+                break
+            end = header[-1]
+            frame, self._buffer = self._buffer[:end], self._buffer[end:]
+            frames.append(self._inflate(frame, *header))
+        return frames
+
+    def _inflate(self, frame, fin, rsv1, opcode, key, start, end):
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY) and rsv1:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self._size = 0
+        elif opcode != OPCODE_CONTINUATION or self._decompressor is None:
+            return frame
+
+        body = frame[start:end]
+        if key is not None:
+            body = bytes(Frame(masking_key=key).unmask(body))
+        if fin:
+            body += _TAIL
+
+        limit = self.max_size - self._size + 1
+        try:
+            body = self._decompressor.decompress(body, limit)
+        except zlib.error as exc:
+            raise ValueError('invalid compressed message: {}'.format(exc))
+        self._size += len(body)
+        if self._size > self.max_size:
+            raise ValueError('message too large')
+
+        if fin:
+            self._decompressor = None
+        return Frame(opcode=opcode, body=body, fin=fin,
+                     masking_key=key).build()
+
+
+def _parse_header(buf):
+    """
+    Parse the header at the start of the passed bytes, returning a tuple of
+    ``(fin, rsv1, opcode, masking_key, payload_start, frame_end)``, or None
+    if the header is incomplete.
+    """
+    if len(buf) < 2:
+        return None
+    first, second = struct.unpack('!BB', buf[:2])
+    length = second & 0x7f
+    offset = 2
+    if length == 126:
+        if len(buf) < 4:
+            return None
+        length = struct.unpack('!H', buf[2:4])[0]
+        offset = 4
+    elif length == 127:
+        if len(buf) < 10:
+            return None
+        length = struct.unpack('!Q', buf[2:10])[0]
+        offset = 10
+    key = None
+    if second & 0x80:
+        if len(buf) < offset + 4:
+            return None
+        key = buf[offset:offset + 4]
+        offset += 4
+    return ((first >> 7) & 1, (first >> 6) & 1, first & 0xf, key,
+            offset, offset + length)
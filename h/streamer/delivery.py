@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+The delivery of frames to a websocket: a bounded queue drained by the
+socket's own writer, and a window which batches events arriving in quick
+succession.
+"""
+import collections
+import json
+import logging
+
+import gevent
+import gevent.event
+
+from h.streamer.frames import _annotation_frame
+
+log = logging.getLogger(__name__)
+
+
+#: Process-wide counters of frames dropped or coalesced, and of sockets
+#: disconnected, by :py:class:`SendQueue` objects.
+send_queue_counters = collections.Counter()
+
+
+class SendQueue(object):
+    """
+    A bounded queue of outbound frames for a single websocket, drained by the
+    socket's own writer greenlet.
+
+    Frames are queued by the fanout greenlet without blocking, so that one
+    slow or stalled client cannot delay delivery to any other. When a queue
+    is full, its policy decides what happens:
+
+    ``drop_oldest``
+        the oldest pending frame is discarded;
+    ``coalesce``
+        a frame replaces any pending frame with the same key (e.g. for the
+        same annotation), and otherwise the oldest pending frame is discarded;
+    ``disconnect``
+        the socket is closed, and the client is left to reconnect.
+
+    Frames queued as `reliable`, such as replies to the client's requests,
+    are never discarded or replaced, and do not count towards the queue's
+    size.
+
+    The writer is the only greenlet which writes to the socket once it has
+    started, so the socket is closed by it too (see :py:meth:`finish`). The
+    socket is also closed if a frame cannot be sent. `close` is called with
+    the close code and reason.
+    """
+
+    policies = ('drop_oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, send, close, maxsize=100, policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError('unknown send queue policy: {}'.format(policy))
+        if maxsize < 1:
+            raise ValueError('send queue size must be positive')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self._send = send
+        self._close = close
+        self._closing = None
+        self._sending = False
+        self._frames = collections.deque()
+        self._droppable = 0
+        self._keys = {}
+        self._ready = gevent.event.Event()
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def idle(self):
+        """Whether the writer has nothing to send, and is sending nothing."""
+        return not self._frames and not self._sending
+
+    def put(self, data, key=None, reliable=False):
+        """
+        Queue a frame for delivery, applying the queue's policy if it is full.
+
+        Returns False if the frame will not be delivered.
+        """
+        if self.closed or self._closing is not None:
+            return False
+
+        if reliable:
+            self._frames.append([None, data, True])
+            self._ready.set()
+            return True
+
+        if self.policy == 'coalesce' and key in self._keys:
+            self._keys[key][1] = data
+            self.coalesced += 1
+            send_queue_counters['coalesced'] += 1
+            return True
+
+        if self._droppable >= self.maxsize:
+            if self.policy == 'disconnect':
+                send_queue_counters['disconnected'] += 1
+                self._discard()
+                self.finish(1013, 'slow consumer')
+                return False
+            self._evict()
+            self.dropped += 1
+            send_queue_counters['dropped'] += 1
+
+        frame = [key, data, False]
+        self._frames.append(frame)
+        self._droppable += 1
+        if key is not None:
+            self._keys[key] = frame
+        self._ready.set()
+        return True
+
+    def finish(self, code=1000, reason=''):
+        """
+        Close the socket from the writer, once it has sent the pending frames.
+        """
+        if self.closed or self._closing is not None:
+            return
+        self._closing = (code, reason)
+        self._ready.set()
+
+    def start(self):
+        """Start the writer greenlet draining this queue."""
+        return gevent.spawn(self.run)
+
+    def run(self):
+        while not self.closed:
+            self._ready.wait()
+            while self._frames and not self.closed:
+                frame = self._frames.popleft()
+                if not frame[2]:
+                    self._droppable -= 1
+                    self._forget(frame)
+                self._sending = True
+                try:
+                    self._send(frame[1])
+                except Exception:
+                    log.debug("websocket send failed, closing the socket",
+                              exc_info=True)
+                    self.close()
+                    self._close(1011, 'send failed')
+                finally:
+                    self._sending = False
+            if self._closing is not None and not self.closed:
+                code, reason = self._closing
+                self.close()
+                self._close(code, reason)
+            self._ready.clear()
+
+    def close(self):
+        """Discard any pending frames and stop the writer."""
+        self.closed = True
+        self._discard()
+        self._ready.set()
+
+    def _discard(self):
+        self._frames.clear()
+        self._droppable = 0
+        self._keys.clear()
+
+    def _evict(self):
+        # Discard the oldest frame which is not reliable.
+        for i, frame in enumerate(self._frames):
+            if not frame[2]:
+                del self._frames[i]
+                self._droppable -= 1
+                self._forget(frame)
+                return
+
+    def _forget(self, frame):
+        key = frame[0]
+        if key is not None and self._keys.get(key) is frame:
+            del self._keys[key]
+
+
+class DeliveryWindow(object):
+    """
+    Collects the events bound for a single websocket over a short window and
+    delivers them together.
+
+    The first event to arrive opens the window. When it closes, the collected
+    annotations are sent as one ``annotation-notification`` packet per
+    action, in the order in which the actions were first seen. Repeated
+    events for the same annotation and action within the window collapse to
+    the latest version of the annotation.
+
+    If the events carry sequence ids, the last packet of each delivery
+    carries the latest of them, so that a client which resumes from it has
+    seen every event in the window. Events for different sets of named
+    subscriptions are delivered in separate packets.
+
+    Annotations are encoded with `encode` and packets built from them with
+    `frame`, by default as JSON.
+    """
+
+    def __init__(self, push, window, encode=None, frame=None):
+        self.window = window
+        self._encode = encode or json.dumps
+        self._frame = frame or _annotation_frame
+        self._push = push
+        self._pending = collections.OrderedDict()
+        self._seq = None
+        self._timer = None
+
+    def __len__(self):
+        return sum(len(batch) for batch in self._pending.values())
+
+    def add(self, annotation, action, raw=None, seq=None, subscriptions=None):
+        """
+        Add an event to the window.
+
+        `raw` is the annotation's serialization, if already available,
+        `seq` is the event's sequence id, if it has one, and `subscriptions`
+        the list of named subscriptions it matches, if any.
+        """
+        if seq is not None:
+            self._seq = seq
+        if subscriptions is not None:
+            subscriptions = tuple(subscriptions)
+        batch = self._pending.get((action, subscriptions))
+        if batch is None:
+            batch = collections.OrderedDict()
+            self._pending[(action, subscriptions)] = batch
+        key = annotation.get('id')
+        if key is None:
+            key = id(annotation)
+        if raw is None:
+            raw = self._encode(annotation)
+        batch.pop(key, None)
+        batch[key] = raw
+
+        if self._timer is None:
+            self._timer = gevent.spawn_later(self.window, self.flush)
+
+    def flush(self):
+        """Deliver all pending events now."""
+        self._timer = None
+        pending, self._pending = self._pending, collections.OrderedDict()
+        seq, self._seq = self._seq, None
+        batches = pending.items()
+        for i, ((action, subscriptions), batch) in enumerate(batches, 1):
+            last = i == len(batches)
+            if subscriptions is not None:
+                subscriptions = list(subscriptions)
+            self._push(self._frame(batch.values(), action,
+                                   seq if last else None, subscriptions))
+
+    def close(self):
+        """Discard all pending events."""
+        if self._timer is not None:
+            self._timer.kill(block=False)
+            self._timer = None
+        self._pending.clear()
+        self._seq = None
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+A ring buffer of records in a memory-mapped file, written by one process and
+read by any number of others on the same host.
+
+The file starts with a header holding a magic string, a random epoch chosen
+by the writer, the capacity of the ring and the total number of bytes ever
+written to it. Records follow, each a 32-bit length and the record's bytes.
+A record never straddles the end of the ring: if it does not fit, the writer
+marks the remaining space as unused and starts again at the beginning.
+
+Readers poll the header and keep their own position. A reader which falls
+more than a ring's worth of data behind the writer has missed records. It
+skips to the writer's current position, and counts the loss in its
+``dropped`` attribute.
+
+The writer creates a new file, readable only by its own user, and renames it
+into place, so it never writes to a file some other user created at the
+ring's path. Readers must run as the same user, and notice a new file by its
+inode.
+"""
+import logging
+import mmap
+import os
+import random
+import struct
+import tempfile
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'HRING001'
+HEADER_SIZE = 64
+
+_HEADER = struct.Struct('<8sQQQ')
+_WRITTEN = struct.Struct('<Q')
+_WRITTEN_OFFSET = 24
+_LENGTH = struct.Struct('<I')
+_WRAP = 0xffffffff
+
+
+class RingWriter(object):
+    """
+    The writing end of an event ring.
+
+    Creating a writer replaces the file at the passed path, and any readers
+    start again from the writer's current position.
+    """
+
+    def __init__(self, path, capacity=16 << 20):
+        if capacity < 1024:
+            raise ValueError('event ring capacity must be at least 1024')
+        self.capacity = capacity
+        self.max_record = capacity // 4
+        self.epoch = random.getrandbits(63)
+        self.written = 0
+
+        # mkstemp creates the file exclusively, with mode 0600.
+        directory, name = os.path.split(path)
+        fd, tmp = tempfile.mkstemp(prefix=name + '.', dir=directory or '.')
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            self._map = mmap.mmap(fd, HEADER_SIZE + capacity)
+            self._map[:_HEADER.size] = _HEADER.pack(MAGIC, self.epoch,
+                                                    capacity, 0)
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+
+    def append(self, data):
+        """Write a record to the ring."""
+        size = _LENGTH.size + len(data)
+        if size > self.max_record:
+            raise ValueError('record too large for event ring: {} bytes'
+                             .format(len(data)))
+
+        offset = self.written % self.capacity
+        remaining = self.capacity - offset
+        if remaining < size:
+            if remaining >= _LENGTH.size:
+                self._write(offset, _LENGTH.pack(_WRAP))
+            self.written += remaining
+            offset = 0
+
+        self._write(offset, _LENGTH.pack(len(data)) + data)
+        self.written += size
+
+        # Publish the record only once it has been written in full.
+        self._map[_WRITTEN_OFFSET:_WRITTEN_OFFSET + _WRITTEN.size] = \
+            _WRITTEN.pack(self.written)
+
+    def close(self):
+        self._map.close()
+
+    def _write(self, offset, data):
+        start = HEADER_SIZE + offset
+        self._map[start:start + len(data)] = data
+
+
+class RingReader(object):
+    """
+    A reading end of an event ring.
+
+    The ring's file need not exist when the reader is created. Until it does,
+    and until it has been initialized by a writer, :py:meth:`read` returns no
+    records. A reader only sees the records written after it first finds the
+    ring, or after the writer was last restarted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dropped = 0
+        self.epoch = None
+        self.position = 0
+        self._map = None
+        self._inode = None
+
+    def read(self):
+        """Return a list of the records written since the last call."""
+        header = self._header()
+        if header is None:
+            return []
+        epoch, capacity, written = header
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = written
+            return []
+
+        # Records which may have been overwritten, whether before or while
+        # they are copied, start before this position.
+        max_record = capacity // 4
+        if written - self.position > capacity - max_record:
+            self._drop(written)
+
+        records = []
+        while self.position < written:
+            offset = self.position % capacity
+            remaining = capacity - offset
+            if remaining < _LENGTH.size:
+                self.position += remaining
+                continue
+            length, = _LENGTH.unpack_from(self._map, HEADER_SIZE + offset)
+            if length == _WRAP:
+                self.position += remaining
+                continue
+            start = HEADER_SIZE + offset + _LENGTH.size
+            records.append((self.position, self._map[start:start + length]))
+            self.position += _LENGTH.size + length
+
+        # Discard anything the writer may have overwritten while we copied.
+        oldest_valid = self._written() + max_record - capacity
+        intact = [data for pos, data in records if pos >= oldest_valid]
+        if len(intact) < len(records):
+            self.dropped += len(records) - len(intact)
+            log.warn('event ring reader fell behind, dropped %d events',
+                     len(records) - len(intact))
+        return intact
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def reset(self):
+        """
+        Forget the ring, so that the next read starts again from the writer's
+        current position, as when a reader is created.
+        """
+        self.close()
+        self.epoch = None
+
+    def _drop(self, written):
+        log.warn('event ring reader fell behind, skipping to the latest event')
+        self.dropped += 1
+        self.position = written
+
+    def _header(self):
+        if self._map is not None and self._replaced():
+            # A new writer has renamed its file into place: map that instead.
+            self.close()
+        if self._map is None:
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                return None
+            try:
+                stat = os.fstat(fd)
+                if stat.st_size < HEADER_SIZE:
+                    return None
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                self._inode = (stat.st_dev, stat.st_ino)
+            finally:
+                os.close(fd)
+        magic, epoch, capacity, _ = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or len(self._map) < HEADER_SIZE + capacity:
+            # The writer has recreated the file: map it again.
+            self.close()
+            return None
+        return epoch, capacity, self._written()
+
+    def _replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) != self._inode
+
+    def _written(self):
+        # Read the counter until two reads agree, so that a value torn by a
+        # concurrent update is never used.
+        while True:
+            first, = _WRITTEN.unpack_from(self._map, _WRITTEN_OFFSET)
+            second, = _WRITTEN.unpack_from(self._map, _WRITTEN_OFFSET)
+            if first == second:
+                return first
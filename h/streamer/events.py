@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Annotation events: their parsing, their replay, and their fanout from NSQ or
+the event ring to the websockets whose filters they match.
+"""
+import base64
+import collections
+import json
+import logging
+import random
+import re
+import struct
+import time
+
+import gevent
+
+from h.models import Annotation
+from h.streamer import eventring
+from h.streamer import subprotocol
+from h.streamer.filters import MatchContext
+from h.streamer.frames import _annotation_frame
+from h.streamer.shards import _event_topic
+
+log = logging.getLogger(__name__)
+
+
+class ReplayBuffer(object):
+    """
+    A bounded, in-memory log of the most recent annotation events, which lets
+    a reconnecting client catch up on the events it missed.
+
+    Each event is assigned a sequence id of the form ``<epoch>:<n>``, where
+    ``n`` increases by one with every event and ``epoch`` is a random string
+    chosen when the buffer is created. A client holding the id of the last
+    event it saw can ask for every event after it, which succeeds as long as
+    the id was issued by this buffer and the events following it have not
+    yet been evicted.
+    """
+
+    def __init__(self, maxlen=1000):
+        if maxlen < 1:
+            raise ValueError('replay buffer size must be positive')
+        self.epoch = _random_id()
+        self.last = 0
+        self._events = collections.deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def current(self):
+        """The sequence id of the most recent event."""
+        return self._format(self.last)
+
+    def append(self, event):
+        """Add an event to the log, returning its sequence id."""
+        self.last += 1
+        seq = self._format(self.last)
+        self._events.append((self.last, seq, event))
+        return seq
+
+    def since(self, seq):
+        """
+        Return a list of ``(seq, event)`` tuples for the events following the
+        passed sequence id, in order, or None if they are not all available.
+        """
+        if not isinstance(seq, basestring):
+            return None
+        epoch, _, n = seq.rpartition(':')
+        if epoch != self.epoch:
+            return None
+        try:
+            n = int(n)
+        except ValueError:
+            return None
+        if n < 0 or n > self.last:
+            return None
+        oldest = self._events[0][0] if self._events else self.last + 1
+        if n < oldest - 1:
+            return None
+        return [(s, event) for k, s, event in self._events if k > n]
+
+    def _format(self, n):
+        return '{}:{}'.format(self.epoch, n)
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+def _parse_event(body):
+    """
+    Parse an annotation event message body.
+
+    Returns a tuple of the decoded event data and the JSON text of the
+    annotation exactly as it appears in the body, so that it can be passed on
+    to clients without being encoded again.
+    """
+    try:
+        return _split_event(body)
+    except (ValueError, IndexError):
+        data = json.loads(body)
+        return data, json.dumps(data['annotation'])
+
+
+def _split_event(body):
+    # Walk the members of the top-level object, noting the span of the
+    # annotation's value.
+    data = {}
+    raw = None
+    idx = _whitespace.match(body, 0).end()
+    if body[idx] != '{':
+        raise ValueError('event is not a JSON object')
+    idx = _whitespace.match(body, idx + 1).end()
+    while body[idx] != '}':
+        if body[idx] != '"':
+            raise ValueError('expected a member name')
+        key, idx = json.decoder.scanstring(body, idx + 1)
+        idx = _whitespace.match(body, idx).end()
+        if body[idx] != ':':
+            raise ValueError('expected a name separator')
+        idx = _whitespace.match(body, idx + 1).end()
+        value, end = _decoder.raw_decode(body, idx)
+        if key == 'annotation':
+            raw = body[idx:end]
+        data[key] = value
+        idx = _whitespace.match(body, end).end()
+        if body[idx] == ',':
+            idx = _whitespace.match(body, idx + 1).end()
+        elif body[idx] != '}':
+            raise ValueError('expected a member separator')
+    if _whitespace.match(body, idx + 1).end() != len(body):
+        raise ValueError('extra data after event')
+    if raw is None:
+        raise ValueError('event has no annotation')
+    return data, raw
+
+
+def broadcast_from_queue(queue, subscriptions, replay=None, stats=None):
+    """
+    Pulls messages from a passed queue object, and handles dispatching them to
+    appropriate active sessions.
+
+    Only the sockets which the passed :py:class:`SubscriptionIndex` reports as
+    candidates for each annotation are considered. The annotation's JSON is
+    passed through to clients as it was received, rather than being decoded
+    and encoded again.
+
+    If a :py:class:`ReplayBuffer` is passed, each event is recorded in it and
+    sent with its sequence id.
+
+    Each distinct packet is built once and shared by the sockets it is sent
+    to. The annotation is only encoded as msgpack if some socket using the
+    msgpack subprotocol receives it.
+
+    If a :py:class:`StreamerStats` is passed, the fanout of each event is
+    recorded in it.
+    """
+    for message in queue:
+        start = time.time()
+        checked = notified = 0
+        if isinstance(message, ParsedMessage):
+            data_in, raw = message.event
+            if 'annotation' not in data_in:
+                # Events from the event ring only carry the annotation's JSON
+                # text, which is decoded here, once per process.
+                data_in = dict(data_in, annotation=json.loads(raw))
+        else:
+            data_in, raw = _parse_event(message.body)
+        action = data_in['action']
+        annotation = Annotation(**data_in['annotation'])
+        seq = None
+        if replay is not None and action != 'read':
+            seq = replay.append((data_in, annotation, raw))
+        context = MatchContext(annotation)
+        encoded = {False: raw}
+        frames = {}
+        for socket in subscriptions.candidates(context):
+            checked += 1
+            if not socket.named_filters:
+                if not should_send_event(socket, annotation, data_in,
+                                         context):
+                    continue
+                matched = None
+            else:
+                # Sockets with named subscriptions are told which of them the
+                # event matches.
+                matched = matching_subscriptions(socket, annotation, data_in,
+                                                 context)
+                if not matched:
+                    continue
+            binary = socket.binary
+            if binary not in encoded:
+                encoded[binary] = subprotocol.packb(data_in['annotation'])
+            key = (binary, tuple(matched) if matched is not None else None)
+            frame = frames.get(key)
+            if frame is None:
+                build = (subprotocol.annotation_frame if binary
+                         else _annotation_frame)
+                frame = frames[key] = build([encoded[binary]], action, seq,
+                                            matched)
+            socket.notify(annotation, action, frame, encoded[binary], seq,
+                          matched)
+            notified += 1
+        if stats is not None:
+            stats.record_event(time.time() - start, checked, notified,
+                               queue.qsize())
+
+
+class ParsedMessage(object):
+    """
+    A queued event which has already been parsed, as by
+    :py:func:`_parse_event`.
+    """
+
+    __slots__ = ('event',)
+
+    def __init__(self, event):
+        self.event = event
+
+
+def _dump_event(event):
+    """
+    Encode a parsed event, as returned by :py:func:`_parse_event`, for the
+    event ring.
+
+    The record is the JSON of the event data without the annotation, a
+    newline, and the JSON text of the annotation as it is. The annotation is
+    stored once, and is neither encoded again here nor decoded by
+    :py:func:`_load_event`.
+    """
+    data, raw = event
+    data = dict((k, v) for k, v in data.iteritems() if k != 'annotation')
+    return json.dumps(data) + '\n' + raw
+
+
+def _load_event(record):
+    """
+    Decode an event from the event ring, as encoded by :py:func:`_dump_event`.
+
+    Returns a tuple of the event data, without the annotation, and the JSON
+    text of the annotation, which :py:func:`broadcast_from_queue` decodes.
+    Raises ValueError if the record is not a valid event.
+    """
+    data, sep, raw = record.partition('\n')
+    if not sep:
+        raise ValueError('event ring record has no annotation')
+    data = json.loads(data)
+    if not isinstance(data, dict):
+        raise ValueError('event ring record has no event data')
+    return data, raw
+
+
+def read_event_ring(ring, queue, interval):
+    """
+    Poll the passed :py:class:`h.streamer.eventring.RingReader` for parsed
+    events, putting them on the passed queue.
+
+    Records which cannot be decoded are logged and skipped. If the ring
+    cannot be read, the error is logged and the reader starts again from the
+    writer's current position.
+    """
+    while True:
+        try:
+            for record in ring.read():
+                try:
+                    event = _load_event(record)
+                except ValueError:
+                    log.exception("could not decode event from the event "
+                                  "ring")
+                    continue
+                queue.put(ParsedMessage(event))
+        except Exception:
+            log.exception("could not read the event ring")
+            ring.reset()
+        gevent.sleep(interval)
+
+
+def event_ring_writer(request):
+    """
+    Read annotation events from NSQ and write them, parsed, to this host's
+    event ring, for every streamer process on the host to read.
+
+    This lets the streamer processes on a host share a single NSQ reader and
+    the work of parsing each event. It is run as a worker (see
+    :py:mod:`h.worker`) and used by setting ``h.streamer.event_ring.path``
+    for both the worker and the web application.
+    """
+    settings = request.registry.settings
+    ring = eventring.RingWriter(
+        settings['h.streamer.event_ring.path'],
+        capacity=int(settings.get('h.streamer.event_ring.size', 16 << 20)))
+
+    def handle_message(reader, message=None):
+        if message is None:
+            return
+        try:
+            ring.append(_dump_event(_parse_event(message.body)))
+        except Exception:
+            log.exception("could not add event to the event ring")
+
+    reader_id = 'stream-ring-{}#ephemeral'.format(_random_id())
+    reader = request.get_queue_reader(_event_topic(settings), reader_id)
+    reader.on_message.connect(handle_message)
+    reader.start(block=True)
+
+
+def should_send_event(socket, annotation, event_data, context=None):
+    """
+    Inspects the passed annotation and action and decides whether or not
+    the underlying session should receive the event. If it should, the
+    action is wrapped up in a websocket packet and sent to the client.
+
+    If a :py:class:`MatchContext` for the annotation is passed, the socket's
+    filter is evaluated against it, sharing folded field values and the
+    filter's result with every other socket checked against the same event.
+    """
+    return bool(matching_subscriptions(socket, annotation, event_data,
+                                       context))
+
+
+def matching_subscriptions(socket, annotation, event_data, context=None):
+    """
+    Return the list of the socket's subscriptions which should receive the
+    event, as for :py:func:`should_send_event`.
+
+    The filter set by a "filter" message is represented by None, and named
+    subscriptions by their ids. The list is empty if the event should not be
+    sent at all.
+    """
+    if socket.terminated:
+        return []
+
+    if event_data['action'] == 'read':
+        return []
+
+    if event_data['src_client_id'] == socket.client_id:
+        return []
+
+    # We don't send anything until we have received a filter from the client
+    named = socket.named_filters
+    if socket.filter is None and not named:
+        return []
+
+    if not _has_read_permission(socket, annotation, context):
+        return []
+
+    if annotation.get('nipsa') and (
+            socket.state.userid != annotation.get('user', '')):
+        return []
+
+    action = event_data['action']
+    if context is not None:
+        match = lambda f: context.matches(f, action)
+    else:
+        match = lambda f: f.match(annotation, action)
+
+    matched = []
+    if socket.filter is not None and match(socket.filter):
+        matched.append(None)
+    if named:
+        matched.extend(sorted(sid for sid, f in named.iteritems() if match(f)))
+    return matched
+
+
+def _has_read_permission(socket, annotation, context=None):
+    """Return whether the socket may read the annotation."""
+    return socket.state.has_permission('read', annotation, context)
+
+
+def _random_id():
+    """Generate a short random string"""
+    data = struct.pack('Q', random.getrandbits(64))
+    return base64.urlsafe_b64encode(data).strip(b'=')
@@ -1,32 +1,20 @@
 # -*- coding: utf-8 -*-
-import base64
+"""
+Websocket filters: their schema, their translation into Elasticsearch
+queries, and their compiled form, which is matched against each annotation
+event.
+"""
 import copy
 import json
-import logging
 import operator
-import random
 import re
-import struct
 import unicodedata
 import weakref
 
-import gevent
-import gevent.queue
-from jsonpointer import resolve_pointer
-from jsonschema import validate
-from pyramid.config import aslist
-from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
-from pyramid.threadlocal import get_current_request
-from ws4py.exc import HandshakeError
-from ws4py.websocket import WebSocket as _WebSocket
-from ws4py.server.wsgiutils import WebSocketWSGIApplication
-
-from .api.auth import get_user  # FIXME: should not import from .api
-from h.api import nipsa
-from h.api import uri
-from .models import Annotation
+from jsonpointer import JsonPointer, resolve_pointer
+from jsonschema import Draft4Validator
 
-log = logging.getLogger(__name__)
+from h.api import nipsa
 
 
 def uni_fold(text):
@@ -42,6 +30,7 @@ def uni_fold(text):
     text = unicodedata.normalize('NFKD', text)
     return u"".join([c for c in text if not unicodedata.combining(c)])
 
+
 filter_schema = {
     "type": "object",
     "properties": {
@@ -74,6 +63,8 @@ filter_schema = {
     "required": ["match_policy", "clauses", "actions"]
 }
 
+filter_validator = Draft4Validator(filter_schema)
+
 len_operators = {
     "lene": "=",
     "leng": ">",
@@ -429,197 +420,259 @@ class FilterHandler(object):
             return False
 
 
-class WebSocket(_WebSocket):
-    # Class attributes
-    event_queue = None
-    instances = weakref.WeakSet()
-    origins = []
-
-    # Instance attributes
-    client_id = None
-    filter = None
-    request = None
-    query = None
-
-    def __init__(self, *args, **kwargs):
-        kwargs.setdefault('heartbeat_freq', 30.0)
-        super(WebSocket, self).__init__(*args, **kwargs)
-        self.request = get_current_request()
-
-    def __new__(cls, *args, **kwargs):
-        instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
-        cls.instances.add(instance)
-        return instance
-
-    @classmethod
-    def start_reader(cls, request):
-        if cls.event_queue is not None:
-            return
-        cls.event_queue = gevent.queue.Queue()
-        reader_id = 'stream-{}#ephemeral'.format(_random_id())
-        reader = request.get_queue_reader('annotations', reader_id)
-        reader.on_message.connect(cls.on_queue_message)
-        reader.start(block=False)
-        gevent.spawn(broadcast_from_queue, cls.event_queue, cls.instances)
-
-    @classmethod
-    def on_queue_message(cls, reader, message=None):
-        if message is not None:
-            cls.event_queue.put(message)
-
-    def opened(self):
-        # The websocket server runs regardless, but we don't attempt to connect
-        # to NSQ unless 'streamer' is toggled on.
-        if self.request.feature('streamer'):
-            self.start_reader(self.request)
-
-        # Store the user
-        self.user = get_user(self.request)
-
-        # Release the database transaction
-        self.request.tm.commit()
-
-    def send_annotations(self):
-        user = self.user
-        annotations = Annotation.search_raw(query=self.query.query, user=user)
-        packet = _annotation_packet(annotations, 'past')
-        data = json.dumps(packet)
-        self.send(data)
-
-    def _expand_clauses(self, payload):
-        for clause in payload['clauses']:
-            if clause['field'] == '/uri':
-                self._expand_uris(clause)
-
-    def _expand_uris(self, clause):
-        uris = clause['value']
-        expanded = set()
-
-        if not isinstance(uris, list):
-            uris = [uris]
-
-        for item in uris:
-            expanded.update(uri.expand(item))
-
-        clause['value'] = list(expanded)
-
-    def received_message(self, msg):
-        with self.request.tm:
-            self._process_message(msg)
-
-    def _process_message(self, msg):
-        try:
-            data = json.loads(msg.data)
-            msg_type = data.get('messageType', 'filter')
+class CompiledFilter(object):
+    """
+    A precompiled equivalent of :py:class:`FilterHandler`.
+
+    FilterHandler interprets the filter JSON for every clause of every event:
+    copying clauses, parsing JSON pointers, folding clause values and looking
+    up operators. CompiledFilter does all of that once, when the filter is
+    received, and turns each clause into a closure over the prepared values.
+    The results of :py:meth:`match` are identical to those of
+    :py:meth:`FilterHandler.match`.
+    """
 
-            if msg_type == 'filter':
-                payload = data['filter']
+    def __init__(self, filter_json):
+        self.filter = filter_json
+        self.actions = frozenset(filter_json['actions'])
+        self.clauses = tuple(_compile_clause(c)
+                             for c in filter_json['clauses'])
+        if self.clauses:
+            self._policy = getattr(self, filter_json['match_policy'])
+        else:
+            self._policy = _match_everything
 
-                # Let's try to validate the schema
-                validate(payload, filter_schema)
+    # match_policies
+    def include_any(self, target):
+        for clause in self.clauses:
+            if clause(target):
+                return True
+        return False
 
-                # Add backend expands for clauses
-                self._expand_clauses(payload)
+    def include_all(self, target):
+        for clause in self.clauses:
+            if not clause(target):
+                return False
+        return True
 
-                self.filter = FilterHandler(payload)
-                self.query = FilterToElasticFilter(payload, self.request)
-            elif msg_type == 'client_id':
-                self.client_id = data.get('value')
-        except:
-            # TODO: clean this up, catch specific errors, narrow the scope
-            log.exception("Parsing filter: %s", msg)
-            self.close()
-            raise
+    def exclude_all(self, target):
+        return not self.include_all(target)
 
+    def exclude_any(self, target):
+        return not self.include_any(target)
 
-def _annotation_packet(annotations, action):
-    """
-    Generate a packet suitable for sending down the websocket that represents
-    the specified action applied to the passed annotations.
-    """
-    return {
-        'payload': annotations,
-        'type': 'annotation-notification',
-        'options': {'action': action},
-    }
+    def match(self, target, action=None):
+        """
+        Return whether the target matches the filter.
+
+        The target may be an annotation or a :py:class:`MatchContext`
+        wrapping one.
+        """
+        if not action or action == 'past' or action in self.actions:
+            if not isinstance(target, MatchContext):
+                target = MatchContext(target)
+            return self._policy(target)
+        return False
+
+
+def _match_everything(target):
+    return True
+
+
+_compiled_filters = weakref.WeakValueDictionary()
 
 
-def broadcast_from_queue(queue, sockets):
+def compile_filter(filter_json):
     """
-    Pulls messages from a passed queue object, and handles dispatching them to
-    appropriate active sessions.
+    Return a :py:class:`CompiledFilter` for the passed filter.
+
+    Sockets with equivalent filters (as with every sidebar open on the same
+    page) share a single instance, which lets :py:class:`MatchContext`
+    evaluate it once per event on behalf of all of them.
     """
-    for message in queue:
-        data_in = json.loads(message.body)
-        action = data_in['action']
-        annotation = Annotation(**data_in['annotation'])
-        payload = _annotation_packet([annotation], action)
-        data_out = json.dumps(payload)
-        for socket in list(sockets):
-            if should_send_event(socket, annotation, data_in):
-                socket.send(data_out)
-
-
-def should_send_event(socket, annotation, event_data):
+    key = _filter_key(filter_json)
+    compiled = _compiled_filters.get(key)
+    if compiled is None:
+        compiled = _compiled_filters[key] = CompiledFilter(filter_json)
+    return compiled
+
+
+def _filter_key(filter_json):
     """
-    Inspects the passed annotation and action and decides whether or not
-    the underlying session should receive the event. If it should, the
-    action is wrapped up in a websocket packet and sent to the client.
+    Return a canonical serialization of the parts of a filter which affect
+    what it matches.
     """
-    if socket.terminated:
-        return False
+    return json.dumps([filter_json['match_policy'],
+                       sorted(filter_json['actions']),
+                       filter_json['clauses']],
+                      sort_keys=True, separators=(',', ':'))
 
-    if event_data['action'] == 'read':
-        return False
 
-    if event_data['src_client_id'] == socket.client_id:
-        return False
+def _fold(value):
+    if isinstance(value, list):
+        return [uni_fold(v) for v in value]
+    return uni_fold(value)
 
-    if not socket.request.has_permission('read', annotation):
-        return False
 
-    if annotation.get('nipsa') and (
-            socket.request.authenticated_userid != annotation.get('user', '')):
-        return False
+class MatchContext(object):
+    """
+    The state shared by every filter checked against a single event.
 
-    # We don't send anything until we have received a filter from the client
-    if socket.filter is None:
-        return False
+    Each field of the annotation is resolved and Unicode-folded the first time
+    any filter asks for it, and the result is reused for every other socket
+    the event is checked against.
+    """
 
-    if not socket.filter.match(annotation, event_data['action']):
-        return False
+    def __init__(self, annotation):
+        self.annotation = annotation
+        self._folded = {}
+        self._matched = {}
+        self._permitted = {}
 
-    return True
+    def folded(self, path, resolve=None):
+        """
+        Return the folded value of the field at the given JSON pointer, or
+        None if the annotation has no such field.
+
+        The optional `resolve` argument is a precompiled resolver for `path`,
+        as returned by :py:func:`_compile_pointer`.
+        """
+        try:
+            return self._folded[path]
+        except KeyError:
+            pass
+
+        if resolve is None:
+            resolve = _compile_pointer(path)
+        value = resolve(self.annotation)
+        if value is not None:
+            value = _fold(value)
+        self._folded[path] = value
+        return value
+
+    def matches(self, filter, action=None):
+        """
+        Return whether the passed filter matches the annotation.
+
+        The result is computed once per filter and action, however many
+        sockets share the filter.
+        """
+        key = (filter, action)
+        try:
+            return self._matched[key]
+        except KeyError:
+            pass
+        result = filter.match(self, action)
+        self._matched[key] = result
+        return result
+
+    def permits(self, principals, permission, policy):
+        """
+        Return whether the given set of principals has the named permission
+        on the annotation, according to the passed authorization policy.
+
+        The decision is made once per distinct principal set and permission,
+        however many sockets share them.
+        """
+        key = (principals, permission)
+        try:
+            return self._permitted[key]
+        except KeyError:
+            pass
+        result = bool(policy.permits(self.annotation, principals, permission))
+        self._permitted[key] = result
+        return result
 
 
-def _random_id():
-    """Generate a short random string"""
-    data = struct.pack('Q', random.getrandbits(64))
-    return base64.urlsafe_b64encode(data).strip(b'=')
+def _compile_clause(clause):
+    """
+    Return a predicate over :py:class:`MatchContext` objects equivalent to the
+    given clause.
+    """
+    path = clause['field']
+    if isinstance(path, list):
+        predicates = [_compile_clause(dict(clause, field=f)) for f in path]
+        return lambda context: any(p(context) for p in predicates)
+
+    resolve = _compile_pointer(path)
+    test = _compile_test(clause['operator'], _fold(clause['value']))
 
+    def predicate(context):
+        value = context.folded(path, resolve)
+        if value is None:
+            return False
+        return test(value)
+    return predicate
 
-def websocket(request):
-    # WebSockets can be opened across origins and send cookies. To prevent
-    # scripts on other sites from using this socket, ensure that the Origin
-    # header (if present) matches the request host URL or is whitelisted.
-    origin = request.headers.get('Origin')
-    allowed = getattr(request.registry, 'websocket_origins', [])
-    if origin is not None:
-        if origin != request.host_url and origin not in allowed:
-            return HTTPForbidden()
-    return request.get_response(request.registry.websocket)
 
+def _compile_pointer(path):
+    """
+    Return a function resolving the given JSON pointer against a document,
+    returning None if the pointer cannot be resolved.
+    """
+    pointer = JsonPointer(path)
+    parts = tuple(pointer.parts)
+
+    def resolve(doc):
+        target = doc
+        for part in parts:
+            if not isinstance(target, dict):
+                # Leave list indexing and error handling to jsonpointer.
+                return pointer.resolve(doc, None)
+            if part not in target:
+                return None
+            target = target[part]
+        return target
+    return resolve
+
+
+def _compile_test(name, cval):
+    """
+    Return a test of a folded field value against the folded clause value
+    `cval` for the named operator.
 
-def bad_handshake(exc, request):
-    log.error("streamer websocket handshake error: %s", exc)
-    return HTTPBadRequest()
+    The semantics, including the argument order rules for the containment
+    operators, mirror :py:meth:`FilterHandler.evaluate_clause`.
+    """
+    if name in ('one_of', 'matches'):
+        if not isinstance(cval, list):
+            return lambda fval: cval in fval
 
+        members = _frozenset_or_none(cval)
 
-def includeme(config):
-    origins = aslist(config.registry.settings.get('origins', ''))
-    config.registry.websocket = WebSocketWSGIApplication(handler_cls=WebSocket)
-    config.registry.websocket_origins = origins
-    config.add_route('ws', 'ws')
-    config.add_view(websocket, route_name='ws')
-    config.add_view(bad_handshake, context=HandshakeError)
-    config.scan(__name__)
+        def contains(fval):
+            if isinstance(fval, list):
+                return cval in fval
+            if members is not None and _hashable(fval):
+                return fval in members
+            return fval in cval
+        return contains
+
+    if name == 'match_of':
+        members = None
+        if isinstance(cval, list):
+            members = _frozenset_or_none(cval)
+
+        def match_of_(fval):
+            if members is not None and isinstance(fval, list):
+                return any(v in members for v in fval if _hashable(v))
+            return match_of(fval, cval)
+        return match_of_
+
+    op = getattr(operator, FilterHandler.operators[name])
+    return lambda fval: op(fval, cval)
+
+
+def _frozenset_or_none(values):
+    try:
+        return frozenset(values)
+    except TypeError:
+        return None
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""The packets sent to websocket clients about annotation events."""
+import json
+
+
+def _annotation_packet(annotations, action):
+    """
+    Generate a packet suitable for sending down the websocket that represents
+    the specified action applied to the passed annotations.
+    """
+    return {
+        'payload': annotations,
+        'type': 'annotation-notification',
+        'options': {'action': action},
+    }
+
+
+# Strings which can never appear in the output of json.dumps, used to find
+# where serialized annotations, sequence ids and subscription ids belong
+# within an encoded packet.
+_FRAME_PLACEHOLDER = u'\x00annotations\x00'
+_SEQ_PLACEHOLDER = u'\x00seq\x00'
+_SUBSCRIPTIONS_PLACEHOLDER = u'\x00subscriptions\x00'
+_frame_envelopes = {}
+
+
+def _annotation_frame(raw_annotations, action, seq=None, subscriptions=None):
+    """
+    Return the serialized packet for the specified action applied to the
+    passed annotations, which are already serialized as JSON.
+
+    This is equivalent to ``json.dumps(_annotation_packet(...))``, but the
+    annotations are spliced into a prebuilt envelope rather than encoded
+    again. If `seq` is given, it is included in the packet's options, as is
+    the list of `subscriptions` the annotations match, if given.
+    """
+    key = (action, seq is not None, subscriptions is not None)
+    try:
+        segments = _frame_envelopes[key]
+    except KeyError:
+        packet = _annotation_packet([_FRAME_PLACEHOLDER], action)
+        placeholders = []
+        if seq is not None:
+            packet['options']['seq'] = _SEQ_PLACEHOLDER
+            placeholders.append(_SEQ_PLACEHOLDER)
+        if subscriptions is not None:
+            packet['options']['subscriptions'] = _SUBSCRIPTIONS_PLACEHOLDER
+            placeholders.append(_SUBSCRIPTIONS_PLACEHOLDER)
+        placeholders.append(_FRAME_PLACEHOLDER)
+        # With sorted keys, the placeholders always appear in this order.
+        text = json.dumps(packet, sort_keys=True)
+        segments = []
+        for placeholder in placeholders:
+            before, _, text = text.partition(json.dumps(placeholder))
+            segments.append(before)
+        segments.append(text)
+        _frame_envelopes[key] = segments
+    values = []
+    if seq is not None:
+        values.append(json.dumps(seq))
+    if subscriptions is not None:
+        values.append(json.dumps(subscriptions))
+    values.append(', '.join(raw_annotations))
+    parts = [segments[0]]
+    for value, segment in zip(values, segments[1:]):
+        parts.append(value)
+        parts.append(segment)
+    return ''.join(parts)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+An index of websockets by the clauses of their filters, which decides which
+sockets need to be checked against each annotation event.
+"""
+import bisect
+import collections
+import weakref
+
+from h.streamer.filters import MatchContext, _hashable, uni_fold
+
+
+#: An index key for a range or length clause of a socket filter.
+RangeKey = collections.namedtuple('RangeKey', ['field', 'operator', 'value'])
+
+
+class RangeColumn(object):
+    """
+    The thresholds of every indexed socket filter clause with a given field
+    and range or length operator, kept sorted.
+
+    Rather than comparing each socket's threshold with an annotation's field
+    in turn, a single bisection of the column finds the contiguous run of
+    sockets whose clause the field satisfies.
+    """
+
+    #: The comparison made by each operator, as the side of the annotation's
+    #: value on which the satisfied thresholds lie.
+    sides = {
+        'lt': 'above', 'le': 'above_or_equal',
+        'gt': 'below', 'ge': 'below_or_equal',
+        'lenl': 'above', 'lenle': 'above_or_equal',
+        'leng': 'below', 'lenge': 'below_or_equal',
+        'lene': 'equal',
+    }
+
+    def __init__(self, field, operator_):
+        self.field = field
+        self.length = operator_.startswith('len')
+        self.side = self.sides[operator_]
+        self._keys = []
+        self._sockets = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, socket, value):
+        key = (value, id(socket))
+        index = bisect.bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._sockets.insert(index, weakref.ref(socket))
+
+    def discard(self, socket, value):
+        key = (value, id(socket))
+        index = bisect.bisect_left(self._keys, key)
+        # A socket which was garbage collected without being discarded may
+        # have left an entry with the same key behind.
+        while index < len(self._keys) and self._keys[index] == key:
+            if self._sockets[index]() in (socket, None):
+                del self._keys[index]
+                del self._sockets[index]
+            else:
+                index += 1
+
+    def matching(self, value):
+        """
+        Return the sockets whose clause is satisfied by the passed folded
+        field value.
+
+        If the value cannot be compared with the column's thresholds in the
+        way :py:class:`FilterHandler` would compare it, every socket in the
+        column is returned for its filter to decide.
+        """
+        if value is None:
+            # A clause on a missing field is never satisfied.
+            return []
+        refs = self._sockets
+        if self.length:
+            try:
+                value = len(value)
+            except TypeError:
+                value = None
+        if value is not None and _comparable(value):
+            low = bisect.bisect_left(self._keys, (value,))
+            high = bisect.bisect_right(self._keys, (value, _MAX_KEY))
+            if self.side == 'above':
+                refs = refs[high:]
+            elif self.side == 'above_or_equal':
+                refs = refs[low:]
+            elif self.side == 'below':
+                refs = refs[:low]
+            elif self.side == 'below_or_equal':
+                refs = refs[:high]
+            else:
+                refs = refs[low:high]
+        return [s for s in (r() for r in refs) if s is not None]
+
+
+_MAX_KEY = float('inf')
+
+
+def _comparable(value):
+    # Thresholds of each kind are kept in separate columns, and values of
+    # different kinds are ordered consistently, so the ordering of a column
+    # agrees with the comparison operators for any string or number.
+    return isinstance(value, (basestring, int, long, float))
+
+
+def _range_kind(value):
+    if isinstance(value, basestring):
+        return 'text'
+    return 'number'
+
+
+class SubscriptionIndex(object):
+    """
+    An inverted index of websockets keyed by the equality clauses of their
+    filters.
+
+    Most clients subscribe with filters such as "/uri is one of [...]", which
+    can only ever match annotations carrying one of a handful of known values.
+    Indexing sockets by those values means that, for each event, only the
+    sockets whose filters could possibly match need to be inspected. Sockets
+    whose filters cannot be indexed (exclusion policies, substring operators,
+    empty clause lists, ...) are kept in a fallback bucket and are always
+    considered candidates.
+
+    Range and length clauses ("/created is greater than ...") are indexed in
+    a :py:class:`RangeColumn` for each field, operator and kind of threshold,
+    so a time-window filter costs one bisection per event for all of the
+    sockets using one, rather than a check for each of them.
+    """
+
+    #: The fields by which socket filters can be indexed.
+    fields = ('/uri', '/user', '/tags')
+
+    def __init__(self):
+        self._buckets = {}
+        self._columns = {}
+        self._fallback = weakref.WeakSet()
+        self._keys = weakref.WeakKeyDictionary()
+
+    def __iter__(self):
+        return iter(list(self._keys.keys()))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, socket):
+        """(Re)index the passed socket according to its current filter."""
+        self.discard(socket)
+
+        keys = self.keys_for_socket(socket)
+        self._keys[socket] = keys
+        if keys is None:
+            self._fallback.add(socket)
+            return
+        for key in keys:
+            if isinstance(key, RangeKey):
+                column = self._columns.get(self._column_key(key))
+                if column is None:
+                    column = RangeColumn(key.field, key.operator)
+                    self._columns[self._column_key(key)] = column
+                column.add(socket, key.value)
+                continue
+            self._buckets.setdefault(key, weakref.WeakSet()).add(socket)
+
+    def discard(self, socket):
+        """Remove the passed socket from the index, if present."""
+        keys = self._keys.pop(socket, None)
+        self._fallback.discard(socket)
+        if keys is None:
+            return
+        for key in keys:
+            if isinstance(key, RangeKey):
+                column_key = self._column_key(key)
+                column = self._columns.get(column_key)
+                if column is None:
+                    continue
+                column.discard(socket, key.value)
+                if not column:
+                    del self._columns[column_key]
+                continue
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(socket)
+            if not bucket:
+                del self._buckets[key]
+
+    def candidates(self, target):
+        """
+        Return the set of sockets whose filters could match the passed
+        annotation or :py:class:`MatchContext`.
+
+        This is a superset of the matching sockets: the caller must still
+        check each candidate's filter.
+        """
+        if not isinstance(target, MatchContext):
+            target = MatchContext(target)
+        result = set(self._fallback)
+        for key in self.keys_for_context(target):
+            bucket = self._buckets.get(key)
+            if bucket:
+                result.update(bucket)
+        for column in self._columns.itervalues():
+            result.update(column.matching(target.folded(column.field)))
+        return result
+
+    @staticmethod
+    def _column_key(key):
+        return (key.field, key.operator, _range_kind(key.value))
+
+    @classmethod
+    def keys_for_context(cls, context):
+        keys = set()
+        for field in cls.fields:
+            value = context.folded(field)
+            if value is None:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            for item in value:
+                if _hashable(item):
+                    keys.add((field, item))
+        return keys
+
+    @classmethod
+    def keys_for_socket(cls, socket):
+        """
+        Return the index keys for all of the passed socket's filters, or None
+        if any of them cannot be indexed.
+        """
+        filters = []
+        if socket.filter is not None:
+            filters.append(socket.filter)
+        filters.extend((getattr(socket, 'named_filters', None) or {}).values())
+        if len(filters) < 2:
+            return cls.keys_for_filter(filters[0] if filters else None)
+        keys = [cls.keys_for_filter(f) for f in filters]
+        if None in keys:
+            return None
+        return frozenset().union(*keys)
+
+    @classmethod
+    def keys_for_filter(cls, filter_handler):
+        """
+        Return the index keys for the passed FilterHandler, or None if the
+        filter cannot be indexed and must be checked against every event.
+        """
+        filter_json = getattr(filter_handler, 'filter', None)
+        if not isinstance(filter_json, dict):
+            return None
+
+        clauses = filter_json.get('clauses') or []
+        policy = filter_json.get('match_policy')
+        clause_keys = [cls._keys_for_clause(c) for c in clauses]
+
+        if not clause_keys:
+            return None
+
+        # An annotation matching an "include_any" filter must satisfy at least
+        # one of its clauses, so we can only index the filter if every clause
+        # can be indexed.
+        if policy == 'include_any':
+            if None in clause_keys:
+                return None
+            return frozenset().union(*clause_keys)
+
+        # An annotation matching an "include_all" filter must satisfy all of
+        # its clauses, so indexing by any single one of them will do.
+        if policy == 'include_all':
+            indexable = [k for k in clause_keys if k is not None]
+            if not indexable:
+                return None
+            # Prefer the equality clauses, which are usually more selective.
+            return min(indexable, key=lambda keys: (
+                any(isinstance(k, RangeKey) for k in keys), len(keys)))
+
+        return None
+
+    @classmethod
+    def _keys_for_clause(cls, clause):
+        if not isinstance(clause, dict):
+            return None
+
+        field = clause.get('field')
+        operator_ = clause.get('operator')
+        value = clause.get('value')
+
+        if (operator_ in RangeColumn.sides and isinstance(field, basestring)
+                and _comparable(value)):
+            if operator_.startswith('len') and isinstance(value, basestring):
+                return None
+            return frozenset([RangeKey(field, operator_, uni_fold(value))])
+
+        if field not in cls.fields:
+            return None
+
+        # These are the only operator/value combinations for which
+        # FilterHandler.evaluate_clause is an equality or membership test
+        # rather than, say, a substring or range comparison.
+        if operator_ == 'equals' and not isinstance(value, list):
+            values = [value]
+        elif operator_ == 'one_of' and isinstance(value, list):
+            values = value
+        elif (operator_ == 'match_of' and isinstance(value, list) and
+              field == '/tags'):
+            values = value
+        else:
+            return None
+
+        keys = set()
+        for item in values:
+            if not isinstance(item, (basestring, int, long, float)):
+                return None
+            keys.add((field, uni_fold(item)))
+        return frozenset(keys)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""The settings of a sharded streamer, and the shards of websocket filters."""
+from h.api.queue import shard_for_uri, shard_topic
+
+
+def _event_topic(settings):
+    """Return the NSQ topic carrying the events for this streamer."""
+    # A shard only reads the events for the documents its clients can be
+    # watching.
+    shard, _ = _shard_settings(settings)
+    if shard is None:
+        return 'annotations'
+    return shard_topic(shard)
+
+
+def _shard_settings(settings):
+    """
+    Return a tuple of the shard served by this process, or None if it serves
+    every client, and the total number of shards.
+    """
+    shards = int(settings.get('h.streamer.shards', 1))
+    shard = settings.get('h.streamer.shard')
+    if shard is None or shards < 2:
+        return None, shards
+    shard = int(shard)
+    if not 0 <= shard < shards:
+        raise ValueError('h.streamer.shard must be less than '
+                         'h.streamer.shards')
+    return shard, shards
+
+
+def _filter_shard(filter_json, shards):
+    """
+    Return the shard which receives every event the passed filter could
+    match, or None if there is no such shard.
+
+    Only filters which can only match annotations of the documents at a known
+    set of URIs, all of which belong to the same shard, can be served by a
+    single shard. This must be decided before the filter's URIs are expanded:
+    events are published to the shards of all URIs of a document, so the
+    shard of any one of them will do.
+    """
+    uri_clauses = []
+    for clause in filter_json['clauses']:
+        if clause['field'] == '/uri' and \
+                clause['operator'] in ('equals', 'one_of'):
+            uri_clauses.append(clause)
+        elif filter_json['match_policy'] == 'include_any':
+            return None
+
+    if filter_json['match_policy'] == 'include_any':
+        candidates = [[v for c in uri_clauses for v in _as_list(c['value'])]]
+    elif filter_json['match_policy'] == 'include_all':
+        candidates = [_as_list(c['value']) for c in uri_clauses]
+    else:
+        return None
+
+    for uris in candidates:
+        found = set(shard_for_uri(u, shards) for u in uris)
+        if len(found) == 1:
+            return found.pop()
+    return None
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
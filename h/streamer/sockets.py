@@ -0,0 +1,643 @@
+# -*- coding: utf-8 -*-
+"""The streamer's websockets."""
+import json
+import logging
+import os
+import weakref
+
+import gevent
+import gevent.lock
+import gevent.queue
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.threadlocal import get_current_request
+from ws4py.websocket import WebSocket as _WebSocket
+
+from h.api.auth import get_user  # FIXME: should not import from h.api
+from h.api.search import query as search_query
+from h.models import Annotation
+from h.stats import get_client as stats_client
+from h.streamer import deflate
+from h.streamer import eventring
+from h.streamer import subprotocol
+from h.streamer.cache import ExpansionCache
+from h.streamer.delivery import DeliveryWindow, SendQueue
+from h.streamer.delivery import send_queue_counters
+from h.streamer.events import ReplayBuffer, _random_id
+from h.streamer.events import broadcast_from_queue, read_event_ring
+from h.streamer.events import matching_subscriptions, should_send_event
+from h.streamer.filters import FilterToElasticFilter, MatchContext
+from h.streamer.filters import compile_filter, filter_validator
+from h.streamer.frames import _annotation_frame, _annotation_packet
+from h.streamer.index import SubscriptionIndex
+from h.streamer.shards import _event_topic, _filter_shard, _shard_settings
+from h.streamer.stats import StreamerStats, report_stats
+from h.streamer.timers import TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+#: The default and maximum number of past annotations sent per page.
+PAST_PAGE_SIZE = 20
+PAST_PAGE_SIZE_MAX = 200
+
+
+class SocketState(object):
+    """
+    What a websocket needs to know about the request which opened it.
+
+    A socket lives far longer than the request for its handshake, so rather
+    than keeping the request (along with its environ, session and database
+    session) alive for as long as the socket is open, the socket keeps a
+    snapshot of the few things it needs.
+    """
+
+    __slots__ = ('registry', 'userid', 'principals', 'features', 'user')
+
+    #: The feature flags recorded in the snapshot.
+    feature_names = ('streamer',)
+
+    def __init__(self, registry, userid=None, principals=None, features=(),
+                 user=None):
+        self.registry = registry
+        self.userid = _intern(userid)
+        self.principals = principals
+        self.features = frozenset(features)
+        self.user = user
+
+    @classmethod
+    def from_request(cls, request):
+        """Take a snapshot of the passed request."""
+        return cls(request.registry,
+                   userid=request.authenticated_userid,
+                   principals=_principal_set(request),
+                   features=[name for name in cls.feature_names
+                             if request.feature(name)],
+                   user=get_user(request))
+
+    @property
+    def authenticated_userid(self):
+        # As for a request, so the state can be used in place of one by
+        # FilterToElasticFilter.
+        return self.userid
+
+    def feature(self, name):
+        """Return whether the named feature was enabled for the socket."""
+        if name not in self.feature_names:
+            raise ValueError('{} is not recorded for websockets'.format(name))
+        return name in self.features
+
+    def has_permission(self, permission, context, match_context=None):
+        """
+        Return whether the socket's principals have the named permission on
+        the passed context.
+
+        When a :py:class:`MatchContext` is passed the authorization policy is
+        consulted once per distinct set of principals for the event, rather
+        than once per socket.
+        """
+        # As for a request, everything is permitted without authentication.
+        if self.principals is None:
+            return True
+        policy = self.registry.queryUtility(IAuthorizationPolicy)
+        if match_context is not None:
+            return match_context.permits(self.principals, permission, policy)
+        return bool(policy.permits(context, self.principals, permission))
+
+
+_principal_sets = weakref.WeakValueDictionary()
+
+
+def _intern(value):
+    """
+    Return a shared copy of the passed user id, so that the sockets of a
+    user with many open tabs hold one between them.
+    """
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class WebSocket(_WebSocket):
+    # Class attributes
+    event_queue = None
+    instances = weakref.WeakSet()
+    replay_buffer = None
+    subscriptions = SubscriptionIndex()
+    origins = []
+    stats = StreamerStats()
+    stats_reporter = None
+    timers = None
+    uri_cache = ExpansionCache()
+
+    # Instance attributes
+    binary = False
+    client_id = None
+    delivery_window = None
+    filter = None
+    inflater = None
+    last_message = 0
+    last_received = 0
+    named_filters = None
+    ping_sent = None
+    request = None
+    send_queue = None
+    state = None
+
+    def __init__(self, *args, **kwargs):
+        # Heartbeats are sent by the process's TimerWheel, rather than by a
+        # thread for each socket.
+        kwargs.setdefault('heartbeat_freq', None)
+        super(WebSocket, self).__init__(*args, **kwargs)
+        # Only kept until the socket is opened: see SocketState.
+        self.request = get_current_request()
+        self._write_lock = gevent.lock.Semaphore()
+
+        # Compressed messages from the client are inflated as they are read.
+        if deflate.RESPONSE in (self.extensions or []):
+            self.inflater = deflate.Inflater()
+
+        # Clients which negotiated the msgpack subprotocol exchange binary
+        # msgpack messages rather than JSON: see h.streamer.subprotocol.
+        self.binary = subprotocol.PROTOCOL in (self.protocols or [])
+
+    def __new__(cls, *args, **kwargs):
+        instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
+        cls.instances.add(instance)
+        return instance
+
+    @classmethod
+    def start_reader(cls, request):
+        if cls.event_queue is not None:
+            return
+        cls.event_queue = gevent.queue.Queue()
+        settings = request.registry.settings
+        cls.replay_buffer = ReplayBuffer(
+            maxlen=int(settings.get('h.streamer.replay_buffer.size', 1000)))
+        # Either read the events which another process on this host has
+        # already read from NSQ and parsed, or read them from NSQ directly.
+        path = settings.get('h.streamer.event_ring.path')
+        if path:
+            interval = float(settings.get('h.streamer.event_ring.poll_ms', 10))
+            gevent.spawn(read_event_ring, eventring.RingReader(path),
+                         cls.event_queue, interval / 1000.0)
+        else:
+            reader_id = 'stream-{}#ephemeral'.format(_random_id())
+            reader = request.get_queue_reader(_event_topic(settings),
+                                              reader_id)
+            reader.on_message.connect(cls.on_queue_message)
+            reader.start(block=False)
+        gevent.spawn(broadcast_from_queue, cls.event_queue, cls.subscriptions,
+                     cls.replay_buffer, cls.stats)
+
+    @classmethod
+    def start_stats(cls, request):
+        if cls.stats_reporter is not None:
+            return
+        settings = request.registry.settings
+        interval = float(settings.get('h.streamer.stats_interval', 10))
+        if interval > 0:
+            cls.stats_reporter = gevent.spawn(
+                report_stats, cls.stats, stats_client(request), interval)
+
+    @classmethod
+    def start_timers(cls, settings):
+        if cls.timers is not None:
+            return
+        cls.timers = TimerWheel(
+            interval=float(settings.get('h.streamer.heartbeat.interval', 30)),
+            timeout=float(settings.get('h.streamer.heartbeat.timeout', 10)),
+            idle_timeout=float(settings.get('h.streamer.idle_timeout', 0)))
+        gevent.spawn(cls.timers.run)
+
+    @classmethod
+    def on_queue_message(cls, reader, message=None):
+        if message is not None:
+            cls.event_queue.put(message)
+
+    def opened(self):
+        request = self.request
+        self.state = SocketState.from_request(request)
+
+        # The websocket server runs regardless, but we don't attempt to connect
+        # to NSQ unless 'streamer' is toggled on.
+        if self.state.feature('streamer'):
+            self.start_reader(request)
+
+        # Start a writer, so that the fanout never blocks on this client.
+        settings = self.state.registry.settings
+        self.send_queue = SendQueue(
+            self.send,
+            self.drop,
+            maxsize=int(settings.get('h.streamer.send_queue.size', 100)),
+            policy=settings.get('h.streamer.send_queue.policy',
+                                'drop_oldest'))
+        self.send_queue.start()
+
+        # Optionally batch up events arriving in quick succession.
+        window = float(settings.get('h.streamer.delivery_window_ms', 0))
+        if window > 0 and self.binary:
+            self.delivery_window = DeliveryWindow(
+                self.push, window / 1000.0,
+                encode=subprotocol.packb, frame=subprotocol.annotation_frame)
+        elif window > 0:
+            self.delivery_window = DeliveryWindow(self.push, window / 1000.0)
+
+        self.start_timers(settings)
+        self.timers.add(self)
+
+        self.stats.counters['connections.opened'] += 1
+        self.start_stats(request)
+
+        # Release the database transaction, and the request.
+        request.tm.commit()
+        self.request = None
+        self.environ = None
+
+    def closed(self, code, reason=None):
+        self.subscriptions.discard(self)
+        if self.timers is not None:
+            self.timers.discard(self)
+        if self.delivery_window is not None:
+            self.delivery_window.close()
+        if self.send_queue is not None:
+            # The socket was opened.
+            self.stats.counters['connections.closed'] += 1
+            self.send_queue.close()
+
+    def close(self, code=1000, reason=''):
+        """
+        Close the socket.
+
+        Once the socket's writer has started, the closing frame is sent by
+        the writer, after any frames it has still to send, unless it has
+        nothing to send. If the client has already sent a closing or an
+        invalid frame, the reader stops as soon as this returns, and the
+        socket is terminated before the writer could send the closing frame,
+        so the pending frames are discarded and it is sent at once.
+        """
+        queue = self.send_queue
+        stream = self.stream
+        if stream.closing is None and not stream.errors:
+            if queue is not None and not queue.closed and not queue.idle:
+                queue.finish(code, reason)
+                return
+        self._close_now(code, reason)
+
+    def _close_now(self, code, reason):
+        if self.send_queue is not None:
+            self.send_queue.close()
+        super(WebSocket, self).close(code, reason)
+
+    def drop(self, code, reason=''):
+        """
+        Close the socket, dropping the connection if the closing handshake
+        cannot be started.
+        """
+        try:
+            self.close(code, reason)
+        except Exception:
+            log.debug("could not close websocket cleanly, dropping it",
+                      exc_info=True)
+            self.server_terminated = True
+            self.close_connection()
+
+    def notify(self, annotation, action, data, raw=None, seq=None,
+               subscriptions=None):
+        """
+        Deliver an annotation event to the client.
+
+        `data` is the serialized packet for the single event, which is used
+        unless the socket has a delivery window, in which case the event is
+        batched with any others arriving within the window. `raw` is the
+        annotation's own serialization in the socket's encoding (see
+        :py:meth:`encode`), if available, `seq` the event's
+        sequence id, and `subscriptions` the list of the socket's named
+        subscriptions which the event matches, if it has any.
+        """
+        if self.delivery_window is not None:
+            self.delivery_window.add(annotation, action, raw, seq,
+                                     subscriptions)
+            return True
+        return self.push(data, key=annotation.get('id'))
+
+    def encode(self, packet):
+        """
+        Serialize a packet for the client: as msgpack if the client
+        negotiated the msgpack subprotocol, otherwise as JSON.
+        """
+        if self.binary:
+            return subprotocol.packb(packet)
+        return json.dumps(packet)
+
+    def annotation_frame(self, data, raw, seq=None, subscriptions=None):
+        """
+        Return the serialized packet for an annotation event, given the
+        event's data and the annotation's JSON, as for
+        :py:func:`_annotation_frame`.
+        """
+        action = data['action']
+        if self.binary:
+            packed = subprotocol.packb(data['annotation'])
+            return subprotocol.annotation_frame([packed], action, seq,
+                                                subscriptions)
+        return _annotation_frame([raw], action, seq, subscriptions)
+
+    def send(self, payload, binary=False):
+        # Every message to a client using the msgpack subprotocol is binary.
+        binary = binary or self.binary
+        if self.inflater is not None and not binary and \
+                isinstance(payload, basestring):
+            frame = deflate.compressed_frame(payload)
+            if frame is not None:
+                self._write(frame)
+                return
+        super(WebSocket, self).send(payload, binary)
+
+    def _write(self, b):
+        # Frames are sent by the socket's writer, but ws4py answers pings and
+        # closing frames from the reader greenlet, which must not interleave
+        # its bytes with those of a frame the writer is part way through.
+        with self._write_lock:
+            super(WebSocket, self)._write(b)
+
+    def process(self, bytes):
+        if self.timers is not None:
+            self.last_received = self.timers.now
+        if self.inflater is None or not bytes:
+            return super(WebSocket, self).process(bytes)
+        try:
+            frames = self.inflater.feed(bytes)
+        except ValueError as exc:
+            log.debug("closing websocket: %s", exc)
+            # The reader stops once this returns False.
+            self._close_now(1009, str(exc))
+            return False
+        for frame in frames:
+            if not super(WebSocket, self).process(frame):
+                return False
+        self.reading_buffer_size = self.inflater.needed
+        return True
+
+    def push(self, data, key=None, reliable=False):
+        """
+        Queue a frame for delivery by this socket's writer, as for
+        :py:meth:`SendQueue.put`.
+
+        Frames pushed before the socket has been opened are sent immediately.
+        """
+        if self.send_queue is None:
+            self.send(data)
+            return True
+        return self.send_queue.put(data, key, reliable)
+
+    @classmethod
+    def send_queue_stats(cls):
+        """
+        Return the current depth of the outbound queues of all sockets, along
+        with the process-wide eviction counters.
+        """
+        depths = [len(s.send_queue) for s in list(cls.instances)
+                  if s.send_queue is not None]
+        stats = {
+            'sockets': len(depths),
+            'pending': sum(depths),
+            'max_pending': max(depths) if depths else 0,
+        }
+        for name in ('dropped', 'coalesced', 'disconnected'):
+            stats[name] = send_queue_counters[name]
+        return stats
+
+    @classmethod
+    def heartbeat_stats(cls):
+        """
+        Return the number of live sockets, and the counts of pings sent and
+        of sockets closed for not answering them or for being idle.
+        """
+        if cls.timers is None:
+            return {'live': 0, 'pinged': 0, 'timed_out': 0, 'idle': 0}
+        return cls.timers.stats()
+
+    @classmethod
+    def snapshot(cls):
+        """
+        Return the state of the streamer in this process, for debugging.
+        """
+        cache = cls.uri_cache
+        replay = cls.replay_buffer
+        return {
+            'pid': os.getpid(),
+            'fanout': cls.stats.snapshot(),
+            'event_queue': (cls.event_queue.qsize()
+                            if cls.event_queue is not None else None),
+            'subscribed_sockets': len(cls.subscriptions),
+            'send_queues': cls.send_queue_stats(),
+            'heartbeats': cls.heartbeat_stats(),
+            'uri_cache': {'size': len(cache), 'hits': cache.hits,
+                          'misses': cache.misses},
+            'replay_buffer': len(replay) if replay is not None else None,
+        }
+
+    def send_annotations(self, limit=PAST_PAGE_SIZE, cursor=None,
+                         subscription=None):
+        """
+        Send one page of past annotations matching the socket's filter, or
+        the filter of the named subscription.
+
+        Pages are ordered most recently updated first. The packet's options
+        carry a ``cursor`` which the client can send back to fetch the next
+        page, or None if there are no more annotations. Cursors are those of
+        the search API (see :py:func:`h.api.search.query.next_cursor`).
+        """
+        if subscription is None:
+            filter_ = self.filter
+        else:
+            filter_ = (self.named_filters or {}).get(subscription)
+            if filter_ is None:
+                raise ValueError('unknown subscription: {}'.format(
+                    subscription))
+        limit = max(1, min(limit, PAST_PAGE_SIZE_MAX))
+        query = FilterToElasticFilter(filter_.filter, self.state).query
+        query = dict(query, size=limit)
+        if cursor is not None:
+            query = search_query.after_cursor(query, cursor)
+        results = Annotation.search_raw(query=query, user=self.state.user,
+                                        raw_result=True)
+        hits = results['hits']['hits']
+        annotations = [Annotation(h['_source'], id=h['_id']) for h in hits]
+        packet = _annotation_packet(annotations, 'past')
+        packet['options']['cursor'] = search_query.next_cursor(query, hits,
+                                                                cursor)
+        if subscription is not None:
+            packet['options']['subscriptions'] = [subscription]
+        self.push(self.encode(packet), reliable=True)
+
+    def resume(self, since):
+        """
+        Send the client every event matching its filter since the event with
+        the passed sequence id.
+
+        The events are followed by a ``resume`` packet whose ``status`` option
+        is ``ok`` if the client is now up to date, or ``reload`` if the events
+        it missed are no longer available, or could not all be queued, in
+        which case it should fetch annotations afresh.
+
+        The events are queued as reliable frames, so that none of them is
+        discarded however many the client missed: the replay buffer bounds
+        how many there can be.
+        """
+        replay = self.replay_buffer
+        events = replay.since(since) if replay is not None else None
+        delivered = events is not None
+        if events is not None:
+            for seq, (data_in, annotation, raw) in events:
+                context = MatchContext(annotation)
+                if not self.named_filters:
+                    if should_send_event(self, annotation, data_in, context):
+                        frame = self.annotation_frame(data_in, raw, seq)
+                        delivered &= self.push(frame, reliable=True)
+                    continue
+                matched = matching_subscriptions(self, annotation, data_in,
+                                                 context)
+                if matched:
+                    frame = self.annotation_frame(data_in, raw, seq, matched)
+                    delivered &= self.push(frame, reliable=True)
+        self.push(self.encode({
+            'type': 'resume',
+            'options': {
+                'status': 'ok' if delivered else 'reload',
+                'seq': replay.current if replay is not None else None,
+            },
+        }), reliable=True)
+
+    def _compile_filter(self, payload):
+        # Let's try to validate the schema
+        filter_validator.validate(payload)
+
+        # A shard receives too few events to serve filters which could
+        # match documents belonging to another shard.
+        shard, shards = _shard_settings(self.state.registry.settings)
+        if shard is not None and _filter_shard(payload, shards) != shard:
+            raise ValueError('filter does not belong to shard '
+                             '{}'.format(shard))
+
+        # Add backend expands for clauses
+        self._expand_clauses(payload)
+
+        # The ElasticSearch query for past annotations is built from the
+        # filter when needed: sockets with the same filter then share one
+        # copy of its (often long) list of URIs.
+        return compile_filter(payload)
+
+    def _expand_clauses(self, payload):
+        for clause in payload['clauses']:
+            if clause['field'] == '/uri':
+                self._expand_uris(clause)
+
+    def _expand_uris(self, clause):
+        uris = clause['value']
+
+        if not isinstance(uris, list):
+            uris = [uris]
+
+        expanded = self.uri_cache.expand(uris)
+
+        # Sorted, so that equivalent filters serialize identically.
+        clause['value'] = sorted(expanded)
+
+    def received_message(self, msg):
+        if self.timers is not None:
+            self.last_message = self.timers.now
+        try:
+            if self.binary and msg.is_binary:
+                data = subprotocol.unpackb(msg.data)
+            else:
+                data = json.loads(msg.data)
+            msg_type = data.get('messageType', 'filter')
+
+            if msg_type == 'filter':
+                self.filter = self._compile_filter(data['filter'])
+                self.subscriptions.add(self)
+            elif msg_type == 'subscribe':
+                # Add, or replace, one of several named filters, so that a
+                # client watching several documents (as from several frames)
+                # needs only one connection:
+                #
+                #     {"messageType": "subscribe", "id": "<id>",
+                #      "filter": {...}}
+                #
+                # Notifications matching named subscriptions list the ids of
+                # those they match in their ``subscriptions`` option.
+                sid = data.get('id')
+                if not isinstance(sid, basestring) or not sid:
+                    raise ValueError('subscription id must be a string')
+                named = dict(self.named_filters or {})
+                settings = self.state.registry.settings
+                limit = int(settings.get('h.streamer.max_subscriptions', 10))
+                if sid not in named and len(named) >= limit:
+                    raise ValueError('too many subscriptions')
+                named[sid] = self._compile_filter(data['filter'])
+                self.named_filters = named
+                self.subscriptions.add(self)
+            elif msg_type == 'unsubscribe':
+                #     {"messageType": "unsubscribe", "id": "<id>"}
+                named = dict(self.named_filters or {})
+                named.pop(data.get('id'), None)
+                self.named_filters = named or None
+                if self.named_filters is None and self.filter is None:
+                    # Nothing left to match: a socket with no filter would
+                    # otherwise sit in the fallback bucket.
+                    self.subscriptions.discard(self)
+                else:
+                    self.subscriptions.add(self)
+            elif msg_type == 'client_id':
+                self.client_id = data.get('value')
+            elif msg_type == 'past':
+                # Page through past annotations matching the filter, or the
+                # named subscription:
+                #
+                #     {"messageType": "past", "limit": 20, "cursor": null,
+                #      "subscription": null}
+                #
+                # Each reply includes the cursor for the following page.
+                subscription = data.get('subscription')
+                if self.filter is None and subscription is None:
+                    raise ValueError('past annotations requested before '
+                                     'a filter was sent')
+                self.send_annotations(
+                    limit=int(data.get('limit', PAST_PAGE_SIZE)),
+                    cursor=data.get('cursor'),
+                    subscription=subscription)
+            elif msg_type == 'resume':
+                # Catch up on the events missed while disconnected:
+                #
+                #     {"messageType": "resume", "since": "<seq>"}
+                #
+                # where <seq> is the ``seq`` option of the last annotation
+                # notification received.
+                if self.filter is None and not self.named_filters:
+                    raise ValueError('resume requested before a filter was '
+                                     'sent')
+                self.resume(data.get('since'))
+        except:
+            # TODO: clean this up, catch specific errors, narrow the scope
+            log.exception("Parsing filter: %s", msg)
+            self.close()
+            raise
+
+
+def _principal_set(request):
+    """
+    Return the frozen set of effective principals for the request, or None if
+    no authentication policy is in use.
+
+    Equal sets are shared between sockets.
+    """
+    if request.registry.queryUtility(IAuthenticationPolicy) is None:
+        return None
+    principals = frozenset(request.effective_principals)
+    return _principal_sets.setdefault(principals, principals)
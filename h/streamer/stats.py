@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Measurements of the work of a streamer process."""
+import bisect
+import collections
+import logging
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+
+class StreamerStats(object):
+    """
+    Measures the work of a streamer process, for reporting through
+    :py:mod:`h.stats` and for the ``ws/stats`` snapshot.
+
+    For each event fanned out to the sockets, the time taken is recorded in a
+    histogram with fixed buckets, whose upper bounds in milliseconds are
+    ``bounds``, along with the depth of the event queue behind it and the
+    numbers of sockets which were checked against it and which it was sent
+    to. The sockets opened and closed are counted too.
+    """
+
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.max_latency = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self._reported = collections.Counter()
+        self._reported_buckets = list(self.buckets)
+
+    def record_event(self, latency, checked, notified, queue_depth=0):
+        """
+        Record the fanout of one event, which took `latency` seconds, with
+        `queue_depth` events still queued behind it.
+        """
+        ms = latency * 1000.0
+        self.buckets[bisect.bisect_left(self.bounds, ms)] += 1
+        self.max_latency = max(self.max_latency, ms)
+        self.counters['events'] += 1
+        self.counters['sockets.checked'] += checked
+        self.counters['sockets.notified'] += notified
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    @property
+    def open_sockets(self):
+        return (self.counters['connections.opened'] -
+                self.counters['connections.closed'])
+
+    def percentile(self, q, buckets=None):
+        """
+        Return the upper bound, in milliseconds, of the histogram bucket
+        holding the `q`th percentile of fanout times, or None if no events
+        were recorded.
+
+        Times beyond the last bound are reported as the last bound.
+        """
+        if buckets is None:
+            buckets = self.buckets
+        total = sum(buckets)
+        if not total:
+            return None
+        rank = total * q / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def snapshot(self):
+        """Return the counts and measurements so far, as a dict."""
+        checked = self.counters['sockets.checked']
+        labels = ['le_{}ms'.format(b) for b in self.bounds]
+        labels.append('gt_{}ms'.format(self.bounds[-1]))
+        return {
+            'counters': dict(self.counters),
+            'open_sockets': self.open_sockets,
+            'match_ratio': (float(self.counters['sockets.notified']) /
+                            checked if checked else None),
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'latency_ms': {
+                'histogram': dict(zip(labels, self.buckets)),
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max_latency,
+            },
+        }
+
+    def report(self, client):
+        """
+        Send the counts since the last report, and the current queue depth
+        and number of open sockets, through the passed :py:mod:`h.stats`
+        client.
+
+        The counts are sent as statsd counters, and the fanout time
+        percentiles over the period since the last report as gauges.
+        """
+        client = client.get_client('streamer')
+        counter = client.get_counter()
+        gauge = client.get_gauge()
+
+        counters = self.counters.copy()
+        delta = counters - self._reported
+        self._reported = counters
+        for name, value in delta.iteritems():
+            counter.increment(name, value)
+
+        buckets = [n - r for n, r in zip(self.buckets,
+                                         self._reported_buckets)]
+        self._reported_buckets = list(self.buckets)
+        for q in (50, 95, 99):
+            value = self.percentile(q, buckets)
+            if value is not None:
+                gauge.send('fanout.latency.p{}'.format(q), value)
+        if delta['sockets.checked']:
+            gauge.send('fanout.match_ratio',
+                       float(delta['sockets.notified']) /
+                       delta['sockets.checked'])
+        gauge.send('event_queue.depth', self.queue_depth)
+        gauge.send('sockets.open', self.open_sockets)
+
+
+def report_stats(stats, client, interval):
+    """
+    Report the passed :py:class:`StreamerStats` through the passed
+    :py:mod:`h.stats` client every `interval` seconds.
+    """
+    while True:
+        gevent.sleep(interval)
+        try:
+            stats.report(client)
+        except Exception:
+            log.exception('could not report streamer stats')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Support for the streamer's ``msgpack`` WebSocket subprotocol.
+
+A client which offers the ``msgpack`` subprotocol in its handshake's
+``Sec-WebSocket-Protocol`` header exchanges the same messages with the
+streamer as any other, but encoded with MessagePack_ in binary frames rather
+than as JSON in text frames. Clients which offer no subprotocol, or whose
+handshake the streamer answers without one, keep using JSON.
+
+The subprotocol is only offered when the optional ``msgpack`` package is
+installed (``pip install h[msgpack]``): see :py:func:`available`.
+
+.. _MessagePack: http://msgpack.org/
+"""
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PROTOCOL = 'msgpack'
+
+
+def available():
+    """Return whether the subprotocol can be offered to clients."""
+    return msgpack is not None
+
+
+def packb(obj):
+    """Encode the passed object as MessagePack."""
+    # Byte strings and unicode strings are both packed with the str type, as
+    # they both hold text here.
+    return msgpack.packb(obj, use_bin_type=False)
+
+
+def unpackb(data):
+    """Decode a MessagePack message from a client."""
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as exc:
+        # msgpack raises a variety of exceptions for malformed data.
+        raise ValueError('invalid msgpack message: {}'.format(exc))
+
+
+def annotation_frame(packed_annotations, action, seq=None,
+                     subscriptions=None):
+    """
+    Return the encoded packet for the specified action applied to the passed
+    annotations, which are already encoded with :py:func:`packb`.
+
+    This is the counterpart of :py:func:`h.streamer._annotation_frame`: the
+    packet has the same structure, and the annotations are copied into it
+    rather than encoded again.
+    """
+    options = {'action': action}
+    if seq is not None:
+        options['seq'] = seq
+    if subscriptions is not None:
+        options['subscriptions'] = subscriptions
+
+    packer = msgpack.Packer(use_bin_type=False)
+    return b''.join([packer.pack_map_header(3),
+                     packer.pack('type'),
+                     packer.pack('annotation-notification'),
+                     packer.pack('options'),
+                     packer.pack(options),
+                     packer.pack('payload'),
+                     packer.pack_array_header(len(packed_annotations))] +
+                    list(packed_annotations))
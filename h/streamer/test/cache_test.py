@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import gevent
+import pytest
+from mock import patch
+
+from h.streamer.cache import ExpansionCache
+from h.streamer.test.helpers import FakeClock
+
+
+class TestExpansionCache(object):
+    def setup_method(self, method):
+        self.clock = FakeClock()
+        self.cache = ExpansionCache(ttl=60, clock=self.clock)
+
+    @patch('h.api.uri.expand')
+    def test_expand_combines_expansions(self, expand):
+        expand.side_effect = lambda u: [u, u + '/print']
+        assert self.cache.expand(['http://a', 'http://b']) == set([
+            'http://a', 'http://a/print', 'http://b', 'http://b/print'])
+
+    @patch('h.api.uri.expand')
+    def test_expand_caches_expansions(self, expand):
+        expand.return_value = ['http://a', 'http://b']
+        self.cache.expand(['http://a'])
+        assert self.cache.expand(['http://a']) == set(['http://a',
+                                                       'http://b'])
+        assert expand.call_count == 1
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    @patch('h.api.uri.expand')
+    def test_expand_expires_expansions(self, expand):
+        expand.return_value = ['http://a']
+        self.cache.expand(['http://a'])
+        self.clock.now += 61
+        self.cache.expand(['http://a'])
+        assert expand.call_count == 2
+
+    @patch('h.api.uri.expand')
+    def test_expand_shares_concurrent_lookups(self, expand):
+        def slow_expand(u):
+            gevent.sleep(0.01)
+            return [u]
+        expand.side_effect = slow_expand
+
+        jobs = [gevent.spawn(self.cache.expand, ['http://a'])
+                for _ in range(5)]
+        gevent.joinall(jobs)
+
+        assert [j.value for j in jobs] == [set(['http://a'])] * 5
+        assert expand.call_count == 1
+
+    @patch('h.api.uri.expand')
+    def test_expand_looks_up_uris_concurrently(self, expand):
+        def slow_expand(u):
+            gevent.sleep(0.05)
+            return [u]
+        expand.side_effect = slow_expand
+        uris = ['http://example.com/{}'.format(i) for i in range(10)]
+
+        with gevent.Timeout(0.2):
+            assert self.cache.expand(uris) == set(uris)
+
+    @patch('h.api.uri.expand')
+    def test_expand_does_not_cache_failures(self, expand):
+        expand.side_effect = RuntimeError('search failed')
+        with pytest.raises(RuntimeError):
+            self.cache.expand(['http://a'])
+
+        expand.side_effect = None
+        expand.return_value = ['http://a']
+        assert self.cache.expand(['http://a']) == set(['http://a'])
+
+    @patch('h.api.uri.expand')
+    def test_expand_evicts_least_recently_added(self, expand):
+        self.cache = ExpansionCache(maxsize=2)
+        expand.side_effect = lambda u: [u]
+        self.cache.expand(['http://a', 'http://b', 'http://c'])
+        assert len(self.cache) == 2
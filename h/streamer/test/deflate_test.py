@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import zlib
+
+import pytest
+from ws4py.framing import Frame, OPCODE_CONTINUATION, OPCODE_TEXT
+from ws4py.streaming import Stream
+
+from h.streamer import deflate
+
+
+@pytest.mark.parametrize('offers', [
+    'permessage-deflate',
+    'permessage-deflate; client_max_window_bits',
+    'permessage-deflate; client_max_window_bits=10',
+    'permessage-deflate;server_no_context_takeover',
+    'x-webkit-deflate-frame, permessage-deflate',
+    'permessage-deflate; server_max_window_bits=10, permessage-deflate',
+])
+def test_negotiate_accepts(offers):
+    assert deflate.negotiate(offers) == deflate.RESPONSE
+
+
+@pytest.mark.parametrize('offers', [
+    None,
+    '',
+    'x-webkit-deflate-frame',
+    'permessage-deflate; server_max_window_bits=10',
+    'permessage-deflate; client_max_window_bits=20',
+    'permessage-deflate; client_no_context_takeover=1',
+    'permessage-deflate; client_max_window_bits; client_max_window_bits',
+    'permessage-deflate; unknown',
+])
+def test_negotiate_declines(offers):
+    assert deflate.negotiate(offers) is None
+
+
+def test_compress_round_trips():
+    data = '{"text": "%s"}' % ('hello ' * 100)
+    body = deflate.compress(data)
+    assert len(body) < len(data)
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    assert inflater.decompress(body + '\x00\x00\xff\xff') == data
+
+
+def test_compressed_frame_sets_rsv1():
+    frame = deflate.compressed_frame('x' * 200)
+    assert ord(frame[0]) == 0xc1
+
+
+def test_compressed_frame_is_cached():
+    payload = 'y' * 200
+    assert deflate.compressed_frame(payload) is \
+        deflate.compressed_frame(payload)
+
+
+def test_compressed_frame_skips_short_payloads():
+    assert deflate.compressed_frame('{}') is None
+
+
+def test_compressed_frame_encodes_unicode():
+    payload = u'é' * 100
+    frame = deflate.compressed_frame(payload)
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    body = inflater.decompress(frame[2:] + '\x00\x00\xff\xff')
+    assert body == payload.encode('utf-8')
+
+
+def _frame(body, opcode=OPCODE_TEXT, fin=1, rsv1=0):
+    return Frame(opcode=opcode, body=body, fin=fin, rsv1=rsv1,
+                 masking_key='abcd').build()
+
+
+def _parse(frames):
+    stream = Stream()
+    messages = []
+    for frame in frames:
+        stream.parser.send(frame)
+        assert not stream.errors
+        if stream.has_message:
+            messages.append(str(stream.message))
+            stream.message = None
+    return messages
+
+
+class TestInflater(object):
+    def test_passes_uncompressed_frames_through(self):
+        frame = _frame('hello')
+        assert deflate.Inflater().feed(frame) == [frame]
+
+    def test_inflates_compressed_message(self):
+        text = 'hello ' * 50
+        frames = deflate.Inflater().feed(
+            _frame(deflate.compress(text), rsv1=1))
+        assert _parse(frames) == [text]
+
+    def test_inflates_fragmented_message(self):
+        text = 'hello ' * 50
+        body = deflate.compress(text)
+        inflater = deflate.Inflater()
+        frames = inflater.feed(_frame(body[:10], fin=0, rsv1=1))
+        frames += inflater.feed(_frame(body[10:], opcode=OPCODE_CONTINUATION))
+        assert _parse(frames) == [text]
+
+    def test_waits_for_complete_frames(self):
+        frame = _frame(deflate.compress('hello ' * 50), rsv1=1)
+        inflater = deflate.Inflater()
+        assert inflater.feed(frame[:1]) == []
+        assert inflater.feed(frame[1:8]) == []
+        assert inflater.needed == len(frame) - 8
+        assert len(inflater.feed(frame[8:])) == 1
+
+    def test_splits_multiple_frames(self):
+        frames = deflate.Inflater().feed(
+            _frame('one') + _frame(deflate.compress('two'), rsv1=1))
+        assert _parse(frames) == ['one', 'two']
+
+    def test_rejects_invalid_compressed_data(self):
+        with pytest.raises(ValueError):
+            deflate.Inflater().feed(_frame('garbage', rsv1=1))
+
+    def test_rejects_oversized_messages(self):
+        body = deflate.compress('x' * 1000)
+        with pytest.raises(ValueError):
+            deflate.Inflater(max_size=100).feed(_frame(body, rsv1=1))
+
+    def test_rejects_oversized_frames(self):
+        with pytest.raises(ValueError):
+            deflate.Inflater(max_size=10).feed(_frame('x' * 100)[:6])
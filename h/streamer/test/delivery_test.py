@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import json
+
+import gevent
+from mock import MagicMock
+
+from h.streamer.delivery import DeliveryWindow
+from h.streamer.delivery import SendQueue
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.send = MagicMock()
+        self.close = MagicMock()
+
+    def _queue(self, **kwargs):
+        return SendQueue(self.send, self.close, **kwargs)
+
+    def _drain(self, queue):
+        queue.start().join(timeout=0.1)
+
+    def test_sends_frames_in_order(self):
+        queue = self._queue()
+        queue.put('a')
+        queue.put('b')
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['a', 'b']
+        assert len(queue) == 0
+
+    def test_drop_oldest_discards_oldest_frame(self):
+        queue = self._queue(maxsize=2, policy='drop_oldest')
+        for frame in 'abc':
+            queue.put(frame)
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['b', 'c']
+        assert queue.dropped == 1
+
+    def test_coalesce_replaces_pending_frame_with_same_key(self):
+        queue = self._queue(maxsize=2, policy='coalesce')
+        queue.put('a1', key='a')
+        queue.put('b1', key='b')
+        queue.put('a2', key='a')
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['a2', 'b1']
+        assert queue.coalesced == 1
+        assert queue.dropped == 0
+
+    def test_coalesce_drops_oldest_when_full(self):
+        queue = self._queue(maxsize=2, policy='coalesce')
+        queue.put('a1', key='a')
+        queue.put('b1', key='b')
+        queue.put('c1', key='c')
+        queue.put('a2', key='a')
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['c1', 'a2']
+        assert queue.dropped == 2
+
+    def test_disconnect_closes_socket_when_full(self):
+        queue = self._queue(maxsize=1, policy='disconnect')
+        assert queue.put('a')
+        assert not queue.put('b')
+        assert not queue.put('c')
+        self._drain(queue)
+        self.close.assert_called_once_with(1013, 'slow consumer')
+        assert not self.send.called
+        assert queue.closed
+
+    def test_disconnect_waits_for_the_frame_being_sent(self):
+        sent = []
+
+        def send(data):
+            gevent.sleep(0.01)
+            sent.append(data)
+            assert not self.close.called
+        self.send.side_effect = send
+        queue = self._queue(maxsize=1, policy='disconnect')
+        writer = queue.start()
+        queue.put('a')
+        gevent.sleep(0)
+        queue.put('b')
+        assert not queue.put('c')
+        assert not self.close.called
+        writer.join(timeout=0.1)
+        assert sent == ['a']
+        self.close.assert_called_once_with(1013, 'slow consumer')
+
+    def test_reliable_frames_are_never_dropped(self):
+        queue = self._queue(maxsize=1, policy='drop_oldest')
+        queue.put('a')
+        queue.put('p', reliable=True)
+        queue.put('b')
+        queue.put('c')
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['p', 'c']
+        assert queue.dropped == 2
+
+    def test_reliable_frames_do_not_count_towards_size(self):
+        queue = self._queue(maxsize=1, policy='disconnect')
+        assert queue.put('a')
+        for _ in range(5):
+            assert queue.put('p', reliable=True)
+        assert not queue.closed
+        assert len(queue) == 6
+
+    def test_finish_closes_socket_after_pending_frames(self):
+        queue = self._queue()
+        queue.put('a')
+        queue.put('b', reliable=True)
+        queue.finish(1000, 'idle timeout')
+        assert not queue.put('c')
+        self._drain(queue)
+        assert [c[0][0] for c in self.send.call_args_list] == ['a', 'b']
+        self.close.assert_called_once_with(1000, 'idle timeout')
+        assert queue.closed
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self._queue(policy='shrug')
+
+    def test_stops_writer_and_closes_socket_when_send_fails(self):
+        self.send.side_effect = RuntimeError('terminated')
+        queue = self._queue()
+        queue.put('a')
+        queue.put('b')
+        self._drain(queue)
+        assert queue.closed
+        assert self.send.call_count == 1
+        self.close.assert_called_once_with(1011, 'send failed')
+
+
+class TestDeliveryWindow(unittest.TestCase):
+    def setUp(self):
+        self.push = MagicMock()
+        self.window = DeliveryWindow(self.push, 0.01)
+
+    def _packets(self):
+        return [json.loads(c[0][0]) for c in self.push.call_args_list]
+
+    def test_delivers_after_window(self):
+        self.window.add({'id': 'a'}, 'create')
+        assert not self.push.called
+        gevent.sleep(0.02)
+        assert self._packets() == [{
+            'payload': [{'id': 'a'}],
+            'type': 'annotation-notification',
+            'options': {'action': 'create'},
+        }]
+
+    def test_uses_raw_annotation_json(self):
+        self.window.add({'id': 'a'}, 'create', '{"id": "a", "raw": true}')
+        self.window.flush()
+        assert self._packets()[0]['payload'] == [{'id': 'a', 'raw': True}]
+
+    def test_merges_events_into_one_packet_per_action(self):
+        self.window.add({'id': 'a'}, 'create')
+        self.window.add({'id': 'b'}, 'delete')
+        self.window.add({'id': 'c'}, 'create')
+        self.window.flush()
+        packets = self._packets()
+        assert [p['options']['action'] for p in packets] == ['create',
+                                                             'delete']
+        assert packets[0]['payload'] == [{'id': 'a'}, {'id': 'c'}]
+        assert packets[1]['payload'] == [{'id': 'b'}]
+
+    def test_collapses_repeated_updates_to_latest(self):
+        self.window.add({'id': 'a', 'text': 'one'}, 'update')
+        self.window.add({'id': 'b', 'text': 'two'}, 'update')
+        self.window.add({'id': 'a', 'text': 'three'}, 'update')
+        self.window.flush()
+        assert self._packets()[0]['payload'] == [
+            {'id': 'b', 'text': 'two'},
+            {'id': 'a', 'text': 'three'},
+        ]
+
+    def test_close_discards_pending_events(self):
+        self.window.add({'id': 'a'}, 'create')
+        self.window.close()
+        gevent.sleep(0.02)
+        assert not self.push.called
+        assert len(self.window) == 0
+
+    def test_separates_events_for_different_subscriptions(self):
+        self.window.add({'id': 'a'}, 'create', subscriptions=['x'])
+        self.window.add({'id': 'b'}, 'create', subscriptions=['x', 'y'])
+        self.window.add({'id': 'c'}, 'create', subscriptions=['x'])
+        self.window.flush()
+        packets = self._packets()
+        assert [(p['options']['subscriptions'], p['payload'])
+                for p in packets] == [
+            (['x'], [{'id': 'a'}, {'id': 'c'}]),
+            (['x', 'y'], [{'id': 'b'}]),
+        ]
+
+    def test_last_packet_carries_latest_sequence_id(self):
+        self.window.add({'id': 'a'}, 'create', seq='e:1')
+        self.window.add({'id': 'b'}, 'delete', seq='e:2')
+        self.window.add({'id': 'c'}, 'create', seq='e:3')
+        self.window.flush()
+        packets = self._packets()
+        assert 'seq' not in packets[0]['options']
+        assert packets[1]['options']['seq'] == 'e:3'
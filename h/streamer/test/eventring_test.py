@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+
+import pytest
+from mock import patch
+
+from h.streamer.eventring import RingReader, RingWriter
+
+
+def test_reader_sees_records_written_after_it_starts(path):
+    writer = RingWriter(path, capacity=1024)
+    writer.append('before')
+    reader = RingReader(path)
+    assert reader.read() == []
+
+    writer.append('one')
+    writer.append('two')
+    assert reader.read() == ['one', 'two']
+    assert reader.read() == []
+
+
+def test_reader_waits_for_writer(path):
+    reader = RingReader(path)
+    assert reader.read() == []
+
+    writer = RingWriter(path, capacity=1024)
+    assert reader.read() == []
+    writer.append('one')
+    assert reader.read() == ['one']
+
+
+def test_records_wrap_around(path):
+    writer = RingWriter(path, capacity=1024)
+    reader = RingReader(path)
+    reader.read()
+
+    received = []
+    for i in range(100):
+        record = str(i) * 50
+        writer.append(record)
+        received.extend(reader.read())
+    assert received == [str(i) * 50 for i in range(100)]
+    assert reader.dropped == 0
+
+
+def test_slow_reader_skips_overwritten_records(path):
+    writer = RingWriter(path, capacity=1024)
+    reader = RingReader(path)
+    reader.read()
+
+    for i in range(50):
+        writer.append(str(i) * 50)
+    assert reader.read() == []
+    assert reader.dropped == 1
+
+    writer.append('fresh')
+    assert reader.read() == ['fresh']
+
+
+def test_reader_restarts_with_new_writer(path):
+    writer = RingWriter(path, capacity=1024)
+    reader = RingReader(path)
+    reader.read()
+    writer.append('one')
+    writer.close()
+
+    writer = RingWriter(path, capacity=1024)
+    assert reader.read() == []
+    writer.append('two')
+    assert reader.read() == ['two']
+
+
+def test_reader_restarts_with_writer_of_same_epoch(path):
+    with patch('h.streamer.eventring.random.getrandbits', return_value=1):
+        writer = RingWriter(path, capacity=1024)
+        reader = RingReader(path)
+        reader.read()
+        writer.append('one')
+        writer.close()
+
+        writer = RingWriter(path, capacity=1024)
+        writer.append('two')
+        assert reader.read() == ['two']
+
+
+def test_reader_can_be_reset(path):
+    writer = RingWriter(path, capacity=1024)
+    reader = RingReader(path)
+    reader.read()
+    writer.append('one')
+    reader.reset()
+
+    assert reader.read() == []
+    writer.append('two')
+    assert reader.read() == ['two']
+
+
+def test_writer_replaces_file(path):
+    with open(path, 'w') as f:
+        f.write('not a ring')
+    os.chmod(path, 0o666)
+
+    RingWriter(path, capacity=1024)
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert os.listdir(os.path.dirname(path)) == ['events']
+
+
+def test_writer_rejects_large_records(path):
+    writer = RingWriter(path, capacity=1024)
+    with pytest.raises(ValueError):
+        writer.append('x' * 300)
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('events'))
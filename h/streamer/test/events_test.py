@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import json
+
+import gevent
+import gevent.queue
+import pytest
+from mock import ANY
+from mock import MagicMock, Mock
+from mock import patch
+
+from h.streamer import subprotocol
+from h.streamer.eventring import RingReader, RingWriter
+from h.streamer.events import ParsedMessage
+from h.streamer.events import ReplayBuffer
+from h.streamer.events import _dump_event
+from h.streamer.events import _load_event
+from h.streamer.events import broadcast_from_queue
+from h.streamer.events import event_ring_writer
+from h.streamer.events import read_event_ring
+from h.streamer.events import should_send_event
+from h.streamer.filters import FilterHandler
+from h.streamer.filters import MatchContext
+from h.streamer.filters import compile_filter
+from h.streamer.index import SubscriptionIndex
+from h.streamer.sockets import SocketState
+from h.streamer.stats import StreamerStats
+from h.streamer.test.helpers import FakeMessage
+from h.streamer.test.helpers import FakeSocket
+from h.streamer.test.helpers import requires_msgpack
+from h.streamer.test.helpers import tag_filter
+
+
+class TestBroadcast(unittest.TestCase):
+    def setUp(self):
+        self.message_data = [
+            {'annotation': {'id': 1},
+             'action': 'delete',
+             'src_client_id': 'pigeon'},
+            {'annotation': {'id': 2},
+             'action': 'update',
+             'src_client_id': 'pigeon'},
+            {'annotation': {'id': 3},
+             'action': 'delete',
+             'src_client_id': 'cat'},
+        ]
+        self.messages = [FakeMessage(json.dumps(m)) for m in self.message_data]
+
+        self.queue = MagicMock()
+        self.queue.__iter__.return_value = self.messages
+
+        self.should_patcher = patch('h.streamer.events.should_send_event')
+        self.should = self.should_patcher.start()
+
+    def tearDown(self):
+        self.should_patcher.stop()
+
+    def _index(self, *sockets):
+        index = SubscriptionIndex()
+        for sock in sockets:
+            index.add(sock)
+        return index
+
+    def test_send_when_socket_should_receive_event(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        broadcast_from_queue(self.queue, self._index(sock))
+        assert sock.notify.called
+
+    def test_notifies_with_annotation_and_action(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        broadcast_from_queue(self.queue, self._index(sock))
+        events = [(c[0][0]['id'], c[0][1]) for c in sock.notify.call_args_list]
+        assert events == [(1, 'delete'), (2, 'update'), (3, 'delete')]
+
+    def test_passes_annotation_json_through(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        body = ('{"action": "create", "src_client_id": null, '
+                '"annotation": {"id": 4, "text": "a \\"quoted\\" }"}}')
+        self.queue.__iter__.return_value = [FakeMessage(body)]
+
+        broadcast_from_queue(self.queue, self._index(sock))
+
+        annotation, action, data, raw, seq, _ = sock.notify.call_args[0]
+        assert raw == '{"id": 4, "text": "a \\"quoted\\" }"}'
+        assert raw in data
+        assert json.loads(data) == {
+            'payload': [{'id': 4, 'text': 'a "quoted" }'}],
+            'type': 'annotation-notification',
+            'options': {'action': 'create'},
+        }
+
+    def test_handles_unusual_event_json(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        body = ' {"annotation" : {"id": 5} ,"action":"update",\n'\
+               '"src_client_id": "x"} '
+        self.queue.__iter__.return_value = [FakeMessage(body)]
+
+        broadcast_from_queue(self.queue, self._index(sock))
+
+        annotation, action, data, raw, seq, _ = sock.notify.call_args[0]
+        assert annotation == {'id': 5}
+        assert action == 'update'
+        assert json.loads(data)['payload'] == [{'id': 5}]
+
+    def test_no_send_when_socket_should_not_receive_event(self):
+        self.should.return_value = False
+        sock = FakeSocket('pidgeon')
+        broadcast_from_queue(self.queue, self._index(sock))
+        assert sock.notify.called is False
+
+    def test_records_events_in_replay_buffer(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        replay = ReplayBuffer()
+
+        broadcast_from_queue(self.queue, self._index(sock), replay)
+
+        assert len(replay) == 3
+        seqs = [c[0][4] for c in sock.notify.call_args_list]
+        assert seqs == ['{}:{}'.format(replay.epoch, n) for n in (1, 2, 3)]
+        data = sock.notify.call_args[0][2]
+        assert json.loads(data)['options'] == {'action': 'delete',
+                                               'seq': seqs[-1]}
+
+    def test_accepts_parsed_events(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        self.queue.__iter__.return_value = [ParsedMessage((
+            {'action': 'create', 'src_client_id': None,
+             'annotation': {'id': 4}},
+            '{"id": 4}'))]
+
+        broadcast_from_queue(self.queue, self._index(sock))
+
+        annotation, action, data, raw, seq, _ = sock.notify.call_args[0]
+        assert annotation == {'id': 4}
+        assert raw == '{"id": 4}'
+
+    def test_decodes_annotations_of_events_from_the_ring(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        replay = ReplayBuffer()
+        self.queue.__iter__.return_value = [ParsedMessage((
+            {'action': 'create', 'src_client_id': None},
+            '{"id": 4, "tags": ["foo"]}'))]
+
+        broadcast_from_queue(self.queue, self._index(sock), replay)
+
+        annotation, action, data, raw, seq, _ = sock.notify.call_args[0]
+        assert annotation == {'id': 4, 'tags': ['foo']}
+        [(_, (data_in, _, _))] = replay.since('{}:0'.format(replay.epoch))
+        assert data_in['annotation'] == {'id': 4, 'tags': ['foo']}
+
+    def test_tags_frames_for_named_subscriptions(self):
+        sock = FakeSocket('giraffe')
+        sock.filter = None
+        sock.named_filters = {
+            'frame-1': compile_filter(tag_filter('foo')),
+            'frame-2': compile_filter(tag_filter('bar')),
+            'frame-3': compile_filter(tag_filter('baz')),
+        }
+        self.queue.__iter__.return_value = [FakeMessage(json.dumps({
+            'action': 'create', 'src_client_id': 'pigeon',
+            'annotation': {'id': 4, 'tags': ['foo', 'baz']}}))]
+
+        broadcast_from_queue(self.queue, self._index(sock))
+
+        args = sock.notify.call_args[0]
+        assert json.loads(args[2])['options'] == {
+            'action': 'create', 'subscriptions': ['frame-1', 'frame-3']}
+        assert args[5] == ['frame-1', 'frame-3']
+
+    def test_does_not_notify_when_no_named_subscription_matches(self):
+        sock = FakeSocket('giraffe')
+        sock.filter = None
+        sock.named_filters = {'frame-1': compile_filter(tag_filter('foo'))}
+        self.queue.__iter__.return_value = [FakeMessage(json.dumps({
+            'action': 'create', 'src_client_id': 'pigeon',
+            'annotation': {'id': 4, 'tags': ['bar']}}))]
+
+        broadcast_from_queue(self.queue, self._index(sock))
+
+        assert not sock.notify.called
+
+    @requires_msgpack
+    def test_sends_msgpack_frames_to_msgpack_sockets(self):
+        self.should.return_value = True
+        json_sock = FakeSocket('giraffe')
+        msgpack_sock = FakeSocket('pigeon')
+        msgpack_sock.binary = True
+        self.queue.__iter__.return_value = self.messages[:1]
+
+        broadcast_from_queue(self.queue, self._index(json_sock,
+                                                     msgpack_sock))
+
+        packet = {'payload': [{'id': 1}],
+                  'type': 'annotation-notification',
+                  'options': {'action': 'delete'}}
+        args = json_sock.notify.call_args[0]
+        assert json.loads(args[2]) == packet
+        args = msgpack_sock.notify.call_args[0]
+        assert subprotocol.unpackb(args[2]) == packet
+        assert args[3] == subprotocol.packb({'id': 1})
+
+    def test_records_fanout_stats(self):
+        self.should.side_effect = [True, False, True, False, True, False]
+        self.queue.qsize.return_value = 2
+        stats = StreamerStats()
+        sockets = [FakeSocket('giraffe'), FakeSocket('pigeon')]
+
+        broadcast_from_queue(self.queue, self._index(*sockets), stats=stats)
+
+        assert stats.counters['events'] == 3
+        assert stats.counters['sockets.checked'] == 6
+        assert stats.counters['sockets.notified'] == 3
+        assert stats.queue_depth == 2
+        assert sum(stats.buckets) == 3
+
+    def test_only_checks_candidate_sockets(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        sock.filter = FilterHandler({
+            'match_policy': 'include_any',
+            'actions': {},
+            'clauses': [{'field': '/uri',
+                         'operator': 'one_of',
+                         'value': ['http://example.com']}],
+        })
+        broadcast_from_queue(self.queue, self._index(sock))
+        assert not self.should.called
+        assert sock.notify.called is False
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def setUp(self):
+        self.replay = ReplayBuffer(maxlen=2)
+
+    def test_sequence_ids_increase(self):
+        first = self.replay.append('a')
+        second = self.replay.append('b')
+        assert first == '{}:1'.format(self.replay.epoch)
+        assert second == '{}:2'.format(self.replay.epoch)
+        assert self.replay.current == second
+
+    def test_since_returns_following_events(self):
+        first = self.replay.append('a')
+        second = self.replay.append('b')
+        assert self.replay.since(first) == [(second, 'b')]
+        assert self.replay.since(second) == []
+
+    def test_since_start_of_epoch(self):
+        self.replay.append('a')
+        since = '{}:0'.format(self.replay.epoch)
+        assert [e for _, e in self.replay.since(since)] == ['a']
+
+    def test_since_evicted_event_returns_none(self):
+        first = self.replay.append('a')
+        for event in 'bcd':
+            self.replay.append(event)
+        assert self.replay.since(first) is None
+
+    def test_since_last_evicted_event_returns_remaining(self):
+        self.replay.append('a')
+        second = self.replay.append('b')
+        self.replay.append('c')
+        self.replay.append('d')
+        assert [e for _, e in self.replay.since(second)] == ['c', 'd']
+
+    def test_since_other_epoch_returns_none(self):
+        self.replay.append('a')
+        assert self.replay.since('other:0') is None
+
+    def test_since_invalid_ids_return_none(self):
+        self.replay.append('a')
+        epoch = self.replay.epoch
+        for seq in [None, 1, '', epoch, epoch + ':x', epoch + ':-1',
+                    epoch + ':5']:
+            assert self.replay.since(seq) is None
+
+
+class TestShouldSendEvent(unittest.TestCase):
+    def setUp(self):
+        self.sock_giraffe = FakeSocket('giraffe')
+        self.sock_giraffe.filter.match.return_value = True
+
+        self.sock_pigeon = FakeSocket('pigeon')
+
+        self.sock_roadkill = FakeSocket('roadkill')
+        self.sock_roadkill.terminated = True
+
+    def test_non_sending_socket_receives_event(self):
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        assert should_send_event(self.sock_giraffe, {}, data)
+
+    def test_sending_socket_does_not_receive_event(self):
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        assert should_send_event(self.sock_pigeon, {}, data) is False
+
+    def test_terminated_socket_does_not_recieve_event(self):
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        assert should_send_event(self.sock_roadkill, {}, data) is False
+
+    def test_should_send_event_no_filter(self):
+        self.sock_giraffe.filter = None
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        assert should_send_event(self.sock_giraffe, {}, data) is False
+
+    def test_should_send_event_doesnt_send_reads(self):
+        data = {'action': 'read', 'src_client_id': 'pigeon'}
+        assert should_send_event(self.sock_giraffe, {}, data) is False
+
+    def test_should_send_event_filtered(self):
+        self.sock_pigeon.filter.match.return_value = False
+        data = {'action': 'update', 'src_client_id': 'giraffe'}
+        assert should_send_event(self.sock_pigeon, {}, data) is False
+
+    def test_should_send_event_check_permissions(self):
+        self.sock_giraffe.state.has_permission.return_value = False
+        anno = object()
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        sock = self.sock_giraffe
+        assert should_send_event(sock, anno, data) is False
+        sock.state.has_permission.assert_called_once_with('read', anno, None)
+
+    def test_should_send_event_matches_filter_against_context(self):
+        context = MatchContext({})
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        should_send_event(self.sock_giraffe, {}, data, context)
+        self.sock_giraffe.filter.match.assert_called_once_with(context,
+                                                               'update')
+
+    def test_should_send_event_matches_shared_filter_once(self):
+        other = FakeSocket('elephant')
+        other.filter = self.sock_giraffe.filter
+        context = MatchContext({})
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+
+        assert should_send_event(self.sock_giraffe, {}, data, context)
+        assert should_send_event(other, {}, data, context)
+        assert self.sock_giraffe.filter.match.call_count == 1
+
+    def test_should_send_event_checks_permissions_once_per_principals(self):
+        registry = MagicMock()
+        policy = registry.queryUtility.return_value
+        policy.permits.return_value = True
+        other = FakeSocket('elephant')
+        other.filter.match.return_value = True
+        for sock in (self.sock_giraffe, other):
+            sock.state = SocketState(
+                registry, principals=frozenset(['system.Everyone']))
+        anno = {}
+        context = MatchContext(anno)
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+
+        assert should_send_event(self.sock_giraffe, anno, data, context)
+        assert should_send_event(other, anno, data, context)
+        policy.permits.assert_called_once_with(
+            anno, frozenset(['system.Everyone']), 'read')
+
+    def test_should_send_event_denies_by_principals(self):
+        registry = MagicMock()
+        registry.queryUtility.return_value.permits.return_value = False
+        self.sock_giraffe.state = SocketState(
+            registry, principals=frozenset(['system.Everyone']))
+        context = MatchContext({})
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+
+        assert not should_send_event(self.sock_giraffe, {}, data, context)
+
+    def test_should_send_event_does_not_send_nipsad_annotations(self):
+        """Users should not see annotations from NIPSA'd users."""
+        annotation = {'user': 'fred', 'nipsa': True}
+        socket = Mock(terminated=False, client_id='foo', named_filters=None)
+        socket.state = SocketState(MagicMock(), userid='jim')
+        event_data = {'action': 'create', 'src_client_id': 'bar'}
+
+        assert not should_send_event(socket, annotation, event_data)
+
+    def test_should_send_event_does_send_nipsad_annotations(self):
+        """NIPSA'd users should see their own annotations."""
+        annotation = {'user': 'fred', 'nipsa': True}
+        socket = Mock(terminated=False, client_id='foo', named_filters=None)
+        # The annotation creator.
+        socket.state = SocketState(MagicMock(), userid='fred')
+        event_data = {'action': 'create', 'src_client_id': 'bar'}
+
+        assert should_send_event(socket, annotation, event_data)
+
+
+class TestEventRing(object):
+    def test_writer_writes_parsed_events(self, tmpdir):
+        path = str(tmpdir.join('events'))
+        request = MagicMock()
+        request.registry.settings = {'h.streamer.event_ring.path': path,
+                                     'h.streamer.event_ring.size': '4096'}
+        reader = request.get_queue_reader.return_value
+        ring = RingReader(path)
+
+        def start(block):
+            ring.read()
+            handler = reader.on_message.connect.call_args[0][0]
+            handler(reader, FakeMessage('{"action": "create", '
+                                        '"annotation": {"id": 1}}'))
+        reader.start.side_effect = start
+
+        event_ring_writer(request)
+
+        request.get_queue_reader.assert_called_once_with('annotations', ANY)
+        records = [_load_event(r) for r in ring.read()]
+        assert records == [({'action': 'create'}, '{"id": 1}')]
+
+    def test_writer_skips_invalid_events(self, tmpdir):
+        path = str(tmpdir.join('events'))
+        request = MagicMock()
+        request.registry.settings = {'h.streamer.event_ring.path': path,
+                                     'h.streamer.event_ring.size': '4096'}
+        reader = request.get_queue_reader.return_value
+        ring = RingReader(path)
+
+        def start(block):
+            ring.read()
+            handler = reader.on_message.connect.call_args[0][0]
+            handler(reader, FakeMessage('{"action": "create"}'))
+            handler(reader, FakeMessage('{"action": "create", '
+                                        '"annotation": {"id": 1}}'))
+        reader.start.side_effect = start
+
+        event_ring_writer(request)
+
+        assert [_load_event(r)[1] for r in ring.read()] == ['{"id": 1}']
+
+    def test_reader_queues_parsed_events(self, tmpdir):
+        path = str(tmpdir.join('events'))
+        writer = RingWriter(path, capacity=4096)
+        ring = RingReader(path)
+        ring.read()
+        event = ({'action': 'create', 'annotation': {'id': 1}}, '{"id": 1}')
+        writer.append(_dump_event(event))
+        queue = gevent.queue.Queue()
+
+        greenlet = gevent.spawn(read_event_ring, ring, queue, 0.001)
+        try:
+            assert queue.get(timeout=1).event == ({'action': 'create'},
+                                                  '{"id": 1}')
+        finally:
+            greenlet.kill()
+
+    def test_reader_skips_invalid_records(self, tmpdir):
+        path = str(tmpdir.join('events'))
+        writer = RingWriter(path, capacity=4096)
+        ring = RingReader(path)
+        ring.read()
+        event = ({'action': 'create', 'annotation': {'id': 1}}, '{"id": 1}')
+        writer.append('garbage')
+        writer.append(_dump_event(event))
+        queue = gevent.queue.Queue()
+
+        greenlet = gevent.spawn(read_event_ring, ring, queue, 0.001)
+        try:
+            assert queue.get(timeout=1).event == ({'action': 'create'},
+                                                  '{"id": 1}')
+        finally:
+            greenlet.kill()
+
+    def test_reader_resets_ring_after_errors(self):
+        ring = MagicMock()
+        ring.read.side_effect = [IOError()] + [[]] * 100
+        queue = gevent.queue.Queue()
+
+        greenlet = gevent.spawn(read_event_ring, ring, queue, 0.001)
+        try:
+            gevent.sleep(0.01)
+            assert ring.reset.call_count == 1
+            assert not greenlet.dead
+        finally:
+            greenlet.kill()
+
+    def test_events_round_trip(self):
+        raw = '{"id": 1,\n "text": "caf\xc3\xa9"}'
+        event = ({'action': 'update', 'annotation': {'id': 1}}, raw)
+        assert _load_event(_dump_event(event)) == ({'action': 'update'}, raw)
+
+    def test_record_holds_the_annotation_once(self):
+        event = ({'action': 'update', 'annotation': {'id': 'giraffe'}},
+                 '{"id": "giraffe"}')
+        record = _dump_event(event)
+        assert record.count('giraffe') == 1
+        assert record == '{"action": "update"}\n{"id": "giraffe"}'
+
+    def test_load_rejects_records_without_event_data(self):
+        with pytest.raises(ValueError):
+            _load_event('[]\n{"id": 1}')
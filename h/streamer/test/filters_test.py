@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from mock import MagicMock
+from mock import patch
+from pyramid.testing import DummyRequest
+
+from h.streamer.filters import CompiledFilter
+from h.streamer.filters import FilterHandler
+from h.streamer.filters import FilterToElasticFilter
+from h.streamer.filters import MatchContext
+from h.streamer.filters import _compiled_filters
+from h.streamer.filters import _filter_key
+from h.streamer.filters import compile_filter
+
+
+# Tests for the FilterToElasticFilter class
+# this class needs a python request, and a filter json object as the input
+def test_zero_clauses():
+    """No condition is given so a match_all query should be generated
+    """
+    request = DummyRequest()
+    filter_json = {
+        'clauses': [],
+    }
+
+    fef = FilterToElasticFilter(filter_json, request)
+    assert fef.query['query']['filtered']['query'] == {"match_all": {}}
+
+
+def test_policy_include_any():
+    request = DummyRequest()
+    filter_json = {
+        'match_policy': 'include_any',
+        'clauses': [{
+            'field': 'text',
+            'operator': 'equals',
+            'value': 'foo',
+            'options': {}
+        }, {
+            'field': 'tag',
+            'operator': 'equals',
+            'value': 'bar',
+            'options': {}
+        }],
+    }
+
+    fef = FilterToElasticFilter(filter_json, request)
+    assert 'should' in fef.query['query']['filtered']['query']['bool']
+
+
+def test_policy_include_all():
+    request = DummyRequest()
+    filter_json = {
+        'match_policy': 'include_all',
+        'clauses': [{
+            'field': 'text',
+            'operator': 'equals',
+            'value': 'foo',
+            'options': {}
+        }, {
+            'field': 'tag',
+            'operator': 'equals',
+            'value': 'bar',
+            'options': {}
+        }],
+    }
+
+    fef = FilterToElasticFilter(filter_json, request)
+    assert 'must' in fef.query['query']['filtered']['query']['bool']
+
+
+def test_policy_exclude_any():
+    request = DummyRequest()
+    filter_json = {
+        'match_policy': 'exclude_any',
+        'clauses': [{
+            'field': 'text',
+            'operator': 'equals',
+            'value': 'foo',
+            'options': {}
+        }, {
+            'field': 'tag',
+            'operator': 'equals',
+            'value': 'bar',
+            'options': {}
+        }],
+    }
+
+    fef = FilterToElasticFilter(filter_json, request)
+    assert 'must_not' in fef.query['query']['filtered']['query']['bool']
+
+
+def test_policy_exclude_all():
+    request = DummyRequest()
+    filter_json = {
+        'match_policy': 'exclude_all',
+        'clauses': [{
+            'field': 'text',
+            'operator': 'equals',
+            'value': 'foo',
+            'options': {}
+        }, {
+            'field': 'tag',
+            'operator': 'equals',
+            'value': 'bar',
+            'options': {}
+        }],
+    }
+
+    fef = FilterToElasticFilter(filter_json, request)
+    assert 'must' in (
+        fef.query['query']['filtered']['query']['bool']['must_not']['bool'])
+
+
+def test_operator_call():
+    request = DummyRequest()
+
+    filter_json = {
+        'match_policy': 'include_all',
+        'clauses': [{
+            'field': '/text',
+            'operator': 'equals',
+            'value': 'foo bar',
+            'options': {
+                'es': {
+                    'query_type': 'simple'
+                }
+            }
+        }],
+    }
+
+    generated = FilterToElasticFilter(filter_json, request)
+    query = generated.query['query']['filtered']['query']['bool']['must'][0]
+    expected = 'foo bar'
+
+    assert query['term']['text'] == expected
+
+
+COMPILED_FILTER_ANNOTATIONS = [
+    {},
+    {'uri': 'http://example.com', 'user': 'acct:giraffe@example.com',
+     'tags': ['Foo', 'bar'], 'text': u'Caf\xe9 society',
+     'references': ['abc', 'def'], 'created': '2015-01-02'},
+    {'uri': 'http://example.org', 'user': 'acct:pigeon@example.com',
+     'tags': [], 'text': 'nothing to see', 'references': ['xyz'],
+     'created': '2014-06-07'},
+    {'uri': 'HTTP://EXAMPLE.COM', 'tags': ['baz'], 'quote': 'foo',
+     'target': [{'source': 'http://example.com'}]},
+]
+
+
+COMPILED_FILTER_CLAUSES = [
+    {'field': '/uri', 'operator': 'one_of',
+     'value': ['http://example.com', 'http://example.net']},
+    {'field': '/uri', 'operator': 'one_of', 'value': 'example'},
+    {'field': '/uri', 'operator': 'equals', 'value': 'http://example.com'},
+    {'field': '/user', 'operator': 'matches', 'value': 'giraffe'},
+    {'field': '/tags', 'operator': 'match_of', 'value': ['foo', 'baz']},
+    {'field': '/tags', 'operator': 'one_of', 'value': 'bar'},
+    {'field': '/text', 'operator': 'matches', 'value': 'cafe'},
+    {'field': '/text', 'operator': 'match_of', 'value': ['nothing', 'x']},
+    {'field': '/references', 'operator': 'first_of', 'value': 'abc'},
+    {'field': '/references', 'operator': 'lenge', 'value': 2},
+    {'field': '/created', 'operator': 'gt', 'value': '2015-01-01'},
+    {'field': '/target/0/source', 'operator': 'equals',
+     'value': 'http://example.com'},
+    {'field': ['/quote', '/text'], 'operator': 'matches', 'value': 'foo'},
+]
+
+
+class TestCompiledFilter(unittest.TestCase):
+    def _assert_equivalent(self, filter_json):
+        handler = FilterHandler(filter_json)
+        compiled = CompiledFilter(filter_json)
+        for annotation in COMPILED_FILTER_ANNOTATIONS:
+            for action in [None, 'past', 'create', 'delete']:
+                expected = handler.match(annotation, action)
+                result = compiled.match(annotation, action)
+                assert result == expected, (filter_json, annotation, action)
+
+    def test_single_clauses_match_like_filter_handler(self):
+        for policy in ['include_any', 'include_all',
+                       'exclude_any', 'exclude_all']:
+            for clause in COMPILED_FILTER_CLAUSES:
+                self._assert_equivalent({
+                    'match_policy': policy,
+                    'actions': {'create': True},
+                    'clauses': [clause],
+                })
+
+    def test_clause_pairs_match_like_filter_handler(self):
+        clauses = COMPILED_FILTER_CLAUSES
+        for policy in ['include_any', 'include_all',
+                       'exclude_any', 'exclude_all']:
+            for first, second in zip(clauses, clauses[1:] + clauses[:1]):
+                self._assert_equivalent({
+                    'match_policy': policy,
+                    'actions': {'create': True, 'update': True},
+                    'clauses': [first, second],
+                })
+
+    def test_no_clauses_matches_everything(self):
+        self._assert_equivalent({
+            'match_policy': 'include_any',
+            'actions': {'create': True},
+            'clauses': [],
+        })
+
+    def test_compile_filter_shares_equivalent_filters(self):
+        first = compile_filter({
+            'name': 'first',
+            'match_policy': 'include_any',
+            'actions': {'create': True, 'delete': True},
+            'clauses': [{'field': '/uri', 'operator': 'one_of',
+                         'value': ['http://example.com']}],
+        })
+        second = compile_filter({
+            'name': 'second',
+            'actions': {'delete': True, 'create': True},
+            'clauses': [{'value': ['http://example.com'],
+                         'operator': 'one_of', 'field': '/uri'}],
+            'match_policy': 'include_any',
+        })
+        assert first is second
+
+    def test_compile_filter_distinguishes_different_filters(self):
+        filters = [compile_filter({
+            'match_policy': 'include_any',
+            'actions': {'create': True},
+            'clauses': [{'field': '/uri', 'operator': 'one_of',
+                         'value': [uri]}],
+        }) for uri in ['http://example.com', 'http://example.org']]
+        assert filters[0] is not filters[1]
+
+    def test_compile_filter_forgets_unused_filters(self):
+        filter_json = {'match_policy': 'include_any', 'actions': {},
+                       'clauses': []}
+        compiled = compile_filter(filter_json)
+        assert compile_filter(filter_json) is compiled
+        del compiled
+        assert _filter_key(filter_json) not in _compiled_filters
+
+    def test_unknown_operator_raises_when_compiled(self):
+        with self.assertRaises(KeyError):
+            CompiledFilter({
+                'match_policy': 'include_any',
+                'actions': {},
+                'clauses': [{'field': '/uri', 'operator': 'nope',
+                             'value': 'foo'}],
+            })
+
+
+class TestMatchContext(unittest.TestCase):
+    def test_folded_resolves_and_folds_field(self):
+        context = MatchContext({'text': u'Caf\xe9', 'tags': ['Foo']})
+        assert context.folded('/text') == u'cafe'
+        assert context.folded('/tags') == [u'foo']
+
+    def test_folded_returns_none_for_missing_field(self):
+        context = MatchContext({})
+        assert context.folded('/text') is None
+
+    def test_folded_caches_values(self):
+        context = MatchContext({'text': 'foo'})
+        resolve = MagicMock(return_value='foo')
+        context.folded('/text', resolve)
+        context.folded('/text', resolve)
+        assert resolve.call_count == 1
+
+    def test_filters_share_folded_values(self):
+        context = MatchContext({'text': 'Foo'})
+        filters = [CompiledFilter({
+            'match_policy': 'include_any',
+            'actions': {},
+            'clauses': [{'field': '/text', 'operator': 'matches',
+                         'value': value}],
+        }) for value in ['foo', 'bar']]
+
+        with patch('h.streamer.filters.uni_fold') as uni_fold:
+            uni_fold.side_effect = lambda text: text.lower()
+            results = [f.match(context) for f in filters]
+
+        assert results == [True, False]
+        # Clause values were folded when the filters were compiled, so the
+        # only folding left to do is that of the shared field value.
+        assert uni_fold.call_count == 1
+
+    def test_matches_caches_results_per_filter_and_action(self):
+        context = MatchContext({})
+        filter = MagicMock()
+        filter.match.side_effect = [True, False]
+        assert context.matches(filter, 'create')
+        assert context.matches(filter, 'create')
+        assert not context.matches(filter, 'delete')
+        assert filter.match.call_count == 2
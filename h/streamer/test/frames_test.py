@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from h.streamer.frames import _annotation_frame
+from h.streamer.frames import _annotation_packet
+
+
+class TestAnnotationFrame(object):
+    @pytest.mark.parametrize('seq,subscriptions', [
+        (None, None),
+        ('e:1', None),
+        (None, ['a', 'b']),
+        ('e:1', [None, 'a']),
+    ])
+    def test_matches_encoded_packet(self, seq, subscriptions):
+        annotations = [{'id': 'a'}, {'id': 'b', 'text': u'caf\xe9'}]
+        frame = _annotation_frame([json.dumps(a) for a in annotations],
+                                  'create', seq, subscriptions)
+        packet = _annotation_packet(annotations, 'create')
+        if seq is not None:
+            packet['options']['seq'] = seq
+        if subscriptions is not None:
+            packet['options']['subscriptions'] = subscriptions
+        assert json.loads(frame) == packet
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Objects shared by the tests for h.streamer."""
+from collections import namedtuple
+
+import pytest
+from mock import MagicMock
+
+from h.api.queue import shard_for_uri
+from h.streamer import subprotocol
+
+
+FakeMessage = namedtuple('FakeMessage', 'body')
+
+requires_msgpack = pytest.mark.skipif(not subprotocol.available(),
+                                      reason='msgpack is not installed')
+
+
+class FakeSocket(object):
+    binary = False
+    client_id = None
+    filter = None
+    named_filters = None
+    state = None
+    terminated = None
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.terminated = False
+        self.filter = MagicMock()
+        self.state = MagicMock()
+        self.send = MagicMock()
+        self.notify = MagicMock()
+
+
+def has_ordered_sublist(lst, sublist):
+    """
+    Determines whether the passed list contains, in the specified order, all
+    the elements in sublist.
+    """
+    sub_idx = 0
+    max_idx = len(sublist) - 1
+    for x in lst:
+        if x == sublist[sub_idx]:
+            sub_idx += 1
+        if sub_idx > max_idx:
+            return True
+    return sub_idx > max_idx
+
+
+class ObjectIncluding(object):
+    def __init__(self, include):
+        self.include = include
+
+    def __eq__(self, other):
+        try:
+            for k, v in self.include.items():
+                if other[k] != v:
+                    return False
+        except (KeyError, TypeError):
+            return False
+        else:
+            return True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def tag_filter(tag):
+    return {
+        'match_policy': 'include_any',
+        'actions': {'create': True, 'update': True, 'delete': True},
+        'clauses': [{'field': '/tags', 'operator': 'match_of',
+                     'value': [tag]}],
+    }
+
+
+def uri_in_shard(shard, shards, path='/'):
+    for i in range(1000):
+        uri = 'http://example{}.com{}'.format(i, path)
+        if shard_for_uri(uri, shards) == shard:
+            return uri
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import pytest
+
+from h.streamer.filters import FilterHandler
+from h.streamer.index import SubscriptionIndex
+from h.streamer.test.helpers import FakeSocket
+
+
+def _uri_filter(*uris, **kwargs):
+    return FilterHandler({
+        'match_policy': kwargs.get('match_policy', 'include_any'),
+        'actions': {},
+        'clauses': [{'field': '/uri',
+                     'operator': 'one_of',
+                     'value': list(uris)}],
+    })
+
+
+def _range_filter(field, operator_, value):
+    return FilterHandler({
+        'match_policy': 'include_any',
+        'actions': {},
+        'clauses': [{'field': field, 'operator': operator_, 'value': value}],
+    })
+
+
+class TestSubscriptionIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def _socket(self, filter_handler):
+        sock = FakeSocket('giraffe')
+        sock.filter = filter_handler
+        self.index.add(sock)
+        return sock
+
+    def test_candidates_includes_sockets_watching_uri(self):
+        sock = self._socket(_uri_filter('http://example.com'))
+        result = self.index.candidates({'uri': 'http://example.com'})
+        assert result == set([sock])
+
+    def test_candidates_excludes_sockets_watching_other_uris(self):
+        self._socket(_uri_filter('http://example.com'))
+        result = self.index.candidates({'uri': 'http://example.org'})
+        assert result == set()
+
+    def test_candidates_folds_values(self):
+        sock = self._socket(_uri_filter(u'http://EXAMPLE.com/caf\xe9'))
+        result = self.index.candidates({'uri': u'http://example.com/cafe'})
+        assert result == set([sock])
+
+    def test_candidates_matches_tags(self):
+        sock = self._socket(FilterHandler({
+            'match_policy': 'include_any',
+            'actions': {},
+            'clauses': [{'field': '/tags',
+                         'operator': 'match_of',
+                         'value': ['foo', 'bar']}],
+        }))
+        result = self.index.candidates({'tags': ['baz', 'bar']})
+        assert result == set([sock])
+
+    def test_include_all_indexes_by_single_clause(self):
+        sock = self._socket(FilterHandler({
+            'match_policy': 'include_all',
+            'actions': {},
+            'clauses': [{'field': '/uri',
+                         'operator': 'one_of',
+                         'value': ['http://example.com']},
+                        {'field': '/text',
+                         'operator': 'matches',
+                         'value': 'foo'}],
+        }))
+        assert self.index.candidates({'uri': 'http://example.com'}) == set(
+            [sock])
+        assert self.index.candidates({'text': 'foo'}) == set()
+
+    def test_include_any_with_unindexable_clause_uses_fallback(self):
+        sock = self._socket(FilterHandler({
+            'match_policy': 'include_any',
+            'actions': {},
+            'clauses': [{'field': '/uri',
+                         'operator': 'one_of',
+                         'value': ['http://example.com']},
+                        {'field': '/text',
+                         'operator': 'matches',
+                         'value': 'foo'}],
+        }))
+        assert self.index.candidates({'text': 'foo'}) == set([sock])
+
+    def test_exclude_policies_use_fallback(self):
+        sock = self._socket(_uri_filter('http://example.com',
+                                        match_policy='exclude_any'))
+        assert self.index.candidates({'uri': 'http://example.org'}) == set(
+            [sock])
+
+    def test_empty_clauses_use_fallback(self):
+        sock = self._socket(FilterHandler({
+            'match_policy': 'include_any',
+            'actions': {},
+            'clauses': [],
+        }))
+        assert self.index.candidates({}) == set([sock])
+
+    def test_add_reindexes_socket(self):
+        sock = self._socket(_uri_filter('http://example.com'))
+        sock.filter = _uri_filter('http://example.org')
+        self.index.add(sock)
+        assert self.index.candidates({'uri': 'http://example.com'}) == set()
+        assert self.index.candidates({'uri': 'http://example.org'}) == set(
+            [sock])
+
+    def test_indexes_all_named_filters(self):
+        sock = FakeSocket('giraffe')
+        sock.filter = None
+        sock.named_filters = {'a': _uri_filter('http://example.com'),
+                              'b': _uri_filter('http://example.org')}
+        self.index.add(sock)
+        assert self.index.candidates({'uri': 'http://example.com'}) == set(
+            [sock])
+        assert self.index.candidates({'uri': 'http://example.org'}) == set(
+            [sock])
+        assert self.index.candidates({'uri': 'http://example.net'}) == set()
+
+    def test_unindexable_named_filter_uses_fallback(self):
+        sock = FakeSocket('giraffe')
+        sock.named_filters = {'a': _uri_filter('http://example.com'),
+                              'b': _uri_filter('http://example.org',
+                                               match_policy='exclude_any')}
+        self.index.add(sock)
+        assert self.index.candidates({'uri': 'http://example.net'}) == set(
+            [sock])
+
+    def test_discard_removes_socket(self):
+        sock = self._socket(_uri_filter('http://example.com'))
+        self.index.discard(sock)
+        assert self.index.candidates({'uri': 'http://example.com'}) == set()
+        assert len(self.index) == 0
+
+
+class TestSubscriptionIndexRanges(object):
+    def setup_method(self, method):
+        self.index = SubscriptionIndex()
+
+    def _socket(self, filter_handler):
+        sock = FakeSocket('giraffe')
+        sock.filter = filter_handler
+        self.index.add(sock)
+        return sock
+
+    @pytest.mark.parametrize('operator_,value,expected', [
+        ('gt', '2015-10-01', True),
+        ('gt', '2015-11-01', False),
+        ('ge', '2015-10-27', True),
+        ('lt', '2015-10-27', False),
+        ('le', '2015-10-27', True),
+        ('lt', '2015-11-01', True),
+    ])
+    def test_candidates_matches_range_clauses(self, operator_, value,
+                                              expected):
+        sock = self._socket(_range_filter('/created', operator_, value))
+        result = self.index.candidates({'created': '2015-10-27'})
+        assert (sock in result) == expected
+
+    @pytest.mark.parametrize('operator_,value,expected', [
+        ('lene', 2, True),
+        ('lene', 3, False),
+        ('leng', 1, True),
+        ('leng', 2, False),
+        ('lenge', 2, True),
+        ('lenl', 2, False),
+        ('lenle', 2, True),
+    ])
+    def test_candidates_matches_length_clauses(self, operator_, value,
+                                               expected):
+        sock = self._socket(_range_filter('/tags', operator_, value))
+        result = self.index.candidates({'tags': ['foo', 'bar']})
+        assert (sock in result) == expected
+
+    @pytest.mark.parametrize('operator_', ['gt', 'ge', 'lt', 'le'])
+    def test_range_candidates_agree_with_filter(self, operator_):
+        thresholds = [0, 1, 5, 5, 9, 2.5, -3]
+        socks = [self._socket(_range_filter('/n', operator_, t))
+                 for t in thresholds]
+        for n in [-5, 0, 2.5, 5, 7, 10]:
+            result = self.index.candidates({'n': n})
+            assert result == set(s for s in socks if s.filter.match({'n': n}))
+
+    def test_range_candidates_exclude_missing_fields(self):
+        self._socket(_range_filter('/created', 'gt', '2015-10-01'))
+        assert self.index.candidates({}) == set()
+
+    def test_range_candidates_include_all_for_uncomparable_values(self):
+        sock = self._socket(_range_filter('/created', 'gt', '2015-10-01'))
+        assert self.index.candidates({'created': ['x']}) == set([sock])
+
+    def test_include_all_prefers_equality_clauses(self):
+        sock = self._socket(FilterHandler({
+            'match_policy': 'include_all',
+            'actions': {},
+            'clauses': [{'field': '/created',
+                         'operator': 'gt',
+                         'value': '2015-10-01'},
+                        {'field': '/uri',
+                         'operator': 'equals',
+                         'value': 'http://example.com'}],
+        }))
+        assert self.index.candidates({'uri': 'http://example.com'}) == set(
+            [sock])
+        assert self.index.candidates({'created': '2015-10-27'}) == set()
+
+    def test_discard_removes_range_socket(self):
+        sock = self._socket(_range_filter('/created', 'gt', '2015-10-01'))
+        other = self._socket(_range_filter('/created', 'gt', '2015-10-01'))
+        self.index.discard(sock)
+        assert self.index.candidates({'created': '2015-10-27'}) == set(
+            [other])
+        self.index.discard(other)
+        assert self.index._columns == {}
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from h.streamer.shards import _filter_shard
+from h.streamer.test.helpers import uri_in_shard
+
+
+class TestFilterShard(object):
+    def _filter(self, match_policy, *clauses):
+        return {'match_policy': match_policy, 'actions': {},
+                'clauses': list(clauses)}
+
+    def _uri_clause(self, *uris):
+        return {'field': '/uri', 'operator': 'one_of', 'value': list(uris)}
+
+    def test_uri_filter(self):
+        uris = [uri_in_shard(2, 4, '/a'), uri_in_shard(2, 4, '/b')]
+        payload = self._filter('include_any', self._uri_clause(*uris))
+        assert _filter_shard(payload, 4) == 2
+
+    def test_uris_in_different_shards(self):
+        payload = self._filter('include_any', self._uri_clause(
+            uri_in_shard(1, 4), uri_in_shard(2, 4)))
+        assert _filter_shard(payload, 4) is None
+
+    def test_include_any_with_other_clause(self):
+        payload = self._filter(
+            'include_any',
+            self._uri_clause(uri_in_shard(1, 4)),
+            {'field': '/user', 'operator': 'equals', 'value': 'acct:a@b'})
+        assert _filter_shard(payload, 4) is None
+
+    def test_include_all_with_other_clause(self):
+        payload = self._filter(
+            'include_all',
+            self._uri_clause(uri_in_shard(1, 4)),
+            {'field': '/user', 'operator': 'equals', 'value': 'acct:a@b'})
+        assert _filter_shard(payload, 4) == 1
+
+    def test_exclude_policy(self):
+        payload = self._filter('exclude_any',
+                               self._uri_clause(uri_in_shard(1, 4)))
+        assert _filter_shard(payload, 4) is None
+
+    def test_no_clauses(self):
+        assert _filter_shard(self._filter('include_any'), 4) is None
@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import json
+import struct
+
+import gevent
+import pytest
+from mock import ANY
+from mock import MagicMock
+from mock import patch
+from pyramid.testing import DummyRequest
+from ws4py.framing import Frame, OPCODE_CLOSE, OPCODE_TEXT
+from ws4py.messaging import BinaryMessage
+
+from h.api.search import query as search_query
+from h.streamer import deflate
+from h.streamer import subprotocol
+from h.streamer.cache import ExpansionCache
+from h.streamer.delivery import SendQueue
+from h.streamer.events import ReplayBuffer
+from h.streamer.events import read_event_ring
+from h.streamer.index import SubscriptionIndex
+from h.streamer.sockets import SocketState
+from h.streamer.sockets import WebSocket
+from h.streamer.stats import StreamerStats
+from h.streamer.test.helpers import requires_msgpack
+from h.streamer.test.helpers import tag_filter
+from h.streamer.test.helpers import uri_in_shard
+from h.streamer.views import websocket_stats
+
+
+class TestWebSocket(unittest.TestCase):
+    def setUp(self):
+        fake_request = MagicMock()
+        fake_request.registry.settings = {}
+        fake_socket = MagicMock()
+
+        self.request = fake_request
+        self.s = WebSocket(fake_socket)
+        self.s.request = fake_request
+        self.s.state = SocketState(fake_request.registry)
+
+        # Each test should start its own queue reader.
+        self.event_queue_patcher = patch.object(WebSocket, 'event_queue',
+                                                None)
+        self.event_queue_patcher.start()
+        self.timers_patcher = patch.object(WebSocket, 'timers', None)
+        self.timers_patcher.start()
+        self.uri_cache_patcher = patch.object(WebSocket, 'uri_cache',
+                                              ExpansionCache())
+        self.uri_cache_patcher.start()
+        self.stats_patcher = patch.multiple(WebSocket,
+                                            stats=StreamerStats(),
+                                            stats_reporter=None)
+        self.stats_patcher.start()
+        self.stats_client_patcher = patch('h.streamer.sockets.stats_client')
+        self.stats_client = self.stats_client_patcher.start()
+
+    def tearDown(self):
+        self.event_queue_patcher.stop()
+        self.timers_patcher.stop()
+        self.uri_cache_patcher.stop()
+        self.stats_patcher.stop()
+        self.stats_client_patcher.stop()
+
+    def test_opened_starts_reader(self):
+        self.s.opened()
+        self.request.get_queue_reader.assert_called_once_with('annotations',
+                                                             ANY)
+
+    def test_opened_stores_principals(self):
+        self.request.effective_principals = ['system.Everyone', 'acct:a@b']
+        self.s.opened()
+        assert self.s.state.principals == frozenset(['system.Everyone',
+                                                     'acct:a@b'])
+
+    def test_opened_without_authentication_policy_stores_no_principals(self):
+        self.request.registry.queryUtility.return_value = None
+        self.s.opened()
+        assert self.s.state.principals is None
+
+    def test_opened_stores_userid(self):
+        self.request.authenticated_userid = u'acct:giraffe@example.com'
+        self.s.opened()
+        assert self.s.state.userid == 'acct:giraffe@example.com'
+
+    def test_opened_releases_request(self):
+        request = self.request
+        self.s.opened()
+        assert request.tm.commit.called
+        assert self.s.request is None
+        assert self.s.environ is None
+
+    def test_opened_does_not_start_reader_without_streamer_feature(self):
+        request = self.request
+        request.feature.return_value = False
+        self.s.opened()
+        assert not self.s.state.feature('streamer')
+        assert not request.get_queue_reader.called
+
+    def test_opened_watches_socket_with_timers(self):
+        self.request.registry.settings.update({
+            'h.streamer.heartbeat.interval': '20',
+            'h.streamer.idle_timeout': '600',
+        })
+        self.s.opened()
+        assert len(WebSocket.timers) == 1
+        assert WebSocket.timers.interval == 20
+        assert WebSocket.timers.idle_timeout == 600
+
+    def test_does_not_start_heartbeat_thread(self):
+        assert self.s.heartbeat_freq is None
+
+    def test_closed_stops_watching_socket(self):
+        self.s.opened()
+        self.s.closed(1000)
+        assert len(WebSocket.timers) == 0
+
+    def test_process_records_activity(self):
+        self.s.opened()
+        WebSocket.timers.now += 5
+        self.s.process('\x8a\x80abcd')  # A masked, empty pong.
+        assert self.s.last_received == WebSocket.timers.now
+
+    def test_counts_opened_and_closed_sockets(self):
+        self.s.opened()
+        assert WebSocket.stats.open_sockets == 1
+        self.s.closed(1000)
+        assert WebSocket.stats.open_sockets == 0
+        assert WebSocket.stats.counters['connections.closed'] == 1
+
+    def test_opened_starts_stats_reporter(self):
+        self.s.opened()
+        assert WebSocket.stats_reporter is not None
+        self.stats_client.assert_called_once_with(self.request)
+
+    def test_stats_reporter_can_be_disabled(self):
+        self.request.registry.settings.update({
+            'h.streamer.stats_interval': '0',
+        })
+        self.s.opened()
+        assert WebSocket.stats_reporter is None
+
+    def test_stats_view_returns_snapshot(self):
+        self.s.opened()
+        snapshot = websocket_stats(DummyRequest())
+        assert snapshot['fanout']['open_sockets'] == 1
+        assert snapshot['heartbeats']['live'] == 1
+        assert snapshot['uri_cache'] == {'size': 0, 'hits': 0, 'misses': 0}
+        json.dumps(snapshot)
+
+    def test_opened_starts_send_queue(self):
+        self.s.opened()
+        assert isinstance(self.s.send_queue, SendQueue)
+        assert self.s.send_queue.policy == 'drop_oldest'
+
+    def test_opened_configures_send_queue(self):
+        self.request.registry.settings.update({
+            'h.streamer.send_queue.size': '5',
+            'h.streamer.send_queue.policy': 'disconnect',
+        })
+        self.s.opened()
+        assert self.s.send_queue.maxsize == 5
+        assert self.s.send_queue.policy == 'disconnect'
+
+    def test_push_queues_frames_once_opened(self):
+        self.s.send_queue = MagicMock()
+        self.s.push('data', key='id')
+        self.s.send_queue.put.assert_called_once_with('data', 'id', False)
+
+    def test_close_is_left_to_busy_writer(self):
+        self.s.send_queue = MagicMock(closed=False, idle=False)
+        with patch('ws4py.websocket.WebSocket.close') as close:
+            self.s.close(1000, 'idle timeout')
+        self.s.send_queue.finish.assert_called_once_with(1000,
+                                                         'idle timeout')
+        assert not close.called
+
+    def test_close_is_sent_directly_when_writer_idle(self):
+        self.s.send_queue = MagicMock(closed=False, idle=True)
+        with patch('ws4py.websocket.WebSocket.close') as close:
+            self.s.close(1000, 'idle timeout')
+        assert self.s.send_queue.close.called
+        close.assert_called_once_with(1000, 'idle timeout')
+
+    def test_client_close_is_answered_with_frames_pending(self):
+        sock = MagicMock()
+        self.s.sock = sock
+        self.s.send_queue = SendQueue(MagicMock(), self.s.drop)
+        self.s.send_queue.put('event')
+        frame = Frame(opcode=OPCODE_CLOSE, body=struct.pack('!H', 1001),
+                      fin=1, masking_key='abcd').build()
+
+        assert not self.s.process(frame)
+
+        assert self.s.send_queue.closed
+        assert len(self.s.send_queue) == 0
+        assert self.s.server_terminated
+        sent = ''.join(c[0][0] for c in sock.sendall.call_args_list)
+        assert sent.startswith('\x88')
+
+    def test_invalid_compressed_message_closes_with_frames_pending(self):
+        s = self._deflate_socket()
+        s.send_queue = SendQueue(MagicMock(), s.drop)
+        s.send_queue.put('event')
+        frame = Frame(opcode=OPCODE_TEXT, body='not deflate', fin=1,
+                      rsv1=1, masking_key='abcd').build()
+
+        assert not s.process(frame)
+
+        assert s.send_queue.closed
+        assert s.server_terminated
+
+    def test_writes_do_not_interleave(self):
+        written = []
+
+        def sendall(data):
+            written.append(data + ' start')
+            gevent.sleep(0.001)
+            written.append(data + ' end')
+        self.s.sock = MagicMock()
+        self.s.sock.sendall.side_effect = sendall
+        writers = [gevent.spawn(self.s._write, name)
+                   for name in ('frame', 'pong')]
+        gevent.joinall(writers, timeout=1)
+        assert written == ['frame start', 'frame end',
+                           'pong start', 'pong end']
+
+    def test_drop_closes_socket(self):
+        with patch.object(WebSocket, 'close') as close:
+            self.s.drop(1013, 'slow consumer')
+        close.assert_called_once_with(1013, 'slow consumer')
+
+    def test_drop_closes_connection_when_close_fails(self):
+        with patch.object(WebSocket, 'close', side_effect=IOError), \
+                patch.object(WebSocket, 'close_connection') as close_conn:
+            self.s.drop(1011, 'send failed')
+        assert close_conn.called
+        assert self.s.server_terminated
+
+    def test_opened_without_delivery_window(self):
+        self.s.opened()
+        assert self.s.delivery_window is None
+
+    def test_opened_configures_delivery_window(self):
+        self.request.registry.settings.update({
+            'h.streamer.delivery_window_ms': '50',
+        })
+        self.s.opened()
+        assert self.s.delivery_window.window == 0.05
+
+    def test_notify_pushes_packet_without_delivery_window(self):
+        self.s.send_queue = MagicMock()
+        self.s.notify({'id': 'foo'}, 'create', 'data')
+        self.s.send_queue.put.assert_called_once_with('data', 'foo', False)
+
+    def test_notify_batches_with_delivery_window(self):
+        self.s.delivery_window = MagicMock()
+        self.s.notify({'id': 'foo'}, 'create', 'data', '{"id": "foo"}')
+        self.s.delivery_window.add.assert_called_once_with(
+            {'id': 'foo'}, 'create', '{"id": "foo"}', None, None)
+
+    def _deflate_socket(self):
+        s = WebSocket(MagicMock(), extensions=[deflate.RESPONSE])
+        s.request = self.s.request
+        s.received_message = MagicMock()
+        return s
+
+    def test_sends_compressed_frames_when_deflate_negotiated(self):
+        s = self._deflate_socket()
+        payload = json.dumps({'payload': ['x' * 200]})
+        s.send(payload)
+        frame = s.sock.sendall.call_args[0][0]
+        assert frame == deflate.compressed_frame(payload)
+
+    def test_sends_short_frames_uncompressed(self):
+        s = self._deflate_socket()
+        s.send('{}')
+        frame = s.sock.sendall.call_args[0][0]
+        assert frame == '\x81\x02{}'
+
+    def test_sends_uncompressed_frames_without_deflate(self):
+        self.s.send(json.dumps({'payload': ['x' * 200]}))
+        frame = self.s.sock.sendall.call_args[0][0]
+        assert not ord(frame[0]) & 0x40
+
+    def test_inflates_compressed_messages(self):
+        s = self._deflate_socket()
+        text = json.dumps({'messageType': 'client_id', 'value': 'x' * 100})
+        frame = Frame(opcode=OPCODE_TEXT, body=deflate.compress(text), fin=1,
+                      rsv1=1, masking_key='abcd').build()
+        received = []
+        s.received_message.side_effect = lambda m: received.append(m.data)
+        assert s.process(frame[:5])
+        assert received == []
+        assert s.process(frame[5:])
+        assert received == [text]
+
+    def test_closes_on_invalid_compressed_message(self):
+        s = self._deflate_socket()
+        frame = Frame(opcode=OPCODE_TEXT, body='not deflate', fin=1,
+                      rsv1=1, masking_key='abcd').build()
+        assert not s.process(frame)
+        assert s.server_terminated
+
+    def _msgpack_socket(self):
+        s = WebSocket(MagicMock(), protocols=[subprotocol.PROTOCOL])
+        s.state = self.s.state
+        return s
+
+    def test_uses_json_without_msgpack_subprotocol(self):
+        assert not self.s.binary
+        assert self.s.encode({'type': 'resume'}) == '{"type": "resume"}'
+
+    @requires_msgpack
+    def test_sends_binary_frames_with_msgpack_subprotocol(self):
+        s = self._msgpack_socket()
+        s.send(s.encode({'type': 'resume'}))
+        frame = s.sock.sendall.call_args[0][0]
+        assert frame[0] == '\x82'
+        assert subprotocol.unpackb(frame[2:]) == {'type': 'resume'}
+
+    @requires_msgpack
+    def test_decodes_msgpack_messages(self):
+        s = self._msgpack_socket()
+        s.received_message(BinaryMessage(subprotocol.packb({
+            'messageType': 'client_id', 'value': 'x'})))
+        assert s.client_id == 'x'
+
+    @requires_msgpack
+    def test_accepts_json_messages_with_msgpack_subprotocol(self):
+        s = self._msgpack_socket()
+        msg = MagicMock(is_binary=False)
+        msg.data = json.dumps({'messageType': 'client_id', 'value': 'y'})
+        s.received_message(msg)
+        assert s.client_id == 'y'
+
+    @requires_msgpack
+    def test_encodes_annotation_frames_with_msgpack_subprotocol(self):
+        s = self._msgpack_socket()
+        data = {'action': 'create', 'annotation': {'id': 'a'}}
+        frame = s.annotation_frame(data, '{"id": "a"}', seq='1:2')
+        assert subprotocol.unpackb(frame) == {
+            'type': 'annotation-notification',
+            'options': {'action': 'create', 'seq': '1:2'},
+            'payload': [{'id': 'a'}],
+        }
+
+    @requires_msgpack
+    def test_delivery_window_uses_msgpack_subprotocol(self):
+        s = self._msgpack_socket()
+        s.request = self.request
+        self.request.registry.settings.update({
+            'h.streamer.delivery_window_ms': '50',
+        })
+        s.opened()
+        s.send_queue = MagicMock()
+        s.notify({'id': 'a'}, 'create', None)
+        s.delivery_window.flush()
+        frame = s.send_queue.put.call_args[0][0]
+        assert subprotocol.unpackb(frame)['payload'] == [{'id': 'a'}]
+
+    def test_closed_closes_send_queue(self):
+        self.s.send_queue = MagicMock()
+        self.s.closed(1000)
+        assert self.s.send_queue.close.called
+
+    def test_filter_message_with_uri_gets_expanded(self):
+        filter_message = json.dumps({
+            'filter': {
+                'actions': {},
+                'match_policy': 'include_all',
+                'clauses': [{
+                    'field': '/uri',
+                    'operator': 'equals',
+                    'value': 'http://example.com',
+                }],
+            }
+        })
+
+        with patch('h.api.uri.expand') as expand:
+            expand.return_value = ['http://example.com',
+                                   'http://example.com/alter',
+                                   'http://example.com/print']
+            msg = MagicMock()
+            msg.data = filter_message
+
+            self.s.received_message(msg)
+
+            uri_filter = self.s.filter.filter['clauses'][0]
+            uri_values = uri_filter['value']
+            assert len(uri_values) == 3
+            assert 'http://example.com' in uri_values
+            assert 'http://example.com/alter' in uri_values
+            assert 'http://example.com/print' in uri_values
+
+    def _send_past_request(self, **kwargs):
+        self.s.filter = MagicMock()
+        self.s.send = MagicMock()
+        msg = MagicMock()
+        msg.data = json.dumps(dict(kwargs, messageType='past'))
+        with patch('h.streamer.sockets.FilterToElasticFilter') as fef:
+            fef.return_value.query = {
+                'sort': [{'updated': {'order': 'desc'}}],
+                'query': {'match_all': {}}}
+            self.s.received_message(msg)
+            fef.assert_called_once_with(self.s.filter.filter, self.s.state)
+        return json.loads(self.s.send.call_args[0][0])
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_sends_first_page(self, search_raw):
+        search_raw.return_value = _es_results(('a', 1424000000000))
+
+        packet = self._send_past_request(limit=5)
+
+        query = search_raw.call_args[1]['query']
+        assert query['size'] == 5
+        assert query['query'] == {'match_all': {}}
+        assert search_raw.call_args[1]['raw_result']
+        assert packet['options'] == {'action': 'past', 'cursor': None}
+        assert packet['payload'] == [{'id': 'a'}]
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_is_sent_by_writer(self, search_raw):
+        search_raw.return_value = _es_results(('a', 1424000000000))
+        self.s.send_queue = MagicMock()
+        self.s.filter = MagicMock()
+        msg = MagicMock()
+        msg.data = json.dumps({'messageType': 'past'})
+        with patch('h.streamer.sockets.FilterToElasticFilter') as fef:
+            fef.return_value.query = {
+                'sort': [{'updated': {'order': 'desc'}}],
+                'query': {'match_all': {}}}
+            self.s.received_message(msg)
+
+        data, key, reliable = self.s.send_queue.put.call_args[0]
+        assert json.loads(data)['options']['action'] == 'past'
+        assert reliable
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_caps_page_size(self, search_raw):
+        search_raw.return_value = _es_results()
+        self._send_past_request(limit=100000)
+        assert search_raw.call_args[1]['query']['size'] == 200
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_pages_with_search_cursor(self, search_raw):
+        search_raw.return_value = _es_results(('a', 1425000000000),
+                                              ('b', 1424000000000),
+                                              ('c', 1424000000000))
+        cursor = self._send_past_request(limit=3)['options']['cursor']
+        assert cursor is not None
+
+        search_raw.return_value = _es_results(('d', 1424000000000))
+        packet = self._send_past_request(limit=3, cursor=cursor)
+
+        query = search_raw.call_args[1]['query']
+        assert query['from'] == 0
+        filtered = query['query']['filtered']
+        assert filtered['query'] == {'match_all': {}}
+        assert filtered['filter']['bool']['must'] == [
+            {'range': {'updated': {'lte': 1424000000000}}}]
+        assert filtered['filter']['bool']['must_not'] == [
+            {'ids': {'values': ['b', 'c']}}]
+        assert packet['options']['cursor'] is None
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_cursor_is_the_search_api_cursor(self, search_raw):
+        hits = _es_results(('a', 1425000000000), ('b', 1424000000000))
+        search_raw.return_value = hits
+        packet = self._send_past_request(limit=2)
+
+        body = {'size': 2, 'sort': [{'updated': {'order': 'desc'}}]}
+        assert packet['options']['cursor'] == search_query.next_cursor(
+            body, hits['hits']['hits'])
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_accumulates_ids_with_same_timestamp(self,
+                                                             search_raw):
+        search_raw.return_value = _es_results(('a', 1424000000000))
+        cursor = self._send_past_request(limit=1)['options']['cursor']
+        search_raw.return_value = _es_results(('b', 1424000000000))
+        self._send_past_request(limit=1, cursor=cursor)
+        cursor = json.loads(self.s.send.call_args[0][0])['options']['cursor']
+
+        self._send_past_request(limit=1, cursor=cursor)
+
+        page_filter = search_raw.call_args[1]['query']['query']['filtered'][
+            'filter']['bool']
+        assert page_filter['must_not'] == [{'ids': {'values': ['a', 'b']}}]
+
+    def test_past_message_rejects_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            self._send_past_request(cursor='not a cursor')
+
+    def test_past_message_requires_filter(self):
+        msg = MagicMock()
+        msg.data = json.dumps({'messageType': 'past'})
+        with self.assertRaises(ValueError):
+            self.s.received_message(msg)
+
+    def test_filter_message_adds_socket_to_subscriptions(self):
+        filter_message = json.dumps({
+            'filter': {
+                'actions': {},
+                'match_policy': 'include_all',
+                'clauses': [],
+            }
+        })
+        msg = MagicMock()
+        msg.data = filter_message
+
+        with patch.object(WebSocket, 'subscriptions') as subscriptions:
+            self.s.received_message(msg)
+            subscriptions.add.assert_called_once_with(self.s)
+
+    def test_closed_removes_socket_from_subscriptions(self):
+        with patch.object(WebSocket, 'subscriptions') as subscriptions:
+            self.s.closed(1000)
+            subscriptions.discard.assert_called_once_with(self.s)
+
+    def _send(self, **data):
+        msg = MagicMock()
+        msg.data = json.dumps(data)
+        self.s.received_message(msg)
+
+    def test_subscribe_message_adds_named_filter(self):
+        with patch.object(WebSocket, 'subscriptions') as subscriptions:
+            self._send(messageType='subscribe', id='frame-1',
+                       filter=tag_filter('foo'))
+            self._send(messageType='subscribe', id='frame-2',
+                       filter=tag_filter('bar'))
+            assert subscriptions.add.call_count == 2
+
+        assert sorted(self.s.named_filters) == ['frame-1', 'frame-2']
+        assert self.s.named_filters['frame-1'].match({'tags': ['foo']})
+        assert self.s.filter is None
+
+    def test_subscribe_message_replaces_named_filter(self):
+        self._send(messageType='subscribe', id='frame-1',
+                   filter=tag_filter('foo'))
+        self._send(messageType='subscribe', id='frame-1',
+                   filter=tag_filter('bar'))
+        assert self.s.named_filters.keys() == ['frame-1']
+        assert self.s.named_filters['frame-1'].match({'tags': ['bar']})
+
+    def test_subscribe_message_requires_id(self):
+        with self.assertRaises(ValueError):
+            self._send(messageType='subscribe', filter=tag_filter('foo'))
+
+    def test_subscribe_message_limits_subscriptions(self):
+        self.request.registry.settings['h.streamer.max_subscriptions'] = '2'
+        self._send(messageType='subscribe', id='a', filter=tag_filter('a'))
+        self._send(messageType='subscribe', id='b', filter=tag_filter('b'))
+        with self.assertRaises(ValueError):
+            self._send(messageType='subscribe', id='c',
+                       filter=tag_filter('c'))
+
+    def test_unsubscribe_message_removes_named_filter(self):
+        self._send(messageType='subscribe', id='a', filter=tag_filter('a'))
+        self._send(messageType='subscribe', id='b', filter=tag_filter('b'))
+        self._send(messageType='unsubscribe', id='a')
+        assert self.s.named_filters.keys() == ['b']
+        self._send(messageType='unsubscribe', id='b')
+        assert self.s.named_filters is None
+
+    def test_unsubscribe_message_removes_socket_without_filters(self):
+        with patch.object(WebSocket, 'subscriptions', SubscriptionIndex()):
+            self._send(messageType='subscribe', id='a',
+                       filter=tag_filter('a'))
+            self._send(messageType='unsubscribe', id='a')
+            assert len(WebSocket.subscriptions) == 0
+
+    def test_unsubscribe_message_keeps_socket_with_filter(self):
+        self.s.filter = MagicMock()
+        with patch.object(WebSocket, 'subscriptions') as subscriptions:
+            self._send(messageType='subscribe', id='a',
+                       filter=tag_filter('a'))
+            self._send(messageType='unsubscribe', id='a')
+            assert not subscriptions.discard.called
+            subscriptions.add.assert_called_with(self.s)
+
+    @patch('h.streamer.sockets.Annotation.search_raw')
+    def test_past_message_for_subscription(self, search_raw):
+        search_raw.return_value = _es_results(('a', 1424000000000))
+        self.s.send = MagicMock()
+        self._send(messageType='subscribe', id='frame-1',
+                   filter=tag_filter('foo'))
+        self._send(messageType='past', subscription='frame-1')
+        packet = json.loads(self.s.send.call_args[0][0])
+        assert packet['options']['subscriptions'] == ['frame-1']
+        query = json.dumps(search_raw.call_args[1]['query'])
+        assert '"foo"' in query
+
+    def test_past_message_for_unknown_subscription(self):
+        with self.assertRaises(ValueError):
+            self._send(messageType='past', subscription='frame-1')
+
+    def test_opened_reads_shard_topic(self):
+        self.request.registry.settings.update({
+            'h.streamer.shards': '4',
+            'h.streamer.shard': '1',
+        })
+        self.s.opened()
+        self.request.get_queue_reader.assert_called_once_with(
+            'annotations-shard-1', ANY)
+
+    def _send_filter(self, uri):
+        msg = MagicMock()
+        msg.data = json.dumps({'filter': {
+            'actions': {},
+            'match_policy': 'include_any',
+            'clauses': [{'field': '/uri', 'operator': 'one_of',
+                         'value': [uri]}],
+        }})
+        with patch('h.api.uri.expand') as expand:
+            expand.side_effect = lambda u: [u]
+            self.s.received_message(msg)
+
+    def test_shard_accepts_filter_for_its_documents(self):
+        self.request.registry.settings.update({
+            'h.streamer.shards': '4',
+            'h.streamer.shard': '1',
+        })
+        self._send_filter(uri_in_shard(1, 4))
+        assert self.s.filter is not None
+
+    def test_shard_rejects_filter_for_other_documents(self):
+        self.request.registry.settings.update({
+            'h.streamer.shards': '4',
+            'h.streamer.shard': '1',
+        })
+        with self.assertRaises(ValueError):
+            self._send_filter(uri_in_shard(2, 4))
+        assert self.s.filter is None
+
+    @patch('h.streamer.sockets.gevent.spawn')
+    def test_opened_reads_event_ring(self, spawn):
+        self.request.registry.settings.update({
+            'h.streamer.event_ring.path': '/tmp/ring',
+        })
+        self.s.opened()
+        assert not self.request.get_queue_reader.called
+        func, ring = spawn.call_args_list[0][0][:2]
+        assert func is read_event_ring
+        assert ring.path == '/tmp/ring'
+
+    def test_opened_starts_replay_buffer(self):
+        with patch.object(WebSocket, 'replay_buffer', None):
+            self.request.registry.settings.update({
+                'h.streamer.replay_buffer.size': '10',
+            })
+            self.s.opened()
+            assert WebSocket.replay_buffer._events.maxlen == 10
+
+    def _send_resume_request(self, replay, since):
+        self.s.filter = MagicMock()
+        self.s.send = MagicMock()
+        msg = MagicMock()
+        msg.data = json.dumps({'messageType': 'resume', 'since': since})
+        with patch.object(WebSocket, 'replay_buffer', replay):
+            with patch('h.streamer.sockets.should_send_event') as should:
+                should.side_effect = lambda s, a, e, c: a['id'] != 'skip'
+                self.s.received_message(msg)
+        return [json.loads(c[0][0]) for c in self.s.send.call_args_list]
+
+    def _replay_buffer(self, *ids):
+        replay = ReplayBuffer(maxlen=3)
+        for id_ in ids:
+            annotation = {'id': id_}
+            replay.append(({'action': 'create'}, annotation,
+                           json.dumps(annotation)))
+        return replay
+
+    def test_resume_message_replays_missed_events(self):
+        replay = self._replay_buffer('a', 'b', 'skip', 'c')
+        since = '{}:2'.format(replay.epoch)
+
+        packets = self._send_resume_request(replay, since)
+
+        assert [p['payload'] for p in packets[:-1]] == [[{'id': 'c'}]]
+        assert packets[0]['options']['seq'] == replay.current
+        assert packets[-1] == {
+            'type': 'resume',
+            'options': {'status': 'ok', 'seq': replay.current},
+        }
+
+    def test_resume_message_when_up_to_date(self):
+        replay = self._replay_buffer('a')
+        packets = self._send_resume_request(replay, replay.current)
+        assert packets == [{
+            'type': 'resume',
+            'options': {'status': 'ok', 'seq': replay.current},
+        }]
+
+    def test_resume_message_asks_for_reload_when_gap_too_old(self):
+        replay = self._replay_buffer('a', 'b', 'c', 'd', 'e')
+        since = '{}:1'.format(replay.epoch)
+        packets = self._send_resume_request(replay, since)
+        assert packets == [{
+            'type': 'resume',
+            'options': {'status': 'reload', 'seq': replay.current},
+        }]
+
+    def test_resume_message_asks_for_reload_after_restart(self):
+        replay = self._replay_buffer('a')
+        packets = self._send_resume_request(replay, 'otherepoch:1')
+        assert packets[-1]['options']['status'] == 'reload'
+
+    def _send_resume_through_queue(self, replay, since, policy):
+        send = MagicMock()
+        self.s.send_queue = SendQueue(send, MagicMock(), maxsize=2,
+                                      policy=policy)
+        self._send_resume_request(replay, since)
+        self.s.send_queue.start().join(timeout=0.1)
+        return [json.loads(c[0][0]) for c in send.call_args_list]
+
+    def test_resume_message_replays_more_events_than_queue_size(self):
+        for policy in SendQueue.policies:
+            replay = ReplayBuffer(maxlen=10)
+            for id_ in 'abcde':
+                replay.append(({'action': 'create'}, {'id': id_},
+                               json.dumps({'id': id_})))
+            since = '{}:0'.format(replay.epoch)
+
+            packets = self._send_resume_through_queue(replay, since, policy)
+
+            assert [p['payload'] for p in packets[:-1]] == [
+                [{'id': id_}] for id_ in 'abcde']
+            assert packets[-1]['options']['status'] == 'ok'
+
+    def test_resume_message_asks_for_reload_when_events_not_queued(self):
+        replay = self._replay_buffer('a', 'b')
+        since = '{}:0'.format(replay.epoch)
+        self.s.send_queue = MagicMock()
+        self.s.send_queue.put.side_effect = [False, True, True]
+
+        self._send_resume_request(replay, since)
+
+        packet = json.loads(self.s.send_queue.put.call_args[0][0])
+        assert packet['options']['status'] == 'reload'
+
+    def test_resume_message_requires_filter(self):
+        msg = MagicMock()
+        msg.data = json.dumps({'messageType': 'resume', 'since': 'x:1'})
+        with self.assertRaises(ValueError):
+            self.s.received_message(msg)
+
+
+class TestSocketState(object):
+    def test_from_request(self):
+        request = MagicMock()
+        request.authenticated_userid = 'acct:giraffe@example.com'
+        request.effective_principals = ['system.Everyone']
+        request.feature.return_value = True
+
+        state = SocketState.from_request(request)
+
+        assert state.registry is request.registry
+        assert state.userid == 'acct:giraffe@example.com'
+        assert state.principals == frozenset(['system.Everyone'])
+        assert state.feature('streamer')
+
+    def test_from_request_shares_userids_and_principals(self):
+        request = MagicMock()
+        request.authenticated_userid = u'acct:giraffe@' + u'example.com'
+        request.effective_principals = ['system.Everyone']
+        first = SocketState.from_request(request)
+
+        request.authenticated_userid = u'acct:giraffe@' + u'example.com'
+        request.effective_principals = ['system.Everyone']
+        second = SocketState.from_request(request)
+
+        assert first.userid is second.userid
+        assert first.principals is second.principals
+
+    def test_feature_rejects_unrecorded_features(self):
+        state = SocketState(MagicMock())
+        with pytest.raises(ValueError):
+            state.feature('notification')
+
+    def test_has_permission_without_authentication(self):
+        state = SocketState(MagicMock(), principals=None)
+        assert state.has_permission('read', {})
+        assert not state.registry.queryUtility.called
+
+    def test_has_permission_asks_policy(self):
+        state = SocketState(MagicMock(),
+                            principals=frozenset(['system.Everyone']))
+        policy = state.registry.queryUtility.return_value
+        policy.permits.return_value = False
+
+        assert not state.has_permission('read', {'id': 'a'})
+        policy.permits.assert_called_once_with(
+            {'id': 'a'}, frozenset(['system.Everyone']), 'read')
+
+    def test_slots(self):
+        state = SocketState(MagicMock())
+        with pytest.raises(AttributeError):
+            state.request = MagicMock()
+
+
+def _es_results(*hits):
+    """Return a raw Elasticsearch result for (id, sort value) pairs."""
+    return {'hits': {'total': len(hits), 'hits': [
+        {'_id': id_, '_source': {}, 'sort': [value]}
+        for id_, value in hits]}}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from mock import MagicMock
+
+from h.streamer.stats import StreamerStats
+
+
+class TestStreamerStats(object):
+    def setup_method(self, method):
+        self.stats = StreamerStats()
+
+    def test_records_latency_in_buckets(self):
+        for latency in (0.0005, 0.003, 0.003, 60):
+            self.stats.record_event(latency, 1, 1)
+        assert self.stats.buckets[0] == 1
+        assert self.stats.buckets[2] == 2
+        assert self.stats.buckets[-1] == 1
+        assert self.stats.max_latency == 60000
+
+    def test_percentiles_are_bucket_bounds(self):
+        for _ in range(98):
+            self.stats.record_event(0.0015, 1, 1)
+        self.stats.record_event(0.15, 1, 1)
+        self.stats.record_event(60, 1, 1)
+        assert self.stats.percentile(50) == 2
+        assert self.stats.percentile(99) == 200
+        assert self.stats.percentile(100) == 5000
+
+    def test_percentile_without_events(self):
+        assert self.stats.percentile(50) is None
+
+    def test_snapshot(self):
+        self.stats.record_event(0.001, 4, 1, queue_depth=3)
+        self.stats.record_event(0.001, 4, 0, queue_depth=1)
+        snapshot = self.stats.snapshot()
+        assert snapshot['match_ratio'] == 0.125
+        assert snapshot['queue_depth'] == 1
+        assert snapshot['max_queue_depth'] == 3
+        assert snapshot['latency_ms']['histogram']['le_1ms'] == 2
+        assert snapshot['latency_ms']['p50'] == 1
+
+    def test_report_sends_changes_since_last_report(self):
+        client = MagicMock()
+        counter = client.get_client.return_value.get_counter.return_value
+        gauge = client.get_client.return_value.get_gauge.return_value
+        self.stats.counters['connections.opened'] += 2
+        self.stats.record_event(0.001, 4, 1)
+        self.stats.report(client)
+
+        self.stats.record_event(0.001, 4, 3)
+        counter.reset_mock()
+        gauge.reset_mock()
+        self.stats.report(client)
+
+        client.get_client.assert_called_with('streamer')
+        counted = dict(c[0] for c in counter.increment.call_args_list)
+        assert counted == {'events': 1, 'sockets.checked': 4,
+                           'sockets.notified': 3}
+        gauged = dict(c[0] for c in gauge.send.call_args_list)
+        assert gauged['fanout.match_ratio'] == 0.75
+        assert gauged['fanout.latency.p99'] == 1
+        assert gauged['sockets.open'] == 2
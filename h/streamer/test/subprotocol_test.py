@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from h.streamer import subprotocol
+from h.streamer.frames import _annotation_frame
+
+pytest.importorskip('msgpack')
+
+
+def test_round_trips_text():
+    packet = {'messageType': 'filter', 'value': u'caf\xe9', 'n': [1, None]}
+    assert subprotocol.unpackb(subprotocol.packb(packet)) == packet
+
+
+def test_unpackb_raises_value_error_for_invalid_data():
+    with pytest.raises(ValueError):
+        subprotocol.unpackb(b'\xc1')
+
+
+@pytest.mark.parametrize('seq,subscriptions', [
+    (None, None),
+    ('1:2', None),
+    (None, ['frame-1', 'frame-2']),
+    ('1:2', [None, 'frame-1']),
+])
+def test_annotation_frame_matches_json_frame(seq, subscriptions):
+    annotations = [{'id': 'a', 'text': u'caf\xe9'}, {'id': 'b', 'tags': []}]
+    frame = subprotocol.annotation_frame(
+        [subprotocol.packb(a) for a in annotations], 'create', seq,
+        subscriptions)
+    expected = _annotation_frame([json.dumps(a) for a in annotations],
+                                 'create', seq, subscriptions)
+    assert subprotocol.unpackb(frame) == json.loads(expected)
+
+
+def test_annotation_frame_without_annotations():
+    frame = subprotocol.annotation_frame([], 'delete')
+    assert subprotocol.unpackb(frame)['payload'] == []
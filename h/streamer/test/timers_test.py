@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import pytest
+from mock import MagicMock
+from ws4py.messaging import PingControlMessage
+
+from h.streamer.delivery import SendQueue
+from h.streamer.test.helpers import FakeClock
+from h.streamer.timers import TimerWheel
+
+
+class TestTimerWheel(object):
+    def setup_method(self, method):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(interval=30, timeout=10, clock=self.clock)
+
+    def _socket(self):
+        sock = MagicMock(terminated=False)
+        self.wheel.add(sock)
+        return sock
+
+    def _advance(self, seconds):
+        for _ in range(int(seconds)):
+            self.clock.now += 1
+            self.wheel.advance(self.clock.now)
+
+    def test_pings_quiet_socket(self):
+        sock = self._socket()
+        self._advance(29)
+        assert not sock.push.called
+        self._advance(1)
+        ping = sock.push.call_args[0][0]
+        assert isinstance(ping, PingControlMessage)
+        assert self.wheel.stats()['pinged'] == 1
+
+    def test_ping_is_not_evicted_from_full_queue(self):
+        send = MagicMock()
+        queue = SendQueue(send, MagicMock(), maxsize=1, policy='drop_oldest')
+        sock = self._socket()
+        sock.push.side_effect = lambda data, key=None, reliable=False: \
+            queue.put(data, key, reliable)
+        queue.put('a')
+        self._advance(30)
+        queue.put('b')
+        queue.put('c')
+
+        queue.start().join(timeout=0.1)
+
+        sent = [c[0][0] for c in send.call_args_list]
+        assert isinstance(sent[0], PingControlMessage)
+        assert sent[1:] == ['c']
+
+    def test_ping_does_not_overflow_full_queue(self):
+        close = MagicMock()
+        queue = SendQueue(MagicMock(), close, maxsize=1, policy='disconnect')
+        sock = self._socket()
+        sock.push.side_effect = lambda data, key=None, reliable=False: \
+            queue.put(data, key, reliable)
+        queue.put('a')
+
+        self._advance(30)
+
+        assert sock.push.called
+        assert not queue.closed
+        assert len(queue) == 2
+
+    def test_does_not_ping_active_socket(self):
+        sock = self._socket()
+        self._advance(20)
+        sock.last_received = self.wheel.now
+        self._advance(20)
+        assert not sock.push.called
+        self._advance(10)
+        assert sock.push.called
+
+    def test_drops_socket_not_answering_ping(self):
+        sock = self._socket()
+        self._advance(30)
+        self._advance(9)
+        assert not sock.close_connection.called
+        self._advance(1)
+        assert sock.close_connection.called
+        assert sock.server_terminated
+        assert self.wheel.stats() == {'live': 0, 'pinged': 1,
+                                      'timed_out': 1, 'idle': 0}
+
+    def test_keeps_socket_answering_ping(self):
+        sock = self._socket()
+        self._advance(30)
+        self._advance(2)
+        sock.last_received = self.wheel.now
+        self._advance(35)
+        assert not sock.close_connection.called
+        assert sock.push.call_count == 2
+        assert len(self.wheel) == 1
+
+    def test_closes_idle_socket(self):
+        self.wheel = TimerWheel(interval=30, timeout=10, idle_timeout=45,
+                                clock=self.clock)
+        sock = self._socket()
+        for _ in range(3):
+            self._advance(15)
+            sock.last_received = self.wheel.now
+        sock.close.assert_called_once_with(1000, 'idle timeout')
+        assert self.wheel.stats()['idle'] == 1
+
+    def test_forgets_terminated_sockets(self):
+        sock = self._socket()
+        sock.terminated = True
+        self._advance(30)
+        assert not sock.push.called
+        assert len(self.wheel) == 0
+
+    def test_discard(self):
+        sock = self._socket()
+        self.wheel.discard(sock)
+        self._advance(30)
+        assert not sock.push.called
+        assert len(self.wheel) == 0
+
+    def test_advance_catches_up_after_stall(self):
+        socks = [self._socket() for _ in range(3)]
+        self.clock.now += 1000
+        self.wheel.advance(self.clock.now)
+        assert all(s.push.called for s in socks)
+
+    def test_rejects_bad_intervals(self):
+        with pytest.raises(ValueError):
+            TimerWheel(interval=0)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import urllib
+
+from mock import MagicMock
+from pyramid.request import Request
+from pyramid.testing import DummyRequest
+
+from h.streamer import deflate
+from h.streamer import subprotocol
+from h.streamer.test.helpers import requires_msgpack
+from h.streamer.test.helpers import uri_in_shard
+from h.streamer.views import websocket
+from h.streamer.views import websocket_shard
+
+
+def test_websocket_bad_origin(config):
+    config.registry.settings.update({'origins': 'http://good'})
+    config.include('h.streamer')
+    req = DummyRequest(headers={'Origin': 'http://bad'})
+    res = websocket(req)
+    assert res.code == 403
+
+
+def test_websocket_good_origin(config):
+    config.registry.settings.update({'origins': 'http://good'})
+    config.include('h.streamer')
+    req = DummyRequest(headers={'Origin': 'http://good'})
+    req.get_response = MagicMock()
+    res = websocket(req)
+    assert res.code != 403
+
+
+def test_websocket_same_origin(config):
+    config.include('h.streamer')
+    # example.com is the dummy request default host URL
+    req = DummyRequest(headers={'Origin': 'http://example.com'})
+    req.get_response = MagicMock()
+    res = websocket(req)
+    assert res.code != 403
+
+
+def _shard_request(config, *uris):
+    req = Request.blank('/ws/shard?' + urllib.urlencode([('uri', u)
+                                                         for u in uris]))
+    req.registry = config.registry
+    return req
+
+
+def test_websocket_shard_for_uri(config):
+    config.registry.settings.update({
+        'h.streamer.shards': '4',
+        'h.streamer.shard_url': 'wss://stream-{shard}.example.com/ws',
+    })
+    req = _shard_request(config, uri_in_shard(3, 4))
+    assert websocket_shard(req) == {
+        'shard': 3,
+        'shards': 4,
+        'url': 'wss://stream-3.example.com/ws',
+    }
+
+
+def test_websocket_shard_for_uris_in_different_shards(config):
+    config.registry.settings.update({'h.streamer.shards': '4'})
+    req = _shard_request(config, uri_in_shard(1, 4), uri_in_shard(2, 4))
+    assert websocket_shard(req)['shard'] is None
+
+
+def test_websocket_shard_when_not_sharded(config):
+    req = _shard_request(config, 'http://example.com')
+    assert websocket_shard(req) == {'shard': None, 'shards': 1, 'url': None}
+
+
+def test_websocket_negotiates_permessage_deflate(config):
+    config.include('h.streamer')
+    offers = 'permessage-deflate; client_max_window_bits'
+    req = DummyRequest(environ={'HTTP_SEC_WEBSOCKET_EXTENSIONS': offers})
+    req.get_response = MagicMock()
+    websocket(req)
+    assert req.environ['HTTP_SEC_WEBSOCKET_EXTENSIONS'] == deflate.RESPONSE
+
+
+def test_websocket_declines_other_extensions(config):
+    config.include('h.streamer')
+    offers = 'x-webkit-deflate-frame'
+    req = DummyRequest(environ={'HTTP_SEC_WEBSOCKET_EXTENSIONS': offers})
+    req.get_response = MagicMock()
+    websocket(req)
+    assert 'HTTP_SEC_WEBSOCKET_EXTENSIONS' not in req.environ
+
+
+def test_websocket_permessage_deflate_can_be_disabled(config):
+    config.registry.settings.update({
+        'h.streamer.permessage_deflate': 'false',
+    })
+    config.include('h.streamer')
+    req = DummyRequest(environ={
+        'HTTP_SEC_WEBSOCKET_EXTENSIONS': 'permessage-deflate',
+    })
+    req.get_response = MagicMock()
+    websocket(req)
+    assert 'HTTP_SEC_WEBSOCKET_EXTENSIONS' not in req.environ
+
+
+@requires_msgpack
+def test_websocket_offers_msgpack_subprotocol(config):
+    config.include('h.streamer')
+    assert config.registry.websocket.protocols == [subprotocol.PROTOCOL]
+
+
+def test_websocket_msgpack_subprotocol_can_be_disabled(config):
+    config.registry.settings.update({'h.streamer.msgpack': 'false'})
+    config.include('h.streamer')
+    assert config.registry.websocket.protocols is None
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""The heartbeats and timeouts of the websockets in a process."""
+import collections
+import logging
+import math
+import time
+import weakref
+
+import gevent
+from ws4py.messaging import PingControlMessage
+
+log = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """
+    A single timer for the heartbeats and timeouts of every websocket in the
+    process.
+
+    Rather than each socket running its own heartbeat greenlet and timer, the
+    sockets are kept in a ring of ``slots`` buckets, one per ``tick`` seconds,
+    according to when they next need attention. Once per tick the wheel takes
+    the sockets due from the current bucket, all at once:
+
+    - a socket which has received nothing for ``interval`` seconds is sent a
+      ping;
+    - a socket which has received nothing within ``timeout`` seconds of being
+      pinged (or of being closed for idleness) is assumed dead, and its
+      connection is dropped;
+    - if ``idle_timeout`` is set, a socket whose client has sent no message
+      for that long is closed.
+
+    Sockets record their activity in their ``last_received`` and
+    ``last_message`` attributes, using the wheel's coarse clock :py:attr:`now`,
+    which costs them nothing per frame beyond an attribute assignment.
+    """
+
+    def __init__(self, interval=30.0, timeout=10.0, idle_timeout=0,
+                 tick=1.0, slots=64, clock=time.time):
+        if interval <= 0 or timeout <= 0:
+            raise ValueError('heartbeat interval and timeout must be positive')
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.clock = clock
+        self.counters = collections.Counter()
+        self.now = clock()
+        self._slots = [weakref.WeakKeyDictionary() for _ in range(slots)]
+        self._slot_of = weakref.WeakKeyDictionary()
+        self._position = self._slot_number(self.now)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, socket):
+        """Start keeping watch over the passed socket."""
+        socket.last_received = socket.last_message = self.now
+        socket.ping_sent = None
+        self._schedule(socket, self.now + self.interval)
+
+    def discard(self, socket):
+        """Stop keeping watch over the passed socket, if it was watched."""
+        slot = self._slot_of.pop(socket, None)
+        if slot is not None:
+            self._slots[slot].pop(socket, None)
+
+    def stats(self):
+        """
+        Return the number of sockets being watched, along with counts of the
+        pings sent and sockets closed since the wheel was started.
+        """
+        stats = {'live': len(self)}
+        for name in ('pinged', 'timed_out', 'idle'):
+            stats[name] = self.counters[name]
+        return stats
+
+    def run(self):
+        while True:
+            gevent.sleep(self.tick)
+            self.advance(self.clock())
+
+    def advance(self, now):
+        """Attend to every socket due by the passed time."""
+        self.now = now
+        target = self._slot_number(now)
+        # Every bucket is visited at most once, however long since the last
+        # call.
+        self._position = max(self._position, target - len(self._slots) + 1)
+        while self._position <= target:
+            slot = self._slots[self._position % len(self._slots)]
+            self._position += 1
+            due = [s for s, deadline in slot.items() if deadline <= now]
+            for socket in due:
+                del slot[socket]
+                del self._slot_of[socket]
+            for socket in due:
+                self._attend(socket, now)
+
+    def _attend(self, socket, now):
+        if socket.terminated:
+            return
+
+        if socket.ping_sent is not None:
+            if socket.last_received < socket.ping_sent:
+                self.counters['timed_out'] += 1
+                log.debug('websocket timed out, dropping the connection')
+                socket.server_terminated = True
+                socket.close_connection()
+                return
+            socket.ping_sent = None
+
+        idle = now - socket.last_message
+        if self.idle_timeout and idle >= self.idle_timeout:
+            self.counters['idle'] += 1
+            socket.close(1000, 'idle timeout')
+            self._await_reply(socket, now)
+            return
+
+        if now - socket.last_received >= self.interval:
+            self.counters['pinged'] += 1
+            # Pings bypass the send queue's policy: a dropped ping would
+            # have a live socket closed for not answering it.
+            socket.push(PingControlMessage(''), reliable=True)
+            self._await_reply(socket, now)
+            return
+
+        deadline = socket.last_received + self.interval
+        if self.idle_timeout:
+            deadline = min(deadline, socket.last_message + self.idle_timeout)
+        self._schedule(socket, deadline)
+
+    def _await_reply(self, socket, now):
+        # Anything received from now on counts as a reply.
+        socket.ping_sent = now
+        self._schedule(socket, now + self.timeout)
+
+    def _schedule(self, socket, deadline):
+        # A socket is never attended to early: it is put in the bucket for
+        # the first tick at or after its deadline.
+        number = max(self._slot_number(deadline, ceil=True), self._position)
+        slot = number % len(self._slots)
+        self._slots[slot][socket] = deadline
+        self._slot_of[socket] = slot
+
+    def _slot_number(self, when, ceil=False):
+        number = when / self.tick
+        if ceil:
+            return int(math.ceil(number))
+        return int(math.floor(number))
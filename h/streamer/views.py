@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""The streamer's views, and its configuration."""
+import logging
+
+from pyramid.config import aslist
+from pyramid.settings import asbool
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
+from ws4py.exc import HandshakeError
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+from h.api.queue import shard_for_uri
+from h.streamer import deflate
+from h.streamer import subprotocol
+from h.streamer.cache import ExpansionCache
+from h.streamer.sockets import WebSocket
+
+log = logging.getLogger(__name__)
+
+
+def websocket(request):
+    # WebSockets can be opened across origins and send cookies. To prevent
+    # scripts on other sites from using this socket, ensure that the Origin
+    # header (if present) matches the request host URL or is whitelisted.
+    origin = request.headers.get('Origin')
+    allowed = getattr(request.registry, 'websocket_origins', [])
+    if origin is not None:
+        if origin != request.host_url and origin not in allowed:
+            return HTTPForbidden()
+
+    # ws4py only accepts extension offers which exactly match one of those it
+    # is configured with, so replace the client's offers with the response to
+    # them, if any.
+    offers = request.environ.pop('HTTP_SEC_WEBSOCKET_EXTENSIONS', None)
+    if getattr(request.registry, 'websocket_deflate', False):
+        response = deflate.negotiate(offers)
+        if response is not None:
+            request.environ['HTTP_SEC_WEBSOCKET_EXTENSIONS'] = response
+
+    return request.get_response(request.registry.websocket)
+
+
+def websocket_shard(request):
+    """
+    Tell a client which streamer shard to connect to in order to watch the
+    documents at the URIs passed in the ``uri`` query parameters.
+
+    The shard is None if the streamer is not sharded, or if the URIs belong to
+    different shards, in which case the client should connect to an unsharded
+    streamer.
+    """
+    settings = request.registry.settings
+    shards = int(settings.get('h.streamer.shards', 1))
+    uris = request.params.getall('uri')
+    shard = None
+    if shards > 1 and uris:
+        found = set(shard_for_uri(u, shards) for u in uris)
+        if len(found) == 1:
+            shard = found.pop()
+    url = None
+    if shard is not None and 'h.streamer.shard_url' in settings:
+        url = settings['h.streamer.shard_url'].format(shard=shard)
+    return {'shard': shard, 'shards': shards, 'url': url}
+
+
+def websocket_stats(request):
+    """
+    Return a snapshot of the streamer's state, for debugging.
+
+    Each worker process runs its own streamer, so this only describes the
+    worker which handles the request.
+    """
+    return WebSocket.snapshot()
+
+
+def bad_handshake(exc, request):
+    log.error("streamer websocket handshake error: %s", exc)
+    return HTTPBadRequest()
+
+
+def includeme(config):
+    settings = config.registry.settings
+    origins = aslist(settings.get('origins', ''))
+    # Clients may ask for messages to be encoded with msgpack, rather than
+    # JSON, if msgpack is installed.
+    protocols = None
+    if asbool(settings.get('h.streamer.msgpack', True)):
+        if subprotocol.available():
+            protocols = [subprotocol.PROTOCOL]
+        elif 'h.streamer.msgpack' in settings:
+            log.warn('h.streamer.msgpack is set, but msgpack is not '
+                     'installed: clients can only use JSON')
+    config.registry.websocket = WebSocketWSGIApplication(
+        handler_cls=WebSocket, protocols=protocols,
+        extensions=[deflate.RESPONSE])
+    config.registry.websocket_origins = origins
+    config.registry.websocket_deflate = asbool(
+        settings.get('h.streamer.permessage_deflate', True))
+    WebSocket.uri_cache = ExpansionCache(
+        ttl=float(settings.get('h.streamer.uri_cache.ttl', 60)),
+        maxsize=int(settings.get('h.streamer.uri_cache.size', 10000)),
+        concurrency=int(settings.get('h.streamer.uri_cache.concurrency', 10)))
+    config.add_route('ws', 'ws')
+    config.add_view(websocket, route_name='ws')
+    config.add_route('ws_shard', 'ws/shard')
+    config.add_view(websocket_shard, route_name='ws_shard', renderer='json')
+    config.add_route('ws_stats', 'ws/stats')
+    config.add_view(websocket_stats, route_name='ws_stats', renderer='json',
+                    permission='admin')
+    config.add_view(bad_handshake, context=HandshakeError)
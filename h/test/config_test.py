@@ -216,6 +216,18 @@ def test_blocklist():
     assert actual_config == {'h.blocklist': blocklist}
 
 
+def test_streamer_shards():
+    os.environ['STREAMER_SHARDS'] = '4'
+    os.environ['STREAMER_SHARD'] = '2'
+
+    actual_config = settings_from_environment()
+
+    assert actual_config == {
+        'h.streamer.shards': '4',
+        'h.streamer.shard': '2',
+    }
+
+
 @pytest.fixture(autouse=True)
 def environ(request):
     """Clear the environment and later restore it to its original state."""
@@ -73,6 +73,7 @@ DEV_EXTRAS = ['pyramid_debugtoolbar>=2.1', 'prospector[with_pyroma]', 'pep257',
 TESTING_EXTRAS = ['mock', 'pytest>=2.5', 'pytest-cov', 'factory-boy']
 CLAIM_EXTRAS = ['mandrill']
 YAML_EXTRAS = ['PyYAML']
+MSGPACK_EXTRAS = ['msgpack>=0.5.2']
 
 setup(
     name='h',
@@ -104,6 +105,7 @@ setup(
         'testing': TESTING_EXTRAS,
         'claim': CLAIM_EXTRAS,
         'YAML': YAML_EXTRAS,
+        'msgpack': MSGPACK_EXTRAS,
     },
     tests_require=DEV_EXTRAS + TESTING_EXTRAS,
     setup_requires=['setuptools_git'],
@@ -119,6 +121,7 @@ setup(
         'paste.app_factory': [
             'main=h.app:create_app',
             'api=h.app:create_api',
+            'streamer=h.app:create_streamer',
         ],
         'console_scripts': [
             'hypothesis=h.script:main',
@@ -129,6 +132,7 @@ setup(
         'h.worker': [
             'notification=h.notification.worker:run',
             'nipsa=h.api.nipsa.worker:worker',
+            'streamer-ring=h.streamer.events:event_ring_writer',
         ],
         'h.annotool': [
             'prepare=h.api.search:prepare',